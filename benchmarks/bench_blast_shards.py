@@ -0,0 +1,98 @@
+#!/usr/bin/python3
+'''
+bench_blast_shards.py
+---------------------
+Benchmark de la búsqueda de blastp repartida en shards: compara la búsqueda
+sobre MultifaDB entero con la búsqueda repartida en shards
+(identipy.iblast.run_blastp) y comprueba que ambas encuentran los mismos
+hits con evalues parecidos. No son idénticos: el ajuste de longitud de
+BLAST+ depende del nº de secuencias de cada shard, así que se admite una
+diferencia relativa de los evalues y no se cuentan los hits que solo
+aparecen en una búsqueda si su evalue está cerca del límite.
+
+Se tiene que ejecutar en la carpeta del análisis (donde está MultifaDB.fasta).
+Si blastp no está instalado el benchmark se omite.
+
+Uso:
+    "bench_blast_shards.py query_path [shards] [evalue] [blastdb=0/1]"
+
+    - query_path: ruta del archivo fasta de querys
+    - shards: número de shards (def. 4)
+    - evalue: evalue usado en blastp (def. 0.01)
+    - blastdb: usar bases de datos formateadas (def. 1)
+'''
+
+import os
+import sys
+import time
+import shutil
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from identipy.iblast import run_blastp, make_blastdb, multifa_path
+
+
+def hit_table (lines):
+    '''
+    Convierte las líneas de blastp en un dict (query, subject) :: evalue
+    (el mejor de todas sus HSPs)
+    '''
+    table = {}
+    for line in lines:
+        fields = line.rstrip('\n').split('\t')
+        key = (fields[0], fields[1])
+        table[key] = min(table.get(key, float('inf')), float(fields[5]))
+
+    return table
+
+#end hit_table()
+
+
+def same_evalue (a, b, tolerance=0.1):
+    '''
+    Compara dos evalues con tolerancia relativa (blastp los redondea y el
+    ajuste de longitud de cada shard los cambia ligeramente)
+    '''
+    return abs(a - b) <= tolerance * max(abs(a), abs(b)) or a == b
+
+#end same_evalue()
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print(__doc__)
+        exit(1)
+    if shutil.which('blastp') is None:
+        print('blastp no está instalado: se omite el benchmark')
+        exit(0)
+    query_path = sys.argv[1]
+    shards = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+    evalue = float(sys.argv[3]) if len(sys.argv) > 3 else 0.01
+    blastdb = not (len(sys.argv) > 4 and sys.argv[4] == 'blastdb=0')
+
+    db = make_blastdb(multifa_path()) if blastdb else None
+
+    start = time.perf_counter()
+    single = hit_table(run_blastp(query_path, evalue, db))
+    single_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    sharded = hit_table(run_blastp(query_path, evalue, db, shards=shards))
+    sharded_time = time.perf_counter() - start
+
+    #Los hits con evalue cercano al límite pueden quedar a un lado u otro
+    missing = [key for key in set(single) - set(sharded) \
+               if not same_evalue(single[key], evalue, 0.5)]
+    extra = [key for key in set(sharded) - set(single) \
+             if not same_evalue(sharded[key], evalue, 0.5)]
+    different = [key for key in set(single) & set(sharded) \
+                 if not same_evalue(single[key], sharded[key])]
+
+    print('Hits sin shards:     '+str(len(single)))
+    print('Hits con '+str(shards)+' shards:  '+str(len(sharded)))
+    print('Tiempo sin shards:   %.3f s' % single_time)
+    print('Tiempo con shards:   %.3f s' % sharded_time)
+    print('Hits que faltan:     '+str(len(missing)))
+    print('Hits de más:         '+str(len(extra)))
+    print('Evalues distintos:   '+str(len(different)))
+    if missing or extra or different:
+        exit(1)
@@ -0,0 +1,163 @@
+#!/usr/bin/python3
+'''
+bench_hit_table.py
+------------------
+Benchmark de la tabla de hits de blastp: compara la lectura clásica del
+output de blastp (Blast_result y una lista de tuplas con los thresholds
+aplicados línea a línea, con el resumen por organismo en un bucle de
+Python) con la tabla columnar de identipy.iblast (HitTable, filter_hits y
+organism_summary).
+
+Las líneas de blastp son sintéticas (formato de BLAST_OUTFMT, con
+alineamientos de 50 a 400 residuos). Comprueba además que las dos lecturas
+dan los mismos hits y el mismo resumen por organismo, y compara el tamaño
+y el tiempo de relectura de Blast_result con los de Blast_result.npz.
+
+Uso:
+    "bench_hit_table.py [n_hits] [n_organisms] [seed]"
+
+    - n_hits: número de líneas de blastp (def. 200000)
+    - n_organisms: número de ensamblados (@id) de los subjects (def. 1000)
+    - seed: semilla del generador aleatorio (def. 1)
+'''
+
+import os
+import sys
+import time
+import tempfile
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from identipy.iblast import _write_blast_result, filter_hits, \
+                            organism_summary, load_hit_table
+
+#Thresholds de coverage e identidad (los de main.py por defecto)
+COV_T = 50
+IDEN_T = 30
+
+
+def blast_lines (n_hits, n_organisms, seed=1):
+    '''
+    Genera n_hits líneas de blastp con subjects locus@accession repartidos
+    entre n_organisms ensamblados
+    '''
+    rng = np.random.default_rng(seed)
+    organism = rng.integers(0, n_organisms, n_hits)
+    locus = rng.integers(0, max(1, n_hits // n_organisms), n_hits)
+    cov = rng.integers(1, 101, n_hits)
+    iden = rng.uniform(10, 100, n_hits)
+    evalue = 10.0 ** -rng.uniform(0, 100, n_hits)
+    bitscore = rng.uniform(20, 500, n_hits)
+    #Las secuencias alineadas son trozos de una proteína aleatoria
+    protein = ''.join(rng.choice(list('ACDEFGHIKLMNPQRSTVWY'), 1000))
+    start = rng.integers(0, 600, n_hits)
+    end = start + rng.integers(50, 401, n_hits)
+    return ['query1\tL%d_%d@NZ_%07d.1\t%d\t%.3f\t%s\t%.2e\t%.1f' \
+            % (n, locus, n, cov, iden, protein[a:b], evalue, bitscore) \
+            for n, locus, cov, iden, a, b, evalue, bitscore \
+            in zip(organism.tolist(), locus.tolist(), cov.tolist(), \
+                   iden.tolist(), start.tolist(), end.tolist(), \
+                   evalue.tolist(), bitscore.tolist())]
+
+#end blast_lines()
+
+
+def classic (result_path, lines, organisms):
+    '''
+    Lectura clásica: Blast_result, filas en tuplas, thresholds por línea y
+    resumen por organismo en un dict (organismo :: [proteínas, hits])
+    '''
+    hits = []
+    rows = []
+    with open(result_path+'/Blast_result', 'w') as blast_final:
+        blast_final.write('Query\tSubject\t% Coverage\t% Identity\t Sequence\n')
+        for line in lines:
+            fields = line.rstrip('\n').split('\t')
+            cov = float(fields[2])
+            iden = float(fields[3])
+            blast_final.write('\t'.join(fields[:5])+'\n')
+            rows.append((fields[0], fields[1], cov, iden))
+            if cov >= COV_T and iden >= IDEN_T:
+                hits.append(fields[1])
+    summary = {}
+    for name in set(hits):
+        organism = organisms[name.rpartition('@')[2]]
+        summary.setdefault(organism, [0, 0])[0] += 1
+    for name in hits:
+        summary[organisms[name.rpartition('@')[2]]][1] += 1
+    return hits, summary
+
+#end classic()
+
+
+def reread (result_path):
+    '''
+    Relectura clásica de los valores de cov e iden de Blast_result
+    '''
+    cov = []
+    iden = []
+    with open(result_path+'/Blast_result', 'r') as blast_file:
+        next(blast_file)
+        for line in blast_file:
+            fields = line.split('\t')
+            cov.append(float(fields[2]))
+            iden.append(float(fields[3]))
+    return np.array(cov), np.array(iden)
+
+#end reread()
+
+
+if __name__ == '__main__':
+    n_hits = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    n_organisms = int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+    seed = int(sys.argv[3]) if len(sys.argv) > 3 else 1
+
+    lines = blast_lines(n_hits, n_organisms, seed)
+    with tempfile.TemporaryDirectory() as tmp:
+        organisms = {'NZ_%07d.1' % n: 'Bacterium sp. %d' % n \
+                     for n in range(n_organisms)}
+        with open(tmp+'/ID_Organism_table.csv', 'w') as handle:
+            for record_id, organism in organisms.items():
+                handle.write(record_id+'\t'+organism+'\n')
+
+        start = time.perf_counter()
+        plain_hits, plain_summary = classic(tmp, lines, organisms)
+        plain_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        hits, table = _write_blast_result(tmp, lines, COV_T, IDEN_T, \
+                                          save_table=True)
+        write_time = time.perf_counter() - start
+        start = time.perf_counter()
+        summary = organism_summary(table, filter_hits(table, COV_T, IDEN_T), \
+                                   tmp+'/ID_Organism_table.csv')
+        summary_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        cov, iden = reread(tmp)
+        reread_time = time.perf_counter() - start
+        start = time.perf_counter()
+        loaded = load_hit_table(tmp+'/Blast_result.npz')
+        load_time = time.perf_counter() - start
+
+        text_size = os.path.getsize(tmp+'/Blast_result')
+        table_size = os.path.getsize(tmp+'/Blast_result.npz')
+
+    same = hits == plain_hits and \
+           {row[0]: [row[1], row[2]] for row in summary.tolist()} \
+           == plain_summary and (loaded.hits == table.hits).all() and \
+           (cov == table.hits['cov']).all() and \
+           (iden == table.hits['iden']).all()
+
+    print('Hits: '+str(n_hits)+'  Organismos: '+str(n_organisms)\
+         + '  Pasan los thresholds: '+str(len(hits)))
+    print('Lectura clásica (tuplas):          %.3f s' % plain_time)
+    print('Blast_result + tabla columnar:     %.3f s' % write_time)
+    print('Filtrado y resumen por organismo:  %.3f s' % summary_time)
+    print('Relectura de Blast_result:         %.3f s' % reread_time)
+    print('Carga de Blast_result.npz:         %.3f s' % load_time)
+    print('Blast_result: %.1f MB  Blast_result.npz: %.1f MB' \
+          % (text_size / 2**20, table_size / 2**20))
+    print('Resultados idénticos:              '+str(same))
+    if not same:
+        exit(1)
@@ -0,0 +1,85 @@
+#!/usr/bin/python3
+'''
+bench_import.py
+---------------
+Benchmark del tiempo de importación del paquete: mide `import identipy` en
+intérpretes nuevos (para que no haya nada en caché de sys.modules) y
+comprueba que no carga los módulos del paquete ni sus dependencias pesadas
+(NumPy, Biopython, matplotlib), que se importan la primera vez que se usan.
+También mide lo que cuesta el primer uso de cada módulo.
+
+Sirve como test de regresión: termina con error si import identipy carga
+alguna dependencia pesada o si tarda más de max_ms.
+
+Uso:
+    "bench_import.py [repeats] [max_ms]"
+
+    - repeats: nº de intérpretes en los que se mide cada caso (def. 5)
+    - max_ms: tiempo máximo en ms de import identipy (def. 100)
+'''
+
+import os
+import sys
+import json
+import statistics
+import subprocess
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+#Módulos que import identipy no debe cargar
+HEAVY = ['identipy.iblast', 'identipy.imuscle', 'identipy.iprosite', \
+         'numpy', 'Bio', 'matplotlib']
+
+#Casos medidos: código que se ejecuta después de import identipy
+CASES = [('import identipy', ''),
+         ('identipy.make_multifa', 'identipy.make_multifa'),
+         ('identipy.make_tree', 'identipy.make_tree'),
+         ('identipy.make_domain', 'identipy.make_domain'),
+         ('primer gráfico', 'identipy.iutils.new_figure("plot.png")')]
+
+
+def measure (code):
+    '''
+    Mide en un intérprete nuevo import identipy seguido de code
+
+    Output: tupla (segundos, lista de módulos pesados cargados)
+    '''
+    script = 'import sys, time, json\n' \
+             + 'start = time.perf_counter()\n' \
+             + 'import identipy\n' \
+             + code+'\n' \
+             + 'elapsed = time.perf_counter() - start\n' \
+             + 'print(json.dumps([elapsed, sorted({m.split(".")[0] if not ' \
+             + 'm.startswith("identipy.") else m for m in sys.modules})]))\n'
+    output = subprocess.run([sys.executable, '-c', script], cwd=ROOT, \
+                            capture_output=True, text=True, check=True)
+    elapsed, modules = json.loads(output.stdout)
+
+    return elapsed, [module for module in HEAVY if module in modules]
+
+#end measure()
+
+
+if __name__ == '__main__':
+    repeats = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    max_ms = float(sys.argv[2]) if len(sys.argv) > 2 else 100
+
+    failed = False
+    for name, code in CASES:
+        times = []
+        for _ in range(repeats):
+            elapsed, loaded = measure(code)
+            times.append(elapsed * 1000)
+        median = statistics.median(times)
+        print('%-26s %8.1f ms   cargados: %s' \
+              % (name, median, ', '.join(loaded) or '-'))
+        if not code:
+            if loaded:
+                print('  ERROR: import identipy carga dependencias pesadas')
+                failed = True
+            if median > max_ms:
+                print('  ERROR: import identipy tarda más de %g ms' % max_ms)
+                failed = True
+
+    if failed:
+        exit(1)
@@ -0,0 +1,315 @@
+#!/usr/bin/python3
+'''
+bench_pipeline.py
+-----------------
+Benchmark de todas las etapas de identipy sobre datos sintéticos
+(synthetic.py) de distintos tamaños: make_multifa, make_blastdb, blastp_hits,
+filter_database, make_domain, build_muscle, make_tree (UPGMA y NJ) y los
+gráficos (blast_plot, plot_muscle y plot_domains a archivo).
+
+Cada etapa se ejecuta en un intérprete nuevo (sobre los archivos que han
+dejado las anteriores) para medir por separado su tiempo real, su tiempo de
+CPU (del proceso y de sus subprocesos: blastp, muscle, workers...), su pico
+de memoria, su throughput (elementos procesados por segundo) y los
+contadores y procesos externos registrados por identipy.imetrics. Los
+resultados se escriben en JSON junto con el commit, para poder comparar
+entre commits.
+
+Las etapas que necesitan makeblastdb, blastp o muscle se omiten si no están
+instalados. Sin blastp las etapas siguientes usan como hits los homólogos
+generados (truth.json) y sin muscle el árbol se calcula sobre esos homólogos,
+que ya están alineados (no tienen indels).
+
+Uso:
+    "bench_pipeline.py [sizes] [output] [workers] [seed]"
+
+    - sizes: nº de proteínas de cada tamaño separados por comas
+             (def. 1000,10000,100000; se puede llegar a 1000000, que ocupa
+             unos 2 GB en disco)
+    - output: archivo JSON de resultados (def. bench_pipeline.json)
+    - workers: procesos de make_multifa y make_domain e hilos de blastp
+               (def. 1)
+    - seed: semilla de los datos sintéticos (def. 1)
+'''
+
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import resource
+import tempfile
+import subprocess
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from synthetic import make_dataset
+
+#Etapas en orden de ejecución y programa externo que necesita cada una
+STAGES = ['make_multifa', 'make_blastdb', 'blastp_hits', 'filter_database', \
+          'make_domain', 'build_muscle', 'make_tree_upgma', 'make_tree_nj', \
+          'plots']
+STAGE_TOOLS = {'make_blastdb': 'makeblastdb', 'blastp_hits': 'blastp', \
+               'build_muscle': 'muscle'}
+
+
+def _query_hits (query, truth):
+    '''
+    Hits de una query: los de blastp_hits si se ha ejecutado y si no los
+    homólogos generados
+    '''
+    path = 'Result_'+query+'/hits.json'
+    if os.path.isfile(path):
+        with open(path) as handle:
+            return json.load(handle)
+
+    return truth[query]
+
+#end _query_hits()
+
+
+def _counter (name):
+    '''
+    Valor actual de un contador de identipy.imetrics (0 sin métricas activas)
+    '''
+    from identipy import imetrics
+    report = imetrics.report()
+
+    return report['counters'].get(name, 0) if report else 0
+
+#end _counter()
+
+
+def run_stage (stage, workers):
+    '''
+    Ejecuta una etapa sobre los datos de la carpeta actual
+
+    Output: dict con el nº de elementos procesados y notas de la etapa
+    '''
+    import identipy as id
+    with open('truth.json') as handle:
+        truth = json.load(handle)
+    queries = sorted(truth)
+    info = {}
+
+    if stage == 'make_multifa':
+        id.make_multifa('db', incremental=False, workers=workers)
+        items = len(id.load_fasta_index('MultifaDB.fasta'))
+
+    elif stage == 'make_blastdb':
+        id.make_blastdb('MultifaDB.fasta')
+        items = len(id.load_fasta_index('MultifaDB.fasta'))
+
+    elif stage == 'blastp_hits':
+        db = 'MultifaDB' if shutil.which('makeblastdb') else None
+        found = 0
+        for query in queries:
+            os.makedirs('Result_'+query, exist_ok=True)
+            hits = id.blastp_hits('queries/'+query+'.fasta', 'Result_'+query, \
+                                  0.01, 50, 50, db=db, threads=workers, \
+                                  cache=False)
+            with open('Result_'+query+'/hits.json', 'w') as handle:
+                json.dump(hits, handle)
+            found += len(set(hits) & set(truth[query]))
+        #Elementos: proteínas comparadas con alguna query
+        items = len(queries) * len(id.load_fasta_index('MultifaDB.fasta'))
+        info['recall'] = found / sum(len(truth[query]) for query in queries)
+
+    elif stage == 'filter_database':
+        items = 0
+        for query in queries:
+            os.makedirs('Result_'+query, exist_ok=True)
+            hits = _query_hits(query, truth)
+            id.filter_database('Result_'+query, 'queries/'+query+'.fasta', hits)
+            items += len(hits)
+        info['hits'] = 'blastp' if os.path.isfile('Result_'+queries[0] \
+                                                  +'/hits.json') else 'truth'
+
+    elif stage == 'make_domain':
+        #Elementos: secuencias escaneadas según el contador de las métricas
+        #(la query y los hits distintos de cada query)
+        scanned = _counter('sequences_scanned')
+        for query in queries:
+            table = id.make_domain('Result_'+query, 'prosite.dat', workers, \
+                                   'Result_'+query+'/Domains.npz', cache=False)
+            info['domains'] = info.get('domains', 0) + len(table.start)
+        items = _counter('sequences_scanned') - scanned
+
+    elif stage == 'build_muscle':
+        items = 0
+        for query in queries:
+            id.build_muscle('Result_'+query)
+            items += len(_query_hits(query, truth))
+
+    elif stage in ('make_tree_upgma', 'make_tree_nj'):
+        items = 0
+        for query in queries:
+            #Sin muscle se usan las secuencias filtradas, que ya están
+            #alineadas
+            if not os.path.isfile('Result_'+query+'/MuscleAlign'):
+                shutil.copy('Result_'+query+'/MultifaFiltered.fasta', \
+                            'Result_'+query+'/MuscleAlign')
+                info['alignment'] = 'synthetic'
+            id.make_tree('Result_'+query, stage.split('_')[-1])
+            items += len(_query_hits(query, truth))
+
+    elif stage == 'plots':
+        import matplotlib
+        matplotlib.use('Agg')
+        items = 0
+        for query in queries:
+            result_path = 'Result_'+query
+            if os.path.isfile(result_path+'/Blast_result'):
+                id.blast_plot(result_path+'/Blast_result', \
+                              result_path+'/BlastPlot.png')
+                items += 1
+            id.plot_muscle(result_path, output_path=result_path \
+                           +'/MuscleTree.png')
+            id.plot_domains(result_path+'/Domains.npz', result_path \
+                            +'/DomainsPlot.png')
+            items += 2
+
+    else:
+        raise Exception('Etapa desconocida: '+stage)
+
+    info['items'] = items
+    return info
+
+#end run_stage()
+
+
+def peak_rss ():
+    '''
+    Pico de memoria residente (MB) del proceso actual. En Linux se lee
+    VmHWM de /proc, porque ru_maxrss incluye la memoria del proceso padre en
+    el momento del fork
+    '''
+    try:
+        with open('/proc/self/status') as handle:
+            for line in handle:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    #ru_maxrss está en KB en Linux y en bytes en macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024 if sys.platform == 'darwin' else 1024)
+
+#end peak_rss()
+
+
+def measure_stage (stage, workers):
+    '''
+    Ejecuta run_stage midiendo tiempo real, CPU y memoria (se llama en el
+    intérprete hijo, ver --stage)
+    '''
+    #Los módulos se importan antes de medir para no contar su importación
+    import identipy.iblast, identipy.imuscle, identipy.iprosite
+    from identipy import imetrics
+    imetrics.enable()
+    baseline = peak_rss()
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    start = time.perf_counter()
+    cpu = time.process_time()
+
+    info = run_stage(stage, workers)
+
+    wall = time.perf_counter() - start
+    cpu = time.process_time() - cpu
+    after = resource.getrusage(resource.RUSAGE_CHILDREN)
+    info.update({'wall_s': wall, 'cpu_s': cpu, \
+                 'children_cpu_s': after.ru_utime + after.ru_stime \
+                                   - children.ru_utime - children.ru_stime, \
+                 'peak_rss_mb': peak_rss(), 'baseline_rss_mb': baseline, \
+                 #Pico del mayor subproceso (blastp, muscle, workers...)
+                 'children_peak_rss_mb': after.ru_maxrss / 1024, \
+                 'items_per_s': info['items'] / wall if wall else None})
+    #Contadores y tiempo de los procesos externos según identipy.imetrics
+    metrics = imetrics.report()
+    info.update({'counters': metrics['counters'], \
+                 'tools': metrics['tool_totals']})
+
+    return info
+
+#end measure_stage()
+
+
+def git_commit ():
+    '''
+    Commit actual del repositorio (o None si no se puede obtener)
+    '''
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=ROOT, \
+                              capture_output=True, text=True, \
+                              check=True).stdout.strip()
+    except Exception:
+        return None
+
+#end git_commit()
+
+
+if __name__ == '__main__':
+    #Modo hijo: ejecuta una sola etapa en la carpeta actual
+    if len(sys.argv) > 1 and sys.argv[1] == '--stage':
+        print(json.dumps(measure_stage(sys.argv[2], int(sys.argv[3]))))
+        exit(0)
+
+    sizes = [int(size) for size in sys.argv[1].split(',')] \
+            if len(sys.argv) > 1 else [1000, 10000, 100000]
+    output = os.path.abspath(sys.argv[2]) if len(sys.argv) > 2 \
+             else os.path.abspath('bench_pipeline.json')
+    workers = int(sys.argv[3]) if len(sys.argv) > 3 else 1
+    seed = int(sys.argv[4]) if len(sys.argv) > 4 else 1
+
+    report = {'benchmark': 'bench_pipeline', 'commit': git_commit(), \
+              'date': time.strftime('%Y-%m-%dT%H:%M:%S'), \
+              'python': platform.python_version(), \
+              'platform': platform.platform(), 'cpus': os.cpu_count(), \
+              'workers': workers, 'seed': seed, \
+              'tools': {tool: shutil.which(tool) for tool in \
+                        ['makeblastdb', 'blastp', 'muscle']}, \
+              'results': []}
+
+    for size in sizes:
+        with tempfile.TemporaryDirectory(prefix='identipy_bench_') as folder:
+            start = time.perf_counter()
+            truth = make_dataset(folder, size, seed=seed)
+            print('\n%d proteínas (%d homólogos por query), datos generados '\
+                  'en %.1f s' % (size, len(next(iter(truth.values()))), \
+                                time.perf_counter() - start))
+            for stage in STAGES:
+                result = {'size': size, 'stage': stage}
+                tool = STAGE_TOOLS.get(stage)
+                if tool is not None and shutil.which(tool) is None:
+                    result.update({'status': 'skipped', \
+                                   'reason': tool+' no está instalado'})
+                else:
+                    process = subprocess.run([sys.executable, \
+                                              os.path.abspath(__file__), \
+                                              '--stage', stage, str(workers)], \
+                                             cwd=folder, capture_output=True, \
+                                             text=True)
+                    if process.returncode == 0:
+                        result['status'] = 'ok'
+                        result.update(json.loads(\
+                                      process.stdout.strip().split('\n')[-1]))
+                    else:
+                        result.update({'status': 'error', 'reason': \
+                                       process.stderr.strip().split('\n')[-1]})
+                report['results'].append(result)
+
+                if result['status'] == 'ok':
+                    print('  %-16s %9.2f s  %8.1f MB  %12.1f /s' \
+                          % (stage, result['wall_s'], result['peak_rss_mb'], \
+                             result['items_per_s'] or 0))
+                else:
+                    print('  %-16s %s: %s' % (stage, result['status'], \
+                                             result['reason']))
+                #El JSON se reescribe tras cada etapa para no perder los
+                #resultados si se interrumpe
+                with open(output, 'w') as handle:
+                    json.dump(report, handle, indent=1)
+
+    print('\nResultados en '+output)
@@ -0,0 +1,72 @@
+#!/usr/bin/python3
+'''
+bench_prefilter.py
+------------------
+Benchmark del prefiltro de k-mers de blastp: para cada query compara la
+búsqueda sobre MultifaDB entero con la búsqueda solo en los candidatos del
+prefiltro (identipy.iblast.prefilter_recall) e indica el recall (hits que
+pasan los thresholds encontrados con prefiltro / hits de la búsqueda entera),
+la fracción de MultifaDB que se descarta y el tiempo de cada búsqueda.
+
+Se tiene que ejecutar en la carpeta del análisis (donde está MultifaDB.fasta).
+Si blastp no está instalado el benchmark se omite.
+
+Uso:
+    "bench_prefilter.py query_path [evalue] [cov] [iden] [blastdb=0/1]"
+
+    - query_path: archivo fasta de querys o carpeta con un archivo por query
+    - evalue: evalue usado en blastp (def. 0.01)
+    - cov, iden: thresholds de coverage e identity (def. 50 y 50)
+    - blastdb: usar la base de datos formateada (def. 1)
+'''
+
+import os
+import sys
+import time
+import shutil
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from identipy.iblast import prefilter_recall, make_blastdb, make_kmer_index, \
+                           multifa_path
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print(__doc__)
+        exit(1)
+    if shutil.which('blastp') is None:
+        print('blastp no está instalado: se omite el benchmark')
+        exit(0)
+    query_path = sys.argv[1]
+    evalue = float(sys.argv[2]) if len(sys.argv) > 2 else 0.01
+    cov = float(sys.argv[3]) if len(sys.argv) > 3 else 50
+    iden = float(sys.argv[4]) if len(sys.argv) > 4 else 50
+    blastdb = not (len(sys.argv) > 5 and sys.argv[5] == 'blastdb=0')
+
+    if os.path.isdir(query_path):
+        paths = [os.path.join(query_path, file) \
+                 for file in sorted(os.listdir(query_path))]
+    else:
+        paths = [query_path]
+    db = make_blastdb(multifa_path()) if blastdb else None
+
+    start = time.perf_counter()
+    make_kmer_index(multifa_path())
+    print('Índice de k-mers: %.3f s' % (time.perf_counter() - start))
+
+    found = 0
+    total = 0
+    for path in paths:
+        start = time.perf_counter()
+        result = prefilter_recall(path, evalue, cov, iden, db)
+        elapsed = time.perf_counter() - start
+        found += result['recall'] * result['full_hits']
+        total += result['full_hits']
+        print('%s: recall %.3f (%d/%d hits), candidatos %d de %d (%.1f%%), '\
+              '%.3f s' % (os.path.basename(path), result['recall'], \
+                          result['prefilter_hits'], result['full_hits'], \
+                          result['candidates'], result['proteins'], \
+                          100 * result['candidates'] / result['proteins'], \
+                          elapsed))
+
+    print('Recall total: %.3f' % (found / total if total else 1.0))
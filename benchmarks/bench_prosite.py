@@ -0,0 +1,73 @@
+#!/usr/bin/python3
+'''
+bench_prosite.py
+----------------
+Benchmark del escaneo de dominios de prosite: compara el escaneo clásico
+(un re.search por patrón y proteína) con el escaneo con prefiltro de
+residuos obligatorios de identipy.iprosite.scan_sequence.
+
+Comprueba además que los dos escaneos encuentran exactamente los mismos
+dominios en las mismas posiciones.
+
+Uso:
+    "bench_prosite.py prosite_path [n_proteins] [seed]"
+
+    - prosite_path: ruta del archivo prosite.dat
+    - n_proteins: número de proteínas sintéticas escaneadas (def. 5000)
+    - seed: semilla del generador aleatorio (def. 1)
+'''
+
+import os
+import sys
+import time
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from identipy.iprosite import load_prosite, build_prefilter, scan_sequence
+from synthetic import random_sequences
+
+
+def as_comparable (found):
+    '''
+    Convierte el output de scan_sequence en tuplas comparables
+    '''
+    return [(name, match.start(), match.end()) \
+            for name, accession, description, match in found]
+
+#end as_comparable()
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print(__doc__)
+        exit(1)
+    prosite_path = sys.argv[1]
+    n_proteins = int(sys.argv[2]) if len(sys.argv) > 2 else 5000
+    seed = int(sys.argv[3]) if len(sys.argv) > 3 else 1
+
+    library = load_prosite(prosite_path)
+    start = time.perf_counter()
+    prefilter = build_prefilter(library)
+    build_time = time.perf_counter() - start
+    proteins = random_sequences(np.random.default_rng(seed), n_proteins)
+
+    start = time.perf_counter()
+    plain = [scan_sequence(seq, library) for seq in proteins]
+    plain_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    filtered = [scan_sequence(seq, library, prefilter) for seq in proteins]
+    filtered_time = time.perf_counter() - start
+
+    same = all(as_comparable(a) == as_comparable(b) \
+               for a, b in zip(plain, filtered))
+
+    print('Patrones: '+str(len(library))+'  Proteínas: '+str(n_proteins))
+    print('Construcción del prefiltro: %.3f s' % build_time)
+    print('Escaneo sin prefiltro:      %.3f s' % plain_time)
+    print('Escaneo con prefiltro:      %.3f s' % filtered_time)
+    print('Aceleración:                %.2fx' % (plain_time/filtered_time))
+    print('Resultados idénticos:       '+str(same))
+    if not same:
+        exit(1)
@@ -0,0 +1,106 @@
+#!/usr/bin/python3
+'''
+bench_tree.py
+-------------
+Benchmark de la construcción del árbol filogenético: compara el árbol
+calculado con NumPy (identipy.imuscle.make_tree con UPGMA y neighbor-joining)
+con el de muscle -maketree sobre un alineamiento sintético.
+
+Las secuencias se generan haciendo evolucionar una secuencia ancestral por un
+árbol aleatorio, así que el alineamiento tiene estructura filogenética. Para
+cada método se indica el tiempo y la distancia de Robinson-Foulds (nº de
+grupos distintos) respecto al árbol UPGMA. Si muscle no está instalado se
+omite su parte.
+
+Uso:
+    "bench_tree.py [n_sequences] [length] [seed]"
+
+    - n_sequences: número de secuencias del alineamiento (def. 1000)
+    - length: longitud del alineamiento (def. 300)
+    - seed: semilla del generador aleatorio (def. 1)
+'''
+
+import os
+import sys
+import time
+import random
+import shutil
+import tempfile
+from Bio import Phylo
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from identipy.imuscle import make_tree
+
+LETTERS = 'ACDEFGHIKLMNPQRSTVWY'
+
+
+def evolve (n, length, seed=1, rate=0.08, gap_rate=0.01):
+    '''
+    Genera n secuencias alineadas haciendo evolucionar una secuencia
+    ancestral aleatoria: en cada división cada posición cambia con
+    probabilidad rate y pasa a gap con probabilidad gap_rate
+    '''
+    rng = random.Random(seed)
+    sequences = [[rng.choice(LETTERS) for _ in range(length)]]
+    while len(sequences) < n:
+        parent = sequences.pop(rng.randrange(len(sequences)))
+        for _ in range(2):
+            child = list(parent)
+            for position in range(length):
+                draw = rng.random()
+                if draw < gap_rate:
+                    child[position] = '-'
+                elif draw < rate:
+                    child[position] = rng.choice(LETTERS)
+            sequences.append(child)
+
+    return [''.join(sequence) for sequence in sequences[:n]]
+
+#end evolve()
+
+
+def clades (tree_path):
+    '''
+    Conjunto de grupos (hojas de cada nodo interno) de un árbol newick
+    '''
+    tree = Phylo.read(tree_path, 'newick')
+    leaves = frozenset(leaf.name for leaf in tree.get_terminals())
+    groups = set()
+    for clade in tree.get_nonterminals():
+        group = frozenset(leaf.name for leaf in clade.get_terminals())
+        #Se compara sin raíz: cada grupo se guarda junto con su complemento
+        if 1 < len(group) < len(leaves) - 1:
+            groups.add(min(group, leaves - group, key=sorted))
+
+    return groups
+
+#end clades()
+
+
+if __name__ == '__main__':
+    n_sequences = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    length = int(sys.argv[2]) if len(sys.argv) > 2 else 300
+    seed = int(sys.argv[3]) if len(sys.argv) > 3 else 1
+
+    methods = ['upgma', 'nj']
+    if shutil.which('muscle') is not None:
+        methods.append('muscle')
+    else:
+        print('muscle no está instalado: se omite muscle -maketree')
+
+    with tempfile.TemporaryDirectory() as tmp:
+        with open(tmp+'/MuscleAlign', 'w') as handle:
+            for n, sequence in enumerate(evolve(n_sequences, length, seed)):
+                handle.write('>seq_'+str(n)+'\n'+sequence+'\n')
+
+        print('Secuencias: '+str(n_sequences)+'  Longitud: '+str(length))
+        reference = None
+        for method in methods:
+            start = time.perf_counter()
+            make_tree(tmp, method)
+            elapsed = time.perf_counter() - start
+            groups = clades(tmp+'/MuscleTree.nw')
+            if reference is None:
+                reference = groups
+            print('%-7s %8.3f s   Robinson-Foulds frente a UPGMA: %d' \
+                  % (method, elapsed, len(groups ^ reference)))
@@ -0,0 +1,239 @@
+#!/usr/bin/python3
+'''
+synthetic.py
+------------
+Generadores de datos sintéticos para los benchmarks: ensamblados GenBank,
+querys fasta y un prosite.dat reducido, con la misma estructura que los
+archivos reales que usa identipy.
+
+Las proteínas de los ensamblados son de dos tipos: familias de homólogos de
+cada query (la query con un % de sustituciones, sin indels, así que las de
+una familia ya están alineadas entre sí) y proteínas aleatorias de fondo con
+la composición de aminoácidos de UniProt. Las secuencias se generan con
+NumPy por ensamblado para poder llegar a millones de proteínas.
+
+Uso:
+    "synthetic.py folder n_proteins [n_queries] [seed]"
+
+    Crea en folder las carpetas db (ensamblados) y queries y los archivos
+    prosite.dat y truth.json (miembros de cada familia)
+
+    - n_proteins: número total de proteínas de los ensamblados
+    - n_queries: número de querys (y de familias de homólogos) (def. 5)
+    - seed: semilla del generador aleatorio (def. 1)
+'''
+
+import os
+import sys
+import json
+import numpy as np
+
+#Frecuencias aproximadas de aminoácidos en UniProt (%), para que las
+#proteínas sintéticas se parezcan en composición a las reales
+AA_FREQ = {'A': 8.25, 'R': 5.53, 'N': 4.06, 'D': 5.45, 'C': 1.37,
+           'Q': 3.93, 'E': 6.75, 'G': 7.07, 'H': 2.27, 'I': 5.96,
+           'L': 9.66, 'K': 5.84, 'M': 2.42, 'F': 3.86, 'P': 4.70,
+           'S': 6.56, 'T': 5.34, 'W': 1.08, 'Y': 2.92, 'V': 6.87}
+AA_LETTERS = np.frombuffer(''.join(AA_FREQ).encode(), dtype=np.uint8)
+AA_P = np.array(list(AA_FREQ.values())) / sum(AA_FREQ.values())
+NT_LETTERS = np.frombuffer(b'acgt', dtype=np.uint8)
+
+#Proteínas por ensamblado (record GenBank)
+PROTEINS_PER_ASSEMBLY = 5000
+
+#Patrones del prosite.dat reducido: los más frecuentes de prosite real (que
+#aparecen en casi todas las proteínas) y algunos raros
+PROSITE_PATTERNS = [
+    ('ASN_GLYCOSYLATION', 'PS00001', 'N-glycosylation site.', \
+     'N-{P}-[ST]-{P}.'),
+    ('CAMP_PHOSPHO_SITE', 'PS00004', \
+     'cAMP-dependent protein kinase phosphorylation site.', '[RK](2)-x-[ST].'),
+    ('PKC_PHOSPHO_SITE', 'PS00005', 'Protein kinase C phosphorylation site.', \
+     '[ST]-x-[RK].'),
+    ('CK2_PHOSPHO_SITE', 'PS00006', \
+     'Casein kinase II phosphorylation site.', '[ST]-x(2)-[DE].'),
+    ('MYRISTYL', 'PS00008', 'N-myristoylation site.', \
+     'G-{EDRKHPFYW}-x(2)-[STAGCN]-{P}.'),
+    ('AMIDATION', 'PS00009', 'Amidation site.', 'x-G-[RK]-[RK].'),
+    ('ATP_GTP_A', 'PS00017', 'ATP/GTP-binding site motif A (P-loop).', \
+     '[AG]-x(4)-G-K-[ST].'),
+    ('ZINC_FINGER_C2H2_1', 'PS00028', 'Zinc finger C2H2 type domain.', \
+     'C-x(2,4)-C-x(3)-[LIVMFYWC]-x(8)-H-x(3,5)-H.'),
+    ('LEUCINE_ZIPPER', 'PS00029', 'Leucine zipper pattern.', \
+     'L-x(6)-L-x(6)-L-x(6)-L.'),
+    ('PROKAR_LIPOPROTEIN', 'PS00013', \
+     'Prokaryotic membrane lipoprotein lipid attachment site.', \
+     '{DERK}(6)-[LIVMFWSTAG](2)-[LIVMFYSTAGCQ]-[AGS]-C.'),
+]
+
+
+def random_sequences (rng, n, min_len=100, max_len=600):
+    '''
+    Genera n secuencias de proteína aleatorias con la composición de AA_FREQ
+
+    Output: lista de strings
+    '''
+    lengths = rng.integers(min_len, max_len+1, size=n)
+    residues = AA_LETTERS[rng.choice(len(AA_LETTERS), size=int(lengths.sum()), \
+                                     p=AA_P)].tobytes().decode()
+    bounds = np.concatenate(([0], np.cumsum(lengths)))
+
+    return [residues[bounds[i]:bounds[i+1]] for i in range(n)]
+
+#end random_sequences()
+
+
+def mutate (rng, sequence, rate):
+    '''
+    Cambia cada posición de sequence por un aminoácido aleatorio con
+    probabilidad rate (sin indels, así que la longitud no cambia)
+    '''
+    array = np.frombuffer(sequence.encode(), dtype=np.uint8).copy()
+    changed = rng.random(len(array)) < rate
+    array[changed] = AA_LETTERS[rng.choice(len(AA_LETTERS), \
+                                           size=int(changed.sum()), p=AA_P)]
+
+    return array.tobytes().decode()
+
+#end mutate()
+
+
+def family_size (n_proteins, n_queries):
+    '''
+    Número de homólogos de cada query: crece con el tamaño de la base de
+    datos (1%) pero con un máximo para que muscle y los árboles sigan siendo
+    abordables con millones de proteínas
+    '''
+    return max(5, min(n_proteins // 100, 1000, n_proteins // (2*n_queries)))
+
+#end family_size()
+
+
+def genbank_record (accession, organism, proteins, rng):
+    '''
+    Texto de un record GenBank con un CDS (locus_tag y translation) por
+    proteína y la secuencia de nucleótidos (aleatoria) en ORIGIN, para que el
+    tamaño del archivo sea como el de un ensamblado real
+
+    Input:
+        - proteins: lista de tuplas (locus_tag, secuencia)
+    '''
+    length = sum(3 * len(sequence) + 3 for _, sequence in proteins)
+    lines = ['LOCUS       %-16s %11d bp    DNA     linear   BCT 01-JAN-2020' \
+             % (accession[3:], length),
+             'DEFINITION  '+organism+' chromosome, complete genome.',
+             'ACCESSION   '+accession,
+             'VERSION     '+accession+'.1',
+             'KEYWORDS    .',
+             'SOURCE      '+organism,
+             '  ORGANISM  '+organism,
+             '            Bacteria; Pseudomonadota; Gammaproteobacteria.',
+             'FEATURES             Location/Qualifiers',
+             '     source          1..'+str(length),
+             '                     /organism="'+organism+'"']
+    position = 1
+    for locus_tag, sequence in proteins:
+        end = position + 3 * len(sequence) + 2
+        location = str(position)+'..'+str(end)
+        lines.append('     gene            '+location)
+        lines.append('                     /locus_tag="'+locus_tag+'"')
+        lines.append('     CDS             '+location)
+        lines.append('                     /locus_tag="'+locus_tag+'"')
+        lines.append('                     /product="hypothetical protein"')
+        text = '/translation="'+sequence+'"'
+        for start in range(0, len(text), 58):
+            lines.append(' '*21+text[start:start+58])
+        position = end + 1
+
+    lines.append('ORIGIN')
+    bases = NT_LETTERS[rng.integers(0, 4, size=length)].tobytes().decode()
+    for start in range(0, length, 60):
+        row = bases[start:start+60]
+        lines.append('%9d %s' % (start + 1, ' '.join(row[i:i+10] \
+                                 for i in range(0, len(row), 10))))
+    lines.append('//')
+
+    return '\n'.join(lines)+'\n'
+
+#end genbank_record()
+
+
+def write_prosite (path):
+    '''
+    Escribe un prosite.dat reducido con los patrones de PROSITE_PATTERNS
+    '''
+    with open(path, 'w') as handle:
+        handle.write('CC   Synthetic prosite.dat for identipy benchmarks\n//\n')
+        for name, accession, description, pattern in PROSITE_PATTERNS:
+            handle.write('ID   '+name+'; PATTERN.\nAC   '+accession+';\nDE   '\
+                         + description+'\nPA   '+pattern+'\n//\n')
+
+    return None
+
+#end write_prosite()
+
+
+def make_dataset (folder, n_proteins, n_queries=5, seed=1):
+    '''
+    Genera un conjunto de datos completo en folder: db/asm_*.gbk, queries/
+    q*.fasta, prosite.dat y truth.json con los ids (locus_tag@accesión) de
+    los homólogos de cada query
+
+    Output: dict de truth.json {query: [ids]}
+    '''
+    rng = np.random.default_rng(seed)
+    os.makedirs(folder+'/db', exist_ok=True)
+    os.makedirs(folder+'/queries', exist_ok=True)
+    write_prosite(folder+'/prosite.dat')
+
+    #Cada query es una proteína aleatoria de longitud típica y sus homólogos
+    #tienen entre un 5 y un 35% de sustituciones
+    queries = random_sequences(rng, n_queries, 250, 400)
+    size = family_size(n_proteins, n_queries)
+    homologs = [(query, mutate(rng, queries[query], rng.uniform(0.05, 0.35))) \
+                for query in range(n_queries) for _ in range(size)]
+    #Los homólogos se reparten en posiciones aleatorias de la base de datos
+    slots = rng.choice(n_proteins, size=len(homologs), replace=False)
+    homolog_at = dict(zip(slots.tolist(), homologs))
+
+    truth = {'q'+str(query): [] for query in range(n_queries)}
+    for assembly, first in enumerate(range(0, n_proteins, \
+                                           PROTEINS_PER_ASSEMBLY)):
+        count = min(PROTEINS_PER_ASSEMBLY, n_proteins - first)
+        accession = 'NZ_CP%06d' % assembly
+        background = iter(random_sequences(rng, count))
+        proteins = []
+        for number in range(count):
+            locus_tag = 'SYN%04d_%05d' % (assembly, number)
+            sequence = next(background)
+            if first + number in homolog_at:
+                query, sequence = homolog_at[first + number]
+                truth['q'+str(query)].append(locus_tag+'@'+accession+'.1')
+            proteins.append((locus_tag, sequence))
+        with open(folder+'/db/asm_%04d.gbk' % assembly, 'w') as handle:
+            handle.write(genbank_record(accession, 'Bacterium synthetica '\
+                                        + str(assembly), proteins, rng))
+
+    for query, sequence in enumerate(queries):
+        with open(folder+'/queries/q'+str(query)+'.fasta', 'w') as handle:
+            handle.write('>query'+str(query)+'\n'+sequence+'\n')
+    with open(folder+'/truth.json', 'w') as handle:
+        json.dump(truth, handle)
+
+    return truth
+
+#end make_dataset()
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 3:
+        print(__doc__)
+        exit(1)
+    folder = sys.argv[1]
+    n_proteins = int(sys.argv[2])
+    n_queries = int(sys.argv[3]) if len(sys.argv) > 3 else 5
+    seed = int(sys.argv[4]) if len(sys.argv) > 4 else 1
+
+    truth = make_dataset(folder, n_proteins, n_queries, seed)
+    print('Proteínas: '+str(n_proteins)+'  Querys: '+str(n_queries) \
+          + '  Homólogos por query: '+str(len(next(iter(truth.values())))))
@@ -22,9 +22,75 @@ IDENTIPY - 5.0
     - iprosite:
         + Obtención de los dominios de las proteínas filtradas
         + Visualización de los dominios encontrados
+
+    - iutils:
+        + Utilidades comunes (checksums, lectura de archivos comprimidos,
+          carpeta de caché persistente, límite de procesos externos a la vez
+          y dibujo de gráficos a archivo en segundo plano)
+
+    - imetrics:
+        + Métricas de la ejecución (tiempo, CPU y memoria de cada etapa y
+          query, contadores y procesos externos) y perfilado con cProfile
 '''
 
-#Al importar el paquete se importan las funciones de los de módulos
-from .iblast import *
-from .imuscle import *
-from .iprosite import *
+#Los módulos no se importan al importar el paquete sino la primera vez que
+#se usa uno de sus nombres (p.ej. identipy.make_multifa importa iblast), de
+#forma que importar identipy es rápido aunque los módulos dependan de
+#NumPy, Biopython o matplotlib. Nombres públicos de cada módulo (los de
+#imetrics se usan como identipy.imetrics.stage... para no confundirlos):
+_exports = {
+    'iblast': ['BLAST_OUTFMT', 'MULTIFA_MANIFEST_VERSION', 'MEMBERS_PATH', \
+               'MULTIFA_PATH', 'genbank_proteins', 'fast_genbank_proteins', \
+               'multifa_path', 'make_multifa', 'load_members', \
+               'BLASTDB_MAX_ID_LENGTH', 'make_blastdb', 'blastdb_stamp', \
+               'FASTA_INDEX_DTYPE', 'make_fasta_index', 'load_fasta_index', \
+               'fetch_fasta', 'read_fasta', 'make_blast_shards', \
+               'run_blastp', 'BLAST_CACHE_MAX_BYTES', 'BLAST_CACHE_MAX_AGE', \
+               'cached_blastp', 'KMER_SIZE', 'KMER_ALPHABET', \
+               'make_kmer_index', 'prefilter_candidates', \
+               'run_blastp_subset', 'prefilter_recall', 'HIT_DTYPE', \
+               'HitTable', 'filter_hits', 'save_hit_table', 'load_hit_table', \
+               'organism_summary', 'blastp_hits', 'blastp_batch', \
+               'filter_database', 'blast_plot'],
+    'imuscle': ['word_length', 'cluster_sequences', 'cluster_filtered', \
+                'build_muscle', 'read_alignment', 'distance_matrix', 'upgma', \
+                'neighbor_joining', 'make_tree', 'build_muscle_async', \
+                'plot_muscle'],
+    'iprosite': ['PROSITE_INDEX_VERSION', 'adapt_pattern', \
+                 'prosite_checksum', 'load_prosite', \
+                 'pattern_requirements', 'sequence_grams', 'build_prefilter', \
+                 'scan_sequence', 'cached_domains', 'store_domains', \
+                 'DomainTable', 'DOMAIN_POOL_MIN_SEQUENCES', 'make_domain', 'save_domain_table', \
+                 'load_domain_table', 'color_dispenser', 'plot_domains'],
+    'iutils': ['COMPRESSION_MAGIC', 'compression', 'open_input', \
+               'set_tool_limit', 'WORKER_PRELOAD', 'worker_context', \
+               'start_plot_worker'],
+    'imetrics': [],
+}
+_modules = {name: module for module, names in _exports.items() \
+            for name in names}
+
+def __getattr__ (name):
+    '''
+    Importa el módulo que contiene name la primera vez que se pide y guarda
+    el valor en el paquete para que las siguientes veces no se pase por aquí
+    '''
+    import importlib
+    #Los propios módulos (identipy.iblast...) también se importan al pedirlos
+    if name in _exports:
+        return importlib.import_module('.'+name, __name__)
+    if name not in _modules:
+        raise AttributeError("module 'identipy' has no attribute '"+name+"'")
+    value = getattr(importlib.import_module('.'+_modules[name], __name__), \
+                    name)
+    globals()[name] = value
+
+    return value
+
+#end __getattr__()
+
+
+def __dir__ ():
+    return sorted(list(globals()) + list(_modules))
+
+#end __dir__()
@@ -1,74 +1,1723 @@
 import os
-from subprocess import call
+import json
+import math
+import time
+import mmap
+import hashlib
+import shutil
+import tempfile
+import threading
+from collections import namedtuple
+from subprocess import call, run, Popen, PIPE
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
-import matplotlib.pyplot as plt
-from Bio import SeqIO
+from Bio import SeqIO, bgzf
+from .iutils import file_checksum, file_stamp, cache_path, tool_slot, \
+                    new_figure, finish_figure, compression, open_input, \
+                    worker_context
+from . import imetrics
 
-def make_multifa (database_path):
+#Campos del output tabular de blastp (ver Blast_result)
+#(los dos últimos campos solo se usan internamente y no se escriben)
+BLAST_OUTFMT = '6 qseqid sseqid qcovs pident sseq evalue bitscore'
+
+#Longitud máxima de los ids que makeblastdb acepta con -parse_seqids
+BLASTDB_MAX_ID_LENGTH = 50
+
+#Versión del formato del manifiesto de la base de datos multifasta. Si se
+#cambia el formato de los shards se aumenta para que se regeneren todos
+MULTIFA_MANIFEST_VERSION = 1
+
+#Tabla de miembros de MultifaDB cuando se eliminan las secuencias repetidas
+#(ver make_multifa y load_members)
+MEMBERS_PATH = 'MultifaDB.members.tsv'
+
+#Multifasta con las proteínas de todos los ensamblados. Con compress (ver
+#make_multifa) se escribe en BGZF como MULTIFA_PATH+'.gz'
+MULTIFA_PATH = 'MultifaDB.fasta'
+
+def genbank_proteins (file_path):
+    '''
+    Extrae las proteínas de un archivo GenBank.
+
+    Input:
+        - file_path: ruta del archivo GenBank (puede estar comprimido con
+                     gzip, bzip2 o xz, ver open_input)
+
+    Output: tupla (tabla, fasta) con el texto de las líneas de la tabla
+            ID-organismo y de las entradas del multifasta de ese archivo.
+            Si el archivo no tiene ningún record (no es GenBank) se devuelve
+            None
+    '''
+    table = []
+    fasta = []
+    with open_input(file_path) as handle:
+        genbank = SeqIO.parse(handle, 'genbank')
+        #El control de argumentos es complicado porque SeqIO parsea
+        #el archivo sin producir error aunque no sea GenBank
+        #(no se puede usar try/except) por lo que se asume
+        #inicialmente que no tiene ningún record
+        any = False
+        for record in genbank:
+            #Si tiene algún record se cambia any -> True y se asume
+            #que es GenBank
+            any = True
+            #Para cada ensambldo se añade la entrada correspondiente
+            #en la tabla ID-organismo
+            table.append(record.id+'\t'+record.annotations['organism']+'\n')
+            #Para cada feature se prueba a obtener el locus_tag
+            #del gen y la secuencia de proteinas. Si se consigue se
+            #añade al multifasta y si no se pasa a la siguiente feature
+            for feature in record.features:
+                try:
+                    feature.qualifiers['locus_tag'][0]
+                    feature.qualifiers['translation'][0]
+                except:
+                    pass
+                else:
+                    #Se añade al final @id para identificar el organismo
+                    fasta.append(">"+feature.qualifiers['locus_tag'][0]\
+                                 +'@'+record.id+"\n")
+                    fasta.append(str(feature.qualifiers['translation'][0])\
+                                 +"\n\n")
+    if not any:
+        return None
+
+    return ''.join(table), ''.join(fasta)
+
+#end genbank_proteins()
+
+
+def fast_genbank_proteins (file_path):
+    '''
+    Versión rápida de genbank_proteins(): lee el archivo GenBank línea a
+    línea y solo extrae el id y el organismo de cada record y los qualifiers
+    locus_tag y translation de cada feature, sin construir los SeqRecord.
+
+    Input:
+        - file_path: ruta del archivo GenBank
+
+    Output: igual que genbank_proteins()
+    '''
+    table = []
+    fasta = []
+    any = False
+    #Sección del record en la que se está: None (fuera de un record),
+    #'header', 'features' o 'sequence'
+    section = None
+    with open_input(file_path) as handle:
+        for line in handle:
+            line = line.rstrip('\r\n')
+            if section is None:
+                #Un record empieza siempre con la línea LOCUS
+                if line.startswith('LOCUS'):
+                    any = True
+                    section = 'header'
+                    name = line[12:].split()[0] if line[12:].split() else ''
+                    accession = version = suffix = organism = None
+                    keyword = None
+                    proteins = []
+                continue
+
+            if line.startswith('//'):
+                #Fin del record: el id se obtiene igual que en Biopython
+                #(accesión + versión, o el nombre del LOCUS si no hay)
+                if section == 'features' and feature is not None:
+                    proteins.append(feature)
+                record_id = accession
+                if version and version.count('.') == 1 \
+                   and version.split('.')[1].isdigit():
+                    record_id = record_id or version.split('.')[0]
+                    suffix = version.split('.')[1]
+                elif version:
+                    record_id = version
+                if not record_id:
+                    record_id = name
+                elif '.' not in record_id and suffix:
+                    record_id += '.'+suffix
+                #Igual que con SeqIO, un record sin organismo es un error
+                if organism is None:
+                    raise KeyError('organism')
+                table.append(record_id+'\t'+organism+'\n')
+                for locus_tag, translation in proteins:
+                    if locus_tag is not None and translation is not None:
+                        #Se añade al final @id para identificar el organismo
+                        fasta.append('>'+locus_tag+'@'+record_id+'\n')
+                        fasta.append(translation+'\n\n')
+                section = None
+
+            elif section == 'header':
+                line_type = line[:12].strip()
+                data = line[12:].strip()
+                if line.startswith('FEATURES'):
+                    section = 'features'
+                    feature = None
+                    quoted = None
+                elif line_type == 'ACCESSION' and accession is None and data:
+                    accession = data.replace(';', ' ').split()[0]
+                elif line_type == 'VERSION':
+                    version = ' '.join(data.split()).split(' GI:')[0]
+                elif line_type == 'ORGANISM':
+                    organism = data
+                    lineage = False
+                if line_type:
+                    keyword = line_type
+                elif keyword == 'ORGANISM':
+                    #Líneas que siguen a ORGANISM: son el linaje si tienen ';'
+                    #o son un reino, y si no el nombre del organismo partido
+                    if lineage or ';' in data or data in ('Bacteria.', \
+                       'Archaea.', 'Eukaryota.', 'Unclassified.', 'Viruses.', \
+                       'cellular organisms.', 'other sequences.', \
+                       'unclassified sequences.'):
+                        lineage = True
+                    elif data != '.':
+                        organism += ' '+data
+
+            elif section == 'features':
+                #Si se está dentro de un valor entre comillas de varias líneas
+                #se acumula hasta encontrar la comilla de cierre
+                if quoted is not None:
+                    quoted[1].append(line[21:].strip())
+                    if line.rstrip().endswith('"'):
+                        _close_qualifier(feature, quoted)
+                        quoted = None
+                elif not line[:1].isspace():
+                    #Cualquier sección nueva (ORIGIN, CONTIG...) cierra las
+                    #features
+                    if feature is not None:
+                        proteins.append(feature)
+                    section = 'sequence'
+                elif line[5:6].strip():
+                    #Nueva feature: [locus_tag, translation]
+                    if feature is not None:
+                        proteins.append(feature)
+                    feature = [None, None]
+                elif line[21:22] == '/' and feature is not None:
+                    key, _, value = line[22:].partition('=')
+                    value = value.strip()
+                    if value.startswith('"') and (len(value) == 1 \
+                       or not value.endswith('"')):
+                        quoted = (key, [value])
+                    else:
+                        _close_qualifier(feature, (key, [value]))
+
+    if not any:
+        return None
+
+    return ''.join(table), ''.join(fasta)
+
+#end fast_genbank_proteins()
+
+
+def _close_qualifier (feature, qualifier):
+    '''
+    Guarda en la feature [locus_tag, translation] el valor de un qualifier
+    (key, lista de líneas) si es el primero de ese tipo
+    '''
+    key, lines = qualifier
+    if key not in ('locus_tag', 'translation'):
+        return
+    value = ' '.join(lines)
+    if value.startswith('"') and value.endswith('"') and len(value) > 1:
+        value = value[1:-1].replace('""', '"')
+    if key == 'translation':
+        value = value.replace(' ', '')
+        if feature[1] is None:
+            feature[1] = value
+    elif feature[0] is None:
+        feature[0] = value
+
+#end _close_qualifier()
+
+
+def _extract_proteins (job):
+    '''
+    Extrae las proteínas de un archivo en un proceso worker de make_multifa.
+    job es la tupla (ruta del archivo, usar el parser rápido)
+    '''
+    file_path, fast = job
+    if fast:
+        return fast_genbank_proteins(file_path)
+
+    return genbank_proteins(file_path)
+
+#end _extract_proteins()
+
+
+def _load_manifest (manifest_path):
+    '''
+    Carga el manifiesto de make_multifa. Si no existe, está corrupto o es de
+    otra versión se devuelve un manifiesto vacío
+    '''
+    manifest = {}
+    try:
+        with open(manifest_path, 'r') as handle:
+            manifest = json.load(handle)
+    except Exception:
+        pass
+    if manifest.get('version') != MULTIFA_MANIFEST_VERSION:
+        manifest = {'version': MULTIFA_MANIFEST_VERSION, 'files': {}, \
+                    'output': {}}
+
+    return manifest
+
+#end _load_manifest()
+
+
+def multifa_path ():
+    '''
+    Ruta del MultifaDB actual: MULTIFA_PATH o, si make_multifa lo ha creado
+    comprimido (compress), MULTIFA_PATH+'.gz'
+    '''
+    if not os.path.isfile(MULTIFA_PATH) and os.path.isfile(MULTIFA_PATH+'.gz'):
+        return MULTIFA_PATH+'.gz'
+
+    return MULTIFA_PATH
+
+#end multifa_path()
+
+
+def _output_stamp (order, dedup=False, compress=False):
+    '''
+    Huella de los archivos resultado de make_multifa: orden de shards usado,
+    si se han eliminado las secuencias repetidas y tamaño/fecha de
+    modificación de MultifaDB (comprimido o no), de la tabla ID-organismo y
+    (con dedup) de la tabla de miembros
+    '''
+    stamp = {'order': order, 'dedup': dedup}
+    output_paths = [MULTIFA_PATH, 'ID_Organism_table.csv']
+    #Sin compress la huella es la misma que antes de existir la opción
+    if compress:
+        stamp['compress'] = True
+        output_paths[0] = MULTIFA_PATH+'.gz'
+    if dedup:
+        output_paths.append(MEMBERS_PATH)
+    for output_path in output_paths:
+        if not os.path.isfile(output_path):
+            return None
+        stat = os.stat(output_path)
+        stamp[output_path] = [stat.st_size, stat.st_mtime_ns]
+
+    return stamp
+
+#end _output_stamp()
+
+
+@imetrics.stage('make_multifa')
+def make_multifa (database_path, incremental=True, workers=1, fast=True, \
+                  blastdb=False, dedup=False, compress=False):
     '''
     Crea el archivo multifasta con las secuencias de proteína de un grupo de
     ensamblados genómicos de tipo GenBank.
 
     También comprueba que las secuencias están en el formato GenBank. Si no lo
     están se omiten con un aviso al usuario en vez de cancelar todo el script.
+    Los archivos comprimidos con gzip, bzip2 o xz (.gbk.gz, .gbff.bz2...) se
+    leen descomprimiéndolos al vuelo, cada uno en su proceso worker.
+
+    La reconstrucción es incremental: las proteínas de cada archivo se guardan
+    en un shard de la carpeta de caché identificado por el checksum del
+    archivo, y un manifiesto guarda ruta, tamaño, fecha de modificación y
+    checksum de cada archivo. Solo se parsean los archivos nuevos o
+    modificados y los resultados se rehacen concatenando los shards.
+
+    Con dedup las proteínas con secuencia idéntica (mismo digest) solo se
+    escriben una vez en MultifaDB, con el id de la primera (representante),
+    y en MultifaDB.members.tsv se guarda para cada representante con
+    repetidas la lista de todos sus miembros (ver load_members).
 
     Input:
         - database_path: ruta de la carpeta que contiene los archivos
+        - incremental: si es False se ignora la caché y se parsean todos los
+                       archivos de nuevo
+        - workers: número de procesos entre los que se reparten los archivos
+                   que hay que parsear
+        - fast: si es True se usa el parser ligero fast_genbank_proteins()
+                y si es False el parser completo de Biopython
+        - blastdb: si es True se crea también (si no está al día) la base
+                   de datos de BLAST formateada con make_blastdb()
+        - dedup: si es True se eliminan de MultifaDB las secuencias repetidas
+        - compress: si es True MultifaDB se escribe comprimido en BGZF
+                    (MultifaDB.fasta.gz, ver multifa_path), que se puede
+                    leer con gzip y admite el acceso directo del índice
 
     Output: genera el archivo MultifaDB. El return se silencia a 'None'
     '''
-    #Se abre el archivo donde se guarda el resultado
-    #y el archivo donde se guarda la tabla de equivalencias id - organismo
-    with open('MultifaDB.fasta', 'w') as output:
-        with open('ID_Organism_table.csv', 'w') as tabla:
-            #Cada archivo del directorio se abre y parsea
-            for file in os.listdir(database_path):
-                with open(database_path+'/'+file, 'r') as handle:
-                    genbank = SeqIO.parse(handle, 'genbank')
-                    #El control de argumentos es complicado porque SeqIO parsea
-                    #el archivo sin producir error aunque no sea GenBank
-                    #(no se puede usar try/except) por lo que se asume
-                    #inicialmente que no tiene ningún record
-                    any = False
-                    for record in genbank:
-                        #Si tiene algún record se cambia any -> True y se asume
-                        #que es GenBank
-                        any = True
-                        #Para cada ensambldo se añade la entrada correspondiente
-                        #en la tabla ID-organismo
-                        tabla.write(record.id+'\t'+record.annotations['organism']+'\n')
-                        #Para cada feature se prueba a obtener el locus_tag
-                        #del gen y la secuencia de proteinas. Si se consigue se
-                        #escribe en el archivo resultado y si no se pasa al
-                        #siguiente archivo
-                        for feature in record.features:
-                            try:
-                                feature.qualifiers['locus_tag'][0]
-                                feature.qualifiers['translation'][0]
-                            except:
-                                pass
+    manifest_path = cache_path('multifa', 'manifest.json')
+    manifest = _load_manifest(manifest_path)
+    files = {}
+    pending = []
+
+    #Cada archivo del directorio se compara con su entrada del manifiesto
+    for file in os.listdir(database_path):
+        file_path = database_path+'/'+file
+        stat = os.stat(file_path)
+        entry = manifest['files'].get(file_path)
+        #Si tamaño y fecha no han cambiado se confía en el checksum guardado
+        #y si han cambiado se recalcula (el contenido puede ser el mismo)
+        if not entry or entry['size'] != stat.st_size \
+           or entry['mtime'] != stat.st_mtime_ns:
+            entry = {'size': stat.st_size, 'mtime': stat.st_mtime_ns, \
+                     'sha256': file_checksum(file_path), 'genbank': None}
+        shard = cache_path('multifa', entry['sha256'])
+        has_shard = os.path.isfile(shard+'.tsv') \
+                    and os.path.isfile(shard+'.fasta')
+
+        #Si ya hay shard para ese contenido (aunque sea de otro archivo) no
+        #hace falta parsear. Los archivos que no eran GenBank tampoco se
+        #vuelven a parsear mientras no cambien
+        if incremental and has_shard:
+            entry['genbank'] = True
+        elif entry['genbank'] is not False or not incremental:
+            pending.append(file_path)
+        files[file_path] = entry
+
+    #Los archivos pendientes se parsean (repartidos entre un pool de
+    #procesos si workers > 1) y se guardan como shards
+    pool = None
+    if workers > 1 and len(pending) > 1:
+        pool = worker_context().Pool(min(workers, len(pending)))
+        results = pool.imap(_extract_proteins, \
+                            [(file_path, fast) for file_path in pending])
+    else:
+        results = map(_extract_proteins, \
+                      [(file_path, fast) for file_path in pending])
+    try:
+        for file_path, proteins in zip(pending, results):
+            files[file_path]['genbank'] = proteins is not None
+            imetrics.count('genbank_files_parsed')
+            if proteins is not None:
+                imetrics.count('proteins_parsed', proteins[1].count('>'))
+                #Se escriben a temporales que luego se renombran para que
+                #nunca quede un shard a medio escribir
+                shard = cache_path('multifa', files[file_path]['sha256'])
+                for extension, text in zip(['.tsv', '.fasta'], proteins):
+                    with open(shard+extension+'.tmp', 'w') as handle:
+                        handle.write(text)
+                    os.replace(shard+extension+'.tmp', shard+extension)
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+
+    #Si no había encontrado ningún record se avisa al usuario
+    #de que el tipo de archivo es incorrecto pero se omite para
+    #continuar el script
+    order = []
+    for file_path, entry in files.items():
+        if entry['genbank']:
+            order.append(entry['sha256'])
+        else:
+            print('\t\033[91m{x}\033[0m El archivo database '\
+                  + os.path.basename(file_path) +' no está en formato '\
+                  + 'genbank (o no contiene ninguna entrada) y se ha '\
+                  + 'omitido para el análisis.')
+
+    #Los resultados solo se rehacen si ha cambiado algún shard, su orden o
+    #los propios archivos resultado desde la última ejecución
+    output_path = MULTIFA_PATH+'.gz' if compress else MULTIFA_PATH
+    if not incremental or _output_stamp(order, dedup, compress) \
+       != manifest['output']:
+        #Se abre el archivo donde se guarda el resultado
+        #y el archivo donde se guarda la tabla de equivalencias id - organismo
+        #y se concatenan los shards en el orden de los archivos
+        residues = 0
+        digests = {}
+        members = {}
+        if compress:
+            output = bgzf.BgzfWriter(output_path, 'wb')
+        else:
+            output = open(output_path, 'w')
+        with output:
+            with open('ID_Organism_table.csv', 'w') as tabla:
+                for checksum in order:
+                    shard = cache_path('multifa', checksum)
+                    with open(shard+'.tsv', 'r') as handle:
+                        shutil.copyfileobj(handle, tabla)
+                    with open(shard+'.fasta', 'r') as handle:
+                        if not dedup:
+                            shutil.copyfileobj(handle, output)
+                            continue
+                        #Cada secuencia se identifica por su digest y solo
+                        #se escribe la primera vez que aparece
+                        for record_id, sequence in read_fasta(handle):
+                            residues += len(sequence)
+                            digest = hashlib.blake2b(sequence.encode(), \
+                                                     digest_size=16).digest()
+                            if digest not in digests:
+                                digests[digest] = record_id
+                                output.write('>'+record_id+'\n'+sequence \
+                                             +'\n\n')
                             else:
-                                output.write(">"+feature.qualifiers['locus_tag'][0]\
-                                             +'@'+record.id+"\n")
-                                            #Se añade al final @id para
-                                            #identificar el organismo
-                                output.write(str(feature.qualifiers['translation'][0])\
-                                             +"\n\n")
-                    #Si no se había encontrado ningún record se avisa al usuario
-                    #de que el tipo de archivo es incorrecto pero se omite para
-                    #continuar el script
-                    if not any:
-                         print('\t\033[91m{x}\033[0m El archivo database '\
-                               + file +' no está en formato genbank (o no '\
-                               + 'contiene ninguna entrada) y se ha omitido '\
-                               + 'para el análisis.')
+                                members.setdefault(digests[digest], \
+                                    [digests[digest]]).append(record_id)
+
+        #La tabla de miembros empieza con el nº de residuos de todas las
+        #proteínas (tamaño de la base de datos sin eliminar repetidas)
+        if dedup:
+            with open(MEMBERS_PATH, 'w') as handle:
+                handle.write('#residues\t'+str(residues)+'\n')
+                for representative, names in members.items():
+                    handle.write(representative+'\t'+','.join(names)+'\n')
+        elif os.path.isfile(MEMBERS_PATH):
+            os.remove(MEMBERS_PATH)
+        #Se borra el MultifaDB de la otra forma (comprimido o no) y su índice
+        other_path = MULTIFA_PATH if compress else MULTIFA_PATH+'.gz'
+        for path in [other_path, other_path+'.idx.npy', \
+                     other_path+'.idx.json']:
+            if os.path.isfile(path):
+                os.remove(path)
+
+    #Se borran los shards que ya no corresponden a ningún archivo
+    for shard_file in os.listdir(os.path.dirname(manifest_path)):
+        if shard_file.split('.')[0] not in order \
+           and shard_file.endswith(('.tsv', '.fasta')):
+            os.remove(cache_path('multifa', shard_file))
+
+    #Se guarda el manifiesto solo con los archivos actuales
+    manifest = {'version': MULTIFA_MANIFEST_VERSION, 'files': files, \
+                'output': _output_stamp(order, dedup, compress)}
+    with open(manifest_path+'.tmp', 'w') as handle:
+        json.dump(manifest, handle)
+    os.replace(manifest_path+'.tmp', manifest_path)
+
+    #El índice de acceso directo se rehace si MultifaDB ha cambiado
+    imetrics.count('genbank_files_cached', len(files) - len(pending))
+    imetrics.count('proteins_written', len(load_fasta_index(output_path)))
+    if blastdb:
+        make_blastdb(output_path)
 
     return None
 
 #end make_multifa()
 
 
-def blastp_hits (query_path, result_path, eval, cov_t, iden_t):
+def load_members (members_path=MEMBERS_PATH):
+    '''
+    Carga la tabla de miembros de MultifaDB creada por make_multifa con
+    dedup (si no existe es que MultifaDB contiene todas las proteínas)
+
+    Output: tupla (members, residues) con el dict representante :: lista de
+            todas las proteínas con su misma secuencia (él incluido) y el nº
+            de residuos de todas las proteínas, o (None, None) sin tabla
+    '''
+    if not os.path.isfile(members_path):
+        return None, None
+
+    members = {}
+    residues = None
+    with open(members_path, 'r') as handle:
+        for line in handle:
+            key, value = line.rstrip('\n').split('\t')
+            if key == '#residues':
+                residues = int(value)
+            else:
+                members[key] = value.split(',')
+
+    return members, residues
+
+#end load_members()
+
+
+@imetrics.stage('make_blastdb')
+def make_blastdb (fasta_path='MultifaDB.fasta'):
+    '''
+    Crea (con makeblastdb) la base de datos de BLAST formateada de un
+    multifasta de proteínas, junto al propio multifasta.
+
+    Junto a la base de datos se guarda un archivo .stamp con la huella del
+    multifasta del que se creó, de forma que solo se vuelve a crear si el
+    multifasta ha cambiado. Los ids se leen con -parse_seqids salvo que
+    alguno supere BLASTDB_MAX_ID_LENGTH caracteres (makeblastdb no los
+    acepta); en ese caso blastp devuelve igualmente la primera palabra de la
+    cabecera como sseqid.
+
+    Input:
+        - fasta_path: ruta del multifasta (puede estar comprimido, en cuyo
+                      caso se le pasa descomprimido a makeblastdb por stdin)
+
+    Output: ruta (sin extensión) de la base de datos, para blastp -db
+    '''
+    db_path = _blastdb_path(fasta_path)
+    stamp = blastdb_stamp(fasta_path)
+    if stamp is not None:
+        return db_path
+
+    stamp = file_stamp(fasta_path)
+    command = ['makeblastdb', '-dbtype', 'prot', '-out', db_path]
+    if _max_id_length(fasta_path) <= BLASTDB_MAX_ID_LENGTH:
+        command.insert(3, '-parse_seqids')
+    #makeblastdb escribe un resumen por stdout que se silencia
+    with open(os.devnull, 'w') as devnull, tool_slot('makeblastdb'):
+        if compression(fasta_path) is None:
+            code = call(command+['-in', fasta_path], stdout=devnull)
+        else:
+            #makeblastdb no lee archivos comprimidos, así que el multifasta
+            #se descomprime al vuelo hacia su stdin sin pasar por disco
+            process = Popen(command+['-in', '-', '-title', \
+                                     os.path.basename(db_path)], \
+                            stdin=PIPE, stdout=devnull)
+            try:
+                with open_input(fasta_path, 'rb') as handle:
+                    shutil.copyfileobj(handle, process.stdin)
+            except BrokenPipeError:
+                #Si makeblastdb termina antes de tiempo el error es su código
+                pass
+            finally:
+                try:
+                    process.stdin.close()
+                except BrokenPipeError:
+                    pass
+            code = process.wait()
+    if code != 0:
+        raise Exception('makeblastdb no ha podido crear la base de datos '\
+                        + db_path)
+    with open(db_path+'.stamp', 'w') as handle:
+        json.dump(stamp, handle)
+
+    return db_path
+
+#end make_blastdb()
+
+
+def _max_id_length (fasta_path):
+    '''
+    Longitud del id (primera palabra de la cabecera) más largo de un
+    multifasta
+    '''
+    longest = 0
+    with open_input(fasta_path, 'rb') as handle:
+        for line in handle:
+            if line.startswith(b'>') and line[1:].strip():
+                longest = max(longest, len(line[1:].split(None, 1)[0]))
+
+    return longest
+
+#end _max_id_length()
+
+
+def _blastdb_path (fasta_path):
+    '''
+    Ruta (sin extensión) de la base de datos de BLAST de un multifasta:
+    MultifaDB.fasta y MultifaDB.fasta.gz -> MultifaDB
+    '''
+    if fasta_path.endswith(('.gz', '.bgz', '.bz2', '.xz')):
+        fasta_path = os.path.splitext(fasta_path)[0]
+
+    return os.path.splitext(fasta_path)[0]
+
+#end _blastdb_path()
+
+
+def blastdb_stamp (fasta_path='MultifaDB.fasta'):
+    '''
+    Comprueba si la base de datos de BLAST de un multifasta está al día.
+
+    Output: huella del multifasta guardada junto a la base de datos si esta
+            existe y corresponde al multifasta actual, o None si no existe o
+            está obsoleta
+    '''
+    db_path = _blastdb_path(fasta_path)
+    #Las bases de datos grandes se parten en volúmenes con un alias .pal
+    if not os.path.isfile(fasta_path) or not (os.path.isfile(db_path+'.pin') \
+       or os.path.isfile(db_path+'.pal')):
+        return None
+    try:
+        with open(db_path+'.stamp', 'r') as handle:
+            stamp = json.load(handle)
+    except Exception:
+        return None
+    if file_stamp(fasta_path, stamp)['sha256'] != stamp.get('sha256'):
+        return None
+
+    return stamp
+
+#end blastdb_stamp()
+
+
+#Tipo de los registros del índice de un multifasta: hash del id, posición
+#(en bytes) del inicio de la entrada y longitud (en bytes) de la entrada. En
+#un multifasta BGZF la posición es el offset virtual de BGZF (bloque
+#comprimido y posición dentro del bloque) y la longitud es sin comprimir
+FASTA_INDEX_DTYPE = np.dtype([('hash', '<u8'), ('offset', '<u8'), \
+                              ('length', '<u8')])
+
+def _id_hash (record_id):
+    '''
+    Hash de 64 bits de un id del multifasta (para el índice)
+    '''
+    digest = hashlib.blake2b(record_id.encode(), digest_size=8).digest()
+
+    return int.from_bytes(digest, 'little')
+
+#end _id_hash()
+
+
+def _is_bgzf (path):
+    '''
+    Indica si un archivo está comprimido en BGZF (gzip por bloques con el
+    campo extra 'BC' en la cabecera de cada bloque)
+    '''
+    with open(path, 'rb') as handle:
+        head = handle.read(14)
+
+    return len(head) == 14 and head[:4] == b'\x1f\x8b\x08\x04' \
+           and head[12:14] == b'BC'
+
+#end _is_bgzf()
+
+
+def _bgzf_lines (handle):
+    '''
+    Generador con las líneas (bytes) de un archivo BGZF abierto con
+    bgzf.BgzfReader, cada una junto con el offset virtual de su inicio
+    '''
+    while True:
+        position = handle.tell()
+        line = handle.readline()
+        if not line:
+            return
+        yield position, line
+
+#end _bgzf_lines()
+
+
+def make_fasta_index (fasta_path='MultifaDB.fasta'):
+    '''
+    Crea el índice de acceso directo de un multifasta (parecido a un .fai):
+    un array de NumPy (fasta_path.idx.npy) con el hash del id, la posición y
+    la longitud en bytes de cada entrada, ordenado por hash. Junto al índice
+    se guarda la huella del multifasta (fasta_path.idx.json) para saber si
+    está al día.
+
+    Input:
+        - fasta_path: ruta del multifasta, sin comprimir o comprimido en BGZF
+                      (las posiciones son entonces offsets virtuales)
+
+    Output: el índice cargado (ver load_fasta_index)
+    '''
+    stamp = file_stamp(fasta_path)
+    entries = []
+    #Inicio (sin comprimir) de la última entrada, para su longitud
+    start = offset = 0
+    #Se recorre el archivo en binario para que las posiciones sean bytes
+    if _is_bgzf(fasta_path):
+        handle = bgzf.BgzfReader(fasta_path, 'rb')
+        lines = _bgzf_lines(handle)
+    elif compression(fasta_path) is not None:
+        raise Exception('El multifasta '+fasta_path+' está comprimido pero '\
+                        + 'no en BGZF, por lo que no se puede indexar')
+    else:
+        handle = open(fasta_path, 'rb')
+        lines = ((None, line) for line in handle)
+    with handle:
+        for position, line in lines:
+            if line.startswith(b'>'):
+                if entries:
+                    entries[-1][2] = offset - start
+                header = line[1:].split(None, 1)
+                record_id = header[0].decode() if header else ''
+                start = offset
+                entries.append([_id_hash(record_id), offset if position \
+                                is None else position, 0])
+            offset += len(line)
+    if entries:
+        entries[-1][2] = offset - start
+
+    index = np.array([tuple(entry) for entry in entries], \
+                     dtype=FASTA_INDEX_DTYPE)
+    index.sort(order=['hash', 'offset'])
+    #Los archivos se escriben a temporales propios de cada proceso e hilo y
+    #luego se renombran, la huella la última
+    suffix = '.'+str(os.getpid())+'.'+str(threading.get_ident())+'.tmp'
+    with open(fasta_path+'.idx.npy'+suffix, 'wb') as handle:
+        np.save(handle, index)
+    os.replace(fasta_path+'.idx.npy'+suffix, fasta_path+'.idx.npy')
+    with open(fasta_path+'.idx.json'+suffix, 'w') as handle:
+        json.dump(stamp, handle)
+    os.replace(fasta_path+'.idx.json'+suffix, fasta_path+'.idx.json')
+
+    return np.load(fasta_path+'.idx.npy', mmap_mode='r')
+
+#end make_fasta_index()
+
+
+def _multifa_stamp (fasta_path):
+    '''
+    Huella de un multifasta (ver file_stamp) reutilizando la guardada con su
+    índice (fasta_path.idx.json), de forma que si no ha cambiado no se
+    vuelve a leer entero para su checksum
+    '''
+    try:
+        with open(fasta_path+'.idx.json', 'r') as handle:
+            previous = json.load(handle)
+    except Exception:
+        previous = None
+
+    return file_stamp(fasta_path, previous)
+
+#end _multifa_stamp()
+
+
+def _current_fasta_index (fasta_path):
+    '''
+    Carga el índice de un multifasta si existe y está al día (si no lanza
+    una excepción)
+    '''
+    with open(fasta_path+'.idx.json', 'r') as handle:
+        stamp = json.load(handle)
+    if file_stamp(fasta_path, stamp)['sha256'] != stamp['sha256']:
+        raise ValueError('índice obsoleto')
+
+    return np.load(fasta_path+'.idx.npy', mmap_mode='r')
+
+#end _current_fasta_index()
+
+
+#Cerrojo para que dos hilos no creen a la vez el índice de un multifasta
+_fasta_index_lock = threading.Lock()
+
+def load_fasta_index (fasta_path='MultifaDB.fasta'):
+    '''
+    Carga (mapeado en memoria, sin leerlo entero) el índice de un multifasta.
+    Si no existe o el multifasta ha cambiado se crea de nuevo.
+
+    Output: array de NumPy con dtype FASTA_INDEX_DTYPE
+    '''
+    try:
+        return _current_fasta_index(fasta_path)
+    except Exception:
+        #Si varias querys lo necesitan a la vez solo una lo crea
+        with _fasta_index_lock:
+            try:
+                return _current_fasta_index(fasta_path)
+            except Exception:
+                return make_fasta_index(fasta_path)
+
+#end load_fasta_index()
+
+
+def fetch_fasta (fasta_path, ids, index=None):
+    '''
+    Obtiene del multifasta las entradas de una lista de ids sin recorrerlo
+    entero: los ids se buscan por hash en el índice y se lee directamente el
+    rango de bytes de cada entrada (a través de mmap, o en BGZF
+    descomprimiendo solo los bloques de la entrada).
+
+    Input:
+        - fasta_path: ruta del multifasta (sin comprimir o en BGZF)
+        - ids: ids buscados (los repetidos se ignoran)
+        - index: índice del multifasta (si es None se carga con
+                 load_fasta_index)
+
+    Output: lista de tuplas (id, secuencia) en el orden del multifasta. Si
+            un id aparece varias veces en el multifasta salen todas
+    '''
+    if index is None:
+        index = load_fasta_index(fasta_path)
+    wanted = set(ids)
+    if not wanted or len(index) == 0:
+        return []
+
+    #Se buscan todas las posiciones del índice con el hash de cada id
+    hashes = np.array(sorted(set(_id_hash(record_id) for record_id in wanted)),\
+                      dtype='<u8')
+    starts = np.searchsorted(index['hash'], hashes, side='left')
+    ends = np.searchsorted(index['hash'], hashes, side='right')
+    positions = np.concatenate([np.arange(start, end) \
+                                for start, end in zip(starts, ends)])
+    order = np.argsort(index['offset'][positions])
+    ranges = zip(index['offset'][positions][order].tolist(), \
+                 index['length'][positions][order].tolist())
+
+    records = []
+    for chunk in _read_ranges(fasta_path, ranges):
+        lines = chunk.decode().split('\n')
+        header = lines[0][1:].split(None, 1)
+        record_id = header[0] if header else ''
+        #Dos ids distintos pueden compartir hash: se comprueba el id
+        if record_id in wanted:
+            records.append((record_id, \
+                            ''.join(line.strip() for line in lines[1:])))
+
+    return records
+
+#end fetch_fasta()
+
+
+def _read_ranges (fasta_path, ranges):
+    '''
+    Generador con los bytes de cada rango (posición del índice, longitud) de
+    un multifasta sin comprimir (mapeado en memoria) o en BGZF (la posición
+    es un offset virtual y la longitud es sin comprimir)
+    '''
+    if _is_bgzf(fasta_path):
+        with bgzf.BgzfReader(fasta_path, 'rb') as handle:
+            for offset, length in ranges:
+                handle.seek(offset)
+                yield handle.read(length)
+        return
+
+    with open(fasta_path, 'rb') as handle:
+        with mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            for offset, length in ranges:
+                yield data[offset:offset+length]
+
+#end _read_ranges()
+
+
+def read_fasta (handle):
+    '''
+    Generador que lee un multifasta sin construir SeqRecords
+
+    Input:
+        - handle: archivo abierto en modo texto
+
+    Output: tuplas (id, secuencia) de cada entrada
+    '''
+    record_id = None
+    sequence = []
+    for line in handle:
+        if line.startswith('>'):
+            if record_id is not None:
+                yield record_id, ''.join(sequence)
+            record_id = line[1:].split(None, 1)[0] if line[1:].strip() else ''
+            sequence = []
+        elif record_id is not None:
+            sequence.append(line.strip())
+    if record_id is not None:
+        yield record_id, ''.join(sequence)
+
+#end read_fasta()
+
+
+#Cerrojo para que dos hilos no creen a la vez los mismos shards
+_shards_lock = threading.Lock()
+
+def make_blast_shards (fasta_path='MultifaDB.fasta', shards=2, blastdb=True):
+    '''
+    Reparte las proteínas de un multifasta en varios shards de tamaño
+    (nº de residuos) similar para buscar en ellos en paralelo.
+
+    Los shards se guardan en la carpeta de caché identificados por el
+    checksum del multifasta y el nº de shards, de forma que solo se crean la
+    primera vez. Si blastdb es True cada shard se formatea con make_blastdb.
+
+    Input:
+        - fasta_path: ruta del multifasta
+        - shards: número de shards
+        - blastdb: crear la base de datos de BLAST de cada shard
+
+    Output: tupla (rutas, residuos) con la ruta de cada shard (la base de
+            datos si blastdb es True o el multifasta si no) y el número total
+            de residuos del multifasta, que es el tamaño de base de datos que
+            se usa para que los evalues se aproximen a los de una búsqueda
+            sin shards (ver run_blastp)
+    '''
+    #La huella se obtiene fuera del cerrojo (con la guardada con el índice
+    #no hace falta leer el multifasta), y si varias querys se buscan a la
+    #vez solo una crea los shards
+    stamp = _multifa_stamp(fasta_path)
+    with _shards_lock:
+        shard_dir = cache_path('shards', stamp['sha256'][:16]+'_'+str(shards), \
+                               'info.json')
+        shard_dir = os.path.dirname(shard_dir)
+        try:
+            with open(shard_dir+'/info.json', 'r') as handle:
+                residues = json.load(handle)['residues']
+        except Exception:
+            #Cada proteína va al shard con menos residuos hasta el momento
+            sizes = [0] * shards
+            outputs = [open(shard_dir+'/shard_'+str(n)+'.fasta', 'w') \
+                       for n in range(shards)]
+            try:
+                with open_input(fasta_path) as handle:
+                    for record_id, sequence in read_fasta(handle):
+                        n = sizes.index(min(sizes))
+                        sizes[n] += len(sequence)
+                        outputs[n].write('>'+record_id+'\n'+sequence+'\n\n')
+            finally:
+                for output in outputs:
+                    output.close()
+            residues = sum(sizes)
+            with open(shard_dir+'/info.json', 'w') as handle:
+                json.dump({'residues': residues, 'sizes': sizes}, handle)
+
+            #Se borran los shards de versiones anteriores del multifasta
+            for old_dir in os.listdir(os.path.dirname(shard_dir)):
+                if old_dir != os.path.basename(shard_dir):
+                    shutil.rmtree(os.path.join(os.path.dirname(shard_dir), old_dir))
+
+        paths = [shard_dir+'/shard_'+str(n)+'.fasta' for n in range(shards)]
+        if blastdb:
+            paths = [make_blastdb(path) for path in paths]
+
+    return paths, residues
+
+#end make_blast_shards()
+
+
+def _run_blast_job (command):
+    '''
+    Ejecuta una llamada a blastp y devuelve las líneas de su output. Es la
+    unidad de trabajo que se reparte entre los workers en la búsqueda por
+    shards (solo recibe y devuelve datos simples, para poder enviarse a otro
+    proceso o nodo)
+    '''
+    with tool_slot(command[0]):
+        result = run(command, stdout=PIPE, universal_newlines=True)
+
+    return result.stdout.splitlines(True)
+
+#end _run_blast_job()
+
+
+def _stream_blast_job (command):
+    '''
+    Ejecuta una llamada a blastp y va devolviendo las líneas de su output a
+    medida que blastp las escribe, sin guardarlas en memoria ni en disco
+    '''
+    with tool_slot(command[0]):
+        process = Popen(command, stdout=PIPE, universal_newlines=True)
+        try:
+            for line in process.stdout:
+                yield line
+        finally:
+            #Si se deja de leer antes de tiempo se termina el proceso
+            process.stdout.close()
+            if process.poll() is None:
+                process.terminate()
+            process.wait()
+
+#end _stream_blast_job()
+
+
+def _merge_blast_shards (query_ids, outputs, max_targets=500):
+    '''
+    Junta las líneas de blastp de varios shards como si fueran de una sola
+    búsqueda: para cada query (en el orden de query_ids) los subjects se
+    ordenan por su mejor evalue (y bitscore) y se quedan los max_targets
+    primeros, igual que hace blastp con -max_target_seqs por defecto
+    '''
+    #Se agrupan las líneas por query y subject manteniendo las HSPs juntas
+    groups = {}
+    for n, lines in enumerate(outputs):
+        for position, line in enumerate(lines):
+            fields = line.rstrip('\n').split('\t')
+            query_groups = groups.setdefault(fields[0], {})
+            if fields[1] not in query_groups:
+                query_groups[fields[1]] = [float(fields[5]), \
+                                           -float(fields[6]), n, position, []]
+            group = query_groups[fields[1]]
+            group[0] = min(group[0], float(fields[5]))
+            group[1] = min(group[1], -float(fields[6]))
+            group[4].append(line)
+
+    merged = []
+    for query_id in query_ids:
+        query_groups = sorted(groups.get(query_id, {}).values())
+        for group in query_groups[:max_targets]:
+            merged.extend(group[4])
+
+    return merged
+
+#end _merge_blast_shards()
+
+
+def run_blastp (query_path, eval, db=None, threads=1, shards=1, \
+                executor=None, dbsize=None):
+    '''
+    Ejecuta blastp de un archivo de querys contra MultifaDB.
+
+    Con shards > 1 la base de datos se reparte en shards (make_blast_shards)
+    en los que se busca a la vez y los resultados se juntan como si fueran de
+    una sola búsqueda. Todos los shards usan como tamaño de base de datos
+    (-dbsize) el total de residuos, así que los evalues son comparables a los
+    de la búsqueda sin shards, pero no idénticos: el ajuste de longitud de
+    BLAST+ depende también del nº de secuencias de cada shard (que -dbsize
+    no cambia ni se puede fijar para todas las querys a la vez con
+    -searchsp). Los evalues pueden variar ligeramente y un hit con un evalue
+    muy cercano al límite puede aparecer en una búsqueda y no en la otra.
+
+    Input:
+        - query_path: ruta del archivo de querys
+        - eval: evalue usado en la llamada a blast
+        - db: base de datos formateada (output de make_blastdb) o None para
+              buscar en el multifasta con -subject
+        - threads: número total de hilos de blastp (solo se usa con db)
+        - shards: número de shards de la base de datos
+        - executor: objeto con un método map(función, iterable) con el que
+                    se reparten las búsquedas por shard (p.ej. un Executor de
+                    concurrent.futures, o uno que las mande a otros nodos).
+                    Si es None se lanzan a la vez en local
+        - dbsize: tamaño de base de datos (nº de residuos) con el que se
+                  calculan los evalues, si no es el de MultifaDB (p.ej. el
+                  de todas las proteínas cuando se han eliminado repetidas)
+
+    Output: iterable con las líneas del output tabular de blastp
+            (BLAST_OUTFMT). Sin shards las líneas se leen de blastp a medida
+            que las escribe
+    '''
+    options = ['-evalue', str(eval), '-outfmt', BLAST_OUTFMT]
+    if shards <= 1:
+        if dbsize:
+            options += ['-dbsize', str(dbsize)]
+        return _stream_blast_job(['blastp', '-query', query_path] \
+                              + _blast_target(db, threads) + options)
+
+    paths, residues = make_blast_shards(multifa_path(), shards, \
+                                        blastdb=db is not None)
+    jobs = []
+    for path in paths:
+        if db is not None:
+            target = ['-db', path, '-num_threads', \
+                      str(max(1, threads // shards))]
+        else:
+            target = ['-subject', path]
+        jobs.append(['blastp', '-query', query_path] + target + options \
+                    + ['-dbsize', str(dbsize or residues)])
+
+    #Las búsquedas son procesos externos, así que en local basta con hilos
+    #que lancen a la vez un blastp por shard
+    if executor is None:
+        with ThreadPoolExecutor(len(jobs)) as local_executor:
+            outputs = list(local_executor.map(_run_blast_job, jobs))
+    else:
+        outputs = list(executor.map(_run_blast_job, jobs))
+
+    with open(query_path, 'r') as handle:
+        query_ids = [record_id for record_id, _ in read_fasta(handle)]
+
+    return _merge_blast_shards(query_ids, outputs)
+
+#end run_blastp()
+
+
+def _blast_target (db, threads):
+    '''
+    Argumentos de blastp que indican dónde se busca: con base de datos
+    formateada se usa -db (que admite varios hilos) y si no se usa el
+    multifasta como -subject. blastp no lee multifastas comprimidos, así que
+    en ese caso se usa una copia sin comprimir (el shard único de
+    make_blast_shards)
+    '''
+    if db is not None:
+        return ['-db', db, '-num_threads', str(threads)]
+    fasta_path = multifa_path()
+    if compression(fasta_path) is not None:
+        fasta_path = make_blast_shards(fasta_path, 1, blastdb=False)[0][0]
+
+    return ['-subject', fasta_path]
+
+#end _blast_target()
+
+
+#Límites de la caché de resultados de blastp: tamaño total máximo (bytes) y
+#antigüedad máxima (segundos) desde el último uso de cada resultado
+BLAST_CACHE_MAX_BYTES = 2 * 1024**3
+BLAST_CACHE_MAX_AGE = 30 * 24 * 3600
+
+def _blast_cache_key (query_path, db=None, dbsize=None, \
+                      fasta_path='MultifaDB.fasta'):
+    '''
+    Clave de la caché de resultados de blastp: hash de las secuencias query
+    (con sus ids, que aparecen en el resultado), checksum del multifasta en
+    el que se busca y forma de buscar (-db o -subject y -dbsize). El evalue
+    no forma parte de la clave (ver cached_blastp)
+    '''
+    digest = hashlib.sha256()
+    with open(query_path, 'r') as handle:
+        for record_id, sequence in read_fasta(handle):
+            digest.update(('>'+record_id+'\n'+sequence+'\n').encode())
+
+    #La huella del multifasta guardada con su índice evita volver a leerlo
+    checksum = _multifa_stamp(fasta_path)['sha256']
+
+    key = [digest.hexdigest(), checksum, 'db' if db else 'subject', dbsize]
+    return hashlib.sha256(json.dumps(key).encode()).hexdigest()
+
+#end _blast_cache_key()
+
+
+def _evict_blast_cache (max_bytes=None, max_age=None):
+    '''
+    Borra de la caché de blastp los resultados que llevan más de max_age
+    segundos sin usarse y, si aun así ocupan más de max_bytes, los usados
+    hace más tiempo (por defecto BLAST_CACHE_MAX_BYTES y BLAST_CACHE_MAX_AGE)
+    '''
+    max_bytes = BLAST_CACHE_MAX_BYTES if max_bytes is None else max_bytes
+    max_age = BLAST_CACHE_MAX_AGE if max_age is None else max_age
+    cache_dir = os.path.dirname(cache_path('blast', 'results'))
+    entries = []
+    for file in os.listdir(cache_dir):
+        if file.endswith('.tsv'):
+            try:
+                stat = os.stat(cache_dir+'/'+file)
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, cache_dir+'/'+file))
+
+    #Se recorren del más reciente al más antiguo
+    now = time.time()
+    total = 0
+    for mtime, size, path in sorted(entries, reverse=True):
+        total += size
+        if now - mtime > max_age or total > max_bytes:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    return None
+
+#end _evict_blast_cache()
+
+
+def cached_blastp (query_path, eval, db=None, threads=1, shards=1, \
+                   executor=None, dbsize=None):
+    '''
+    Igual que run_blastp pero guardando el resultado sin filtrar en la
+    caché (.identipy_cache/blast). Si ya hay un resultado de las mismas
+    querys contra el mismo MultifaDB hecho con un evalue igual o mayor, no
+    se ejecuta blastp: se leen de la caché las líneas con evalue <= eval.
+    Así cambiar cov, iden o bajar el evalue no repite la búsqueda.
+
+    Input y output: igual que en run_blastp
+    '''
+    path = cache_path('blast', _blast_cache_key(query_path, db, dbsize, \
+                                                multifa_path())+'.tsv')
+    #La primera línea del resultado guardado es el evalue con el que se hizo.
+    #El archivo se abre una sola vez para que, aunque la limpieza de otra
+    #query lo borre mientras tanto, se pueda seguir leyendo
+    cached = None
+    cached_eval = None
+    try:
+        cached = open(path, 'r')
+        cached_eval = float(cached.readline().split('\t')[1])
+    except (OSError, ValueError, IndexError):
+        pass
+    if cached_eval is not None and eval <= cached_eval:
+        with cached:
+            #Se actualiza la fecha para que la limpieza cuente este uso
+            try:
+                os.utime(path)
+            except OSError:
+                pass
+            imetrics.count('blast_cache_hits')
+            for line in cached:
+                if float(line.split('\t')[5]) <= eval:
+                    yield line
+        return
+    if cached is not None:
+        cached.close()
+
+    #Si no hay resultado aprovechable se busca y las líneas se guardan a la
+    #vez que se devuelven. El archivo solo se incorpora a la caché si se ha
+    #leído el resultado entero
+    imetrics.count('blast_cache_misses')
+    handle, temporal = tempfile.mkstemp(dir=os.path.dirname(path), \
+                                        suffix='.tmp')
+    complete = False
+    try:
+        with os.fdopen(handle, 'w') as output:
+            output.write('#evalue\t'+str(eval)+'\n')
+            for line in run_blastp(query_path, eval, db, threads, shards, \
+                                   executor, dbsize):
+                output.write(line)
+                yield line
+        complete = True
+    finally:
+        if complete:
+            os.replace(temporal, path)
+            _evict_blast_cache()
+        else:
+            os.remove(temporal)
+
+#end cached_blastp()
+
+
+#Longitud de los k-mers del prefiltro de blastp y alfabeto con el que se
+#codifican (5 bits por residuo; el resto de letras comparten el código 20).
+#Con 4 residuos dos proteínas sin relación apenas comparten k-mers, mientras
+#que dos con un 50% de identidad comparten de media uno de cada 16
+KMER_SIZE = 4
+KMER_ALPHABET = 'ACDEFGHIKLMNPQRSTVWY'
+
+def _kmer_codes (sequence, k=KMER_SIZE):
+    '''
+    Códigos empaquetados (5 bits por residuo, uint32) de todos los k-mers de
+    una secuencia, en orden
+    '''
+    table = np.full(256, 20, dtype=np.uint32)
+    for n, letter in enumerate(KMER_ALPHABET):
+        table[ord(letter)] = n
+    residues = table[np.frombuffer(sequence.upper().encode(), dtype=np.uint8)]
+    if len(residues) < k:
+        return np.zeros(0, dtype=np.uint32)
+    codes = np.zeros(len(residues) - k + 1, dtype=np.uint32)
+    for n in range(k):
+        codes = (codes << 5) | residues[n:len(residues) - k + 1 + n]
+
+    return codes
+
+#end _kmer_codes()
+
+
+#Cerrojo para que dos hilos no creen a la vez el mismo índice de k-mers
+_kmer_lock = threading.Lock()
+
+def make_kmer_index (fasta_path='MultifaDB.fasta', k=KMER_SIZE):
+    '''
+    Crea (o carga si ya existe para este multifasta) el índice de k-mers del
+    prefiltro de blastp: un array con los códigos empaquetados (uint32) de
+    todos los k-mers de todas las proteínas seguidos, y la posición en ese
+    array donde empiezan los de cada proteína. Se guarda en la carpeta de
+    caché identificado por el checksum del multifasta y se lee mapeado en
+    memoria.
+
+    Input:
+        - fasta_path: ruta del multifasta
+        - k: longitud de los k-mers
+
+    Output: tupla (ids, codes, offsets, residues) con la lista de ids, el
+            array de códigos, el array de posiciones (nº de proteínas + 1) y
+            el nº total de residuos del multifasta
+    '''
+    checksum = _multifa_stamp(fasta_path)['sha256']
+    kmer_dir = os.path.dirname(cache_path('kmer', 'info.json'))
+    index_dir = kmer_dir+'/'+checksum[:16]+'_k'+str(k)
+
+    #Si varias querys usan el prefiltro a la vez solo una crea el índice. Se
+    #crea en una carpeta temporal que se renombra al terminar (con info.json
+    #escrito el último), de forma que nunca se lee ni se sobrescribe un
+    #índice a medias, ni siquiera desde otro proceso
+    with _kmer_lock:
+        if not os.path.isfile(index_dir+'/info.json'):
+            temporal = tempfile.mkdtemp(dir=kmer_dir, suffix='.tmp')
+            try:
+                _write_kmer_index(fasta_path, k, temporal)
+                #Un índice sin info.json está incompleto y se sustituye
+                if os.path.isdir(index_dir):
+                    shutil.rmtree(index_dir)
+                os.replace(temporal, index_dir)
+            except BaseException:
+                shutil.rmtree(temporal, ignore_errors=True)
+                #Otro proceso puede haberlo terminado antes
+                if not os.path.isfile(index_dir+'/info.json'):
+                    raise
+
+            #Se borran los índices de versiones anteriores del multifasta
+            #(no las carpetas temporales, que pueden ser de otro proceso)
+            for old_dir in os.listdir(kmer_dir):
+                if old_dir != os.path.basename(index_dir) \
+                   and not old_dir.endswith('.tmp'):
+                    shutil.rmtree(os.path.join(kmer_dir, old_dir), \
+                                  ignore_errors=True)
+
+    with open(index_dir+'/ids.txt', 'r') as handle:
+        ids = handle.read().split('\n')[:-1]
+    with open(index_dir+'/info.json', 'r') as handle:
+        residues = json.load(handle)['residues']
+
+    return ids, np.load(index_dir+'/codes.npy', mmap_mode='r'), \
+           np.load(index_dir+'/offsets.npy'), residues
+
+#end make_kmer_index()
+
+
+def _write_kmer_index (fasta_path, k, index_dir):
+    '''
+    Escribe en index_dir los archivos del índice de k-mers de un multifasta
+    (ver make_kmer_index). info.json se escribe el último
+    '''
+    #Primera pasada: ids y nº de k-mers de cada proteína
+    ids = []
+    lengths = []
+    with open_input(fasta_path) as handle:
+        for record_id, sequence in read_fasta(handle):
+            ids.append(record_id)
+            lengths.append(len(sequence))
+    counts = np.maximum(np.array(lengths, dtype=np.int64) - k + 1, 0)
+    offsets = np.zeros(len(ids) + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+
+    #Segunda pasada: se escriben los códigos directamente al archivo
+    codes = np.lib.format.open_memmap(index_dir+'/codes.npy', mode='w+', \
+                                      dtype=np.uint32, \
+                                      shape=(int(offsets[-1]),))
+    with open_input(fasta_path) as handle:
+        for n, (record_id, sequence) in enumerate(read_fasta(handle)):
+            codes[offsets[n]:offsets[n+1]] = _kmer_codes(sequence, k)
+    codes.flush()
+    del codes
+    np.save(index_dir+'/offsets.npy', offsets)
+    with open(index_dir+'/ids.txt', 'w') as handle:
+        handle.write('\n'.join(ids)+'\n')
+    with open(index_dir+'/info.json', 'w') as handle:
+        json.dump({'residues': int(sum(lengths))}, handle)
+
+    return None
+
+#end _write_kmer_index()
+
+
+def prefilter_candidates (query_path, cov_t, iden_t, index=None, \
+                          min_seeds=2, chunk_size=1<<26):
+    '''
+    Prefiltro de blastp: busca las proteínas de MultifaDB que comparten
+    suficientes k-mers (semillas) con alguna query para poder llegar a los
+    thresholds de coverage e identity.
+
+    Un alineamiento que cubre A = cov*L residuos de una query de longitud L
+    con identidad iden tiene como mucho (1-iden)*A diferencias, y cada
+    diferencia rompe como mucho k k-mers, así que comparte al menos
+    A-k+1 - k*(1-iden)*A k-mers. Con identidades bajas ese mínimo no filtra
+    nada, así que se exigen al menos min_seeds semillas (como las dos
+    semillas de blastp). Por eso no es un filtro exacto: su recall frente a
+    la búsqueda entera se mide con prefilter_recall.
+
+    Input:
+        - query_path: ruta del archivo de querys
+        - cov_t, iden_t: thresholds de coverage e identity (%)
+        - index: índice de k-mers (output de make_kmer_index) o None para
+                 crearlo/cargarlo
+        - min_seeds: mínimo de k-mers compartidos
+        - chunk_size: nº de k-mers que se comparan a la vez (memoria)
+
+    Output: tupla (candidates, residues) con la lista de ids candidatos (en
+            el orden de MultifaDB) y el nº de residuos de todo MultifaDB
+    '''
+    ids, codes, offsets, residues = index or make_kmer_index(multifa_path())
+    k = KMER_SIZE
+    selected = np.zeros(len(ids), dtype=bool)
+    with open(query_path, 'r') as handle:
+        queries = [sequence for _, sequence in read_fasta(handle)]
+
+    for sequence in queries:
+        covered = cov_t / 100 * len(sequence)
+        bound = covered - k + 1 - k * (1 - iden_t / 100) * covered
+        minimum = max(min_seeds, math.ceil(bound))
+        #Tabla de los códigos de la query para contar las semillas de cada
+        #proteína con una sola indexación
+        table = np.zeros(1 << (5 * k), dtype=np.uint8)
+        table[_kmer_codes(sequence, k)] = 1
+
+        #Las proteínas se recorren por bloques de chunk_size k-mers
+        first = 0
+        while first < len(ids):
+            last = int(np.searchsorted(offsets, offsets[first] + chunk_size, \
+                                       side='right')) - 1
+            last = min(max(last, first + 1), len(ids))
+            start, end = offsets[first], offsets[last]
+            hits = table[codes[start:end]].astype(np.int32)
+            #Nº de semillas de cada proteína del bloque (reduceat no admite
+            #bloques vacíos, así que se usa la suma acumulada)
+            total = np.concatenate(([0], np.cumsum(hits)))
+            seeds = total[offsets[first+1:last+1] - start] \
+                    - total[offsets[first:last] - start]
+            selected[first:last] |= seeds >= minimum
+            first = last
+    imetrics.count('prefilter_proteins_tested', len(ids))
+    imetrics.count('prefilter_candidates', int(selected.sum()))
+
+    return [ids[n] for n in np.flatnonzero(selected)], residues
+
+#end prefilter_candidates()
+
+
+def run_blastp_subset (query_path, eval, candidates, db=None, threads=1, \
+                       dbsize=None):
+    '''
+    Ejecuta blastp solo contra un subconjunto de MultifaDB (los candidatos
+    del prefiltro). Con base de datos formateada se limita con -seqidlist y
+    sin ella se busca en un multifasta temporal con los candidatos (que se
+    leen con el índice de MultifaDB). El tamaño de base de datos (-dbsize)
+    es el de todo MultifaDB, así que los evalues son los de la búsqueda
+    entera.
+
+    Input:
+        - query_path: ruta del archivo de querys
+        - eval: evalue usado en la llamada a blast
+        - candidates: lista de ids de MultifaDB en los que se busca
+        - db, threads: igual que en run_blastp
+        - dbsize: nº de residuos de todo MultifaDB
+
+    Output: lista de líneas del output tabular de blastp (BLAST_OUTFMT)
+    '''
+    if not candidates:
+        return []
+    options = ['-evalue', str(eval), '-outfmt', BLAST_OUTFMT, \
+               '-dbsize', str(dbsize)]
+    with tempfile.TemporaryDirectory() as tmp:
+        if db is not None:
+            with open(tmp+'/candidates.txt', 'w') as handle:
+                handle.write('\n'.join(candidates)+'\n')
+            target = ['-db', db, '-num_threads', str(threads), \
+                      '-seqidlist', tmp+'/candidates.txt']
+        else:
+            with open(tmp+'/candidates.fasta', 'w') as handle:
+                for record_id, sequence in fetch_fasta(multifa_path(), \
+                                                       candidates):
+                    handle.write('>'+record_id+'\n'+sequence+'\n\n')
+            target = ['-subject', tmp+'/candidates.fasta']
+        return _run_blast_job(['blastp', '-query', query_path] + target \
+                              + options)
+
+#end run_blastp_subset()
+
+
+def prefilter_recall (query_path, eval, cov_t, iden_t, db=None, threads=1):
+    '''
+    Mide el recall del prefiltro de k-mers: hace la búsqueda entera y la
+    búsqueda con prefiltro y compara las proteínas que pasan los thresholds
+
+    Output: dict con el recall (hits encontrados con prefiltro / hits de la
+            búsqueda entera), el nº de hits de cada búsqueda, el nº de
+            candidatos y el nº de proteínas de MultifaDB
+    '''
+    def passing (lines):
+        found = set()
+        for line in lines:
+            fields = line.split('\t')
+            if float(fields[2]) >= cov_t and float(fields[3]) >= iden_t:
+                found.add((fields[0], fields[1]))
+        return found
+
+    index = make_kmer_index(multifa_path())
+    full = passing(run_blastp(query_path, eval, db, threads))
+    candidates, residues = prefilter_candidates(query_path, cov_t, iden_t, \
+                                                index)
+    filtered = passing(run_blastp_subset(query_path, eval, candidates, db, \
+                                         threads, residues))
+
+    return {'recall': len(full & filtered) / len(full) if full else 1.0, \
+            'full_hits': len(full), 'prefilter_hits': len(filtered), \
+            'candidates': len(candidates), 'proteins': len(index[0])}
+
+#end prefilter_recall()
+
+
+#Tabla de hits de blastp en formato columnar:
+#   - queries, subjects: ids distintos de query y de subject (cada uno se
+#     guarda una vez)
+#   - hits: array estructurado (HIT_DTYPE) con una fila por hit: índice de su
+#     query en queries y de su subject en subjects, coverage, identidad,
+#     evalue y bitscore. Están en el orden del output de blastp
+HIT_DTYPE = np.dtype([('query', '<i4'), ('subject', '<i4'), ('cov', '<f8'), \
+                      ('iden', '<f8'), ('evalue', '<f8'), ('bitscore', '<f4')])
+HitTable = namedtuple('HitTable', ['queries', 'subjects', 'hits'])
+
+def _write_blast_result (result_path, lines, cov_t, iden_t, members=None, \
+                         save_table=False):
+    '''
+    Crea el archivo final de resultado de blast en la carpeta de la query a
+    la vez que se leen las líneas de blast (sin header), de manera que se
+    recorren una sola vez. Las líneas de blast carecen de header porque
+    facilita el tratamiento, y aquí se le añade. De cada línea solo se
+    escriben los 5 primeros campos.
+
+    Los valores de cada hit se guardan en una tabla columnar (HitTable), de
+    forma que los thresholds se aplican sobre arrays (ver filter_hits).
+
+    Input:
+        - result_path: ruta de la carpeta de resultados de la query
+        - lines: iterable con las líneas de blast
+        - cov_t: threshold de coverage aplicado al blast
+        - iden_t: threshold de identity aplicado al blast
+        - members: tabla de miembros de MultifaDB (ver load_members). Si se
+                   da, cada hit con un representante se repite para todos
+                   los miembros con su misma secuencia
+        - save_table: si es True la tabla de hits se guarda también en
+                      Blast_result.npz (ver load_hit_table)
+
+    Output: tupla (hits, table) con la lista de nombres de las proteínas que
+            pasan los thresholds y la tabla de todos los hits leídos
+            (HitTable)
+    '''
+    #Los ids se guardan como índices en un dict (cada uno una sola vez) y
+    #los valores numéricos como texto, que se convierte a la vez al final
+    queries = {}
+    subjects = {}
+    query, subject, cov, iden, evalue, bitscore = [], [], [], [], [], []
+    with open(result_path+'/Blast_result', 'w') as blast_final:
+        blast_final.write('Query\tSubject\t% Coverage\t% Identity\t Sequence\n')
+        for line in lines:
+            #Se separan las líneas por tabulación y se recogen los campos
+            #De nombres de genes, cov e id
+            fields = line.rstrip('\n').split('\t')
+            name = fields[1]
+            #Con -parse_seqids los ids locales pueden aparecer como lcl|id
+            if name.startswith('lcl|'):
+                name = name[4:]
+            if members and name in members:
+                names = members[name]
+            else:
+                blast_final.write('\t'.join(fields[:5])+'\n')
+                names = [name]
+            number = queries.setdefault(fields[0], len(queries))
+            for name in names:
+                if len(names) > 1:
+                    blast_final.write('\t'.join([fields[0], name] \
+                                                + fields[2:5])+'\n')
+                query.append(number)
+                subject.append(subjects.setdefault(name, len(subjects)))
+                cov.append(fields[2])
+                iden.append(fields[3])
+                evalue.append(fields[5])
+                bitscore.append(fields[6])
+
+    table = HitTable(np.array(list(queries), dtype=str), \
+                     np.array(list(subjects), dtype=str), \
+                     np.empty(len(query), dtype=HIT_DTYPE))
+    for field, values in zip(HIT_DTYPE.names, [query, subject, cov, iden, \
+                                               evalue, bitscore]):
+        table.hits[field] = np.array(values, dtype=HIT_DTYPE[field])
+    if save_table:
+        save_hit_table(table, result_path+'/Blast_result.npz')
+
+    #Las proteínas que pasan los filtros de cov e iden son la lista de hits
+    #con la que se filtra luego
+    passed = filter_hits(table, cov_t, iden_t)
+    hits = table.subjects[table.hits['subject'][passed]].tolist()
+    imetrics.count('blast_hits_kept', len(hits))
+    imetrics.count('blast_hits_dropped', len(table.hits) - len(hits))
+
+    return hits, table
+
+#end _write_blast_result()
+
+
+def filter_hits (table, cov_t=0, iden_t=0, eval=None):
+    '''
+    Aplica los thresholds a todos los hits de una tabla a la vez
+
+    Input:
+        - table: tabla de hits (HitTable)
+        - cov_t, iden_t: mínimo de coverage e identidad (%)
+        - eval: máximo de evalue (None para no filtrar por evalue)
+
+    Output: array de bool con True en los hits que pasan los thresholds
+
+    Use:
+        passed = filter_hits(table, 70, 50)
+        names = table.subjects[table.hits['subject'][passed]]
+    '''
+    hits = table.hits
+    passed = (hits['cov'] >= cov_t) & (hits['iden'] >= iden_t)
+    if eval is not None:
+        passed &= hits['evalue'] <= eval
+
+    return passed
+
+#end filter_hits()
+
+
+def save_hit_table (table, table_path):
+    '''
+    Guarda una tabla de hits (HitTable) en un único archivo .npz (se escribe
+    a un temporal que luego se renombra). Los ids se guardan en UTF-8, que
+    ocupa la cuarta parte que en memoria
+    '''
+    temporal = table_path+'.'+str(os.getpid())+'.' \
+               +str(threading.get_ident())+'.tmp'
+    with open(temporal, 'wb') as handle:
+        np.savez(handle, hits=table.hits, \
+                 **{field: np.array([name.encode() for name in \
+                                     getattr(table, field).tolist()], \
+                                    dtype=bytes) \
+                    for field in ['queries', 'subjects']})
+    os.replace(temporal, table_path)
+
+    return None
+
+#end save_hit_table()
+
+
+def load_hit_table (table_path):
+    '''
+    Carga una tabla de hits guardada con save_hit_table
+
+    Output: HitTable
+    '''
+    with np.load(table_path) as arrays:
+        return HitTable(np.char.decode(arrays['queries'], 'utf-8'), \
+                        np.char.decode(arrays['subjects'], 'utf-8'), \
+                        arrays['hits'])
+
+#end load_hit_table()
+
+
+def organism_summary (table, passed=None, \
+                      organism_path='ID_Organism_table.csv', output_path=None):
+    '''
+    Resumen de los hits de una tabla por organismo: nº de proteínas distintas
+    y de hits, mejor identidad y coverage medio. El organismo de cada subject
+    es el de su @id en la tabla ID-organismo.
+
+    Input:
+        - table: tabla de hits (HitTable)
+        - passed: array de bool con los hits que se cuentan (p.ej. output de
+                  filter_hits) o None para contarlos todos
+        - organism_path: tabla ID-organismo de make_multifa
+        - output_path: si se da, el resumen se guarda también en este
+                       archivo (tsv con header)
+
+    Output: array estructurado con los campos organism, proteins, hits,
+            best_iden y mean_cov, con una fila por organismo con algún hit
+            y ordenado de más a menos proteínas
+    '''
+    organisms = {}
+    with open(organism_path, 'r') as handle:
+        for line in handle:
+            record_id, _, organism = line.rstrip('\n').partition('\t')
+            organisms[record_id] = organism
+
+    #Solo se busca el organismo de los subjects con algún hit (los que no
+    #están en la tabla ID-organismo se agrupan con su propio @id)
+    hits = table.hits if passed is None else table.hits[passed]
+    subjects, subject = np.unique(hits['subject'], return_inverse=True)
+    names = []
+    for name in table.subjects[subjects].tolist():
+        record_id = name.rpartition('@')[2]
+        names.append(organisms.get(record_id, record_id))
+    names, subject_organism = np.unique(np.array(names, dtype=str), \
+                                        return_inverse=True)
+    subject_organism = subject_organism.reshape(-1)
+    organism = subject_organism[subject.reshape(-1)]
+
+    count = np.bincount(organism, minlength=len(names))
+    best = np.zeros(len(names))
+    np.maximum.at(best, organism, hits['iden'])
+    summary = np.empty(len(names), dtype=[('organism', names.dtype), \
+                                          ('proteins', '<i8'), \
+                                          ('hits', '<i8'), \
+                                          ('best_iden', '<f8'), \
+                                          ('mean_cov', '<f8')])
+    summary['organism'] = names
+    summary['proteins'] = np.bincount(subject_organism, minlength=len(names))
+    summary['hits'] = count
+    summary['best_iden'] = best
+    summary['mean_cov'] = np.bincount(organism, weights=hits['cov'], \
+                                      minlength=len(names)) / count
+    summary = summary[np.argsort(-summary['proteins'], kind='stable')]
+
+    if output_path is not None:
+        with open(output_path, 'w') as handle:
+            handle.write('Organism\tProteins\tHits\tBest % Identity\t'\
+                         + 'Mean % Coverage\n')
+            for row in summary.tolist():
+                handle.write('%s\t%d\t%d\t%.3f\t%.1f\n' % row)
+
+    return summary
+
+#end organism_summary()
+
+
+@imetrics.stage('blastp_hits')
+def blastp_hits (query_path, result_path, eval, cov_t, iden_t, db=None, \
+                 threads=1, shards=1, executor=None, return_rows=False, \
+                 members=None, dbsize=None, cache=True, prefilter=False, \
+                 save_table=False, index=None):
     '''
     Obtiene la lista de proteinas de un multifasta que han sido filtradas
     al hacer un blasteo frente a una query.
@@ -79,52 +1728,135 @@ def blastp_hits (query_path, result_path, eval, cov_t, iden_t):
         - eval: evalue usado en la llamada a blast
         - cov_t: threshold de coverage aplicado al blast
         - iden_t: threshold de identity aplicado al blast
+        - db: ruta de la base de datos de BLAST formateada (output de
+              make_blastdb). Si es None se busca directamente en el
+              multifasta con blastp -subject
+        - threads: número de hilos de blastp (solo se usa con db)
+        - shards, executor: búsqueda repartida en shards (ver run_blastp)
+        - return_rows: si es True también se devuelve la tabla de todos los
+                       hits leídos (HitTable, para blast_plot y
+                       organism_summary)
+        - members, dbsize: tabla de miembros y nº de residuos de todas las
+                           proteínas cuando MultifaDB no tiene repetidas
+                           (ver load_members). Los hits se devuelven ya
+                           repetidos para todos los miembros
+        - cache: si es True se reutilizan los resultados de blastp guardados
+                 en la caché (ver cached_blastp)
+        - prefilter: si es True solo se busca en las proteínas que pasan el
+                     prefiltro de k-mers (ver prefilter_candidates). Esta
+                     búsqueda no usa shards ni la caché
+        - save_table: si es True la tabla de hits se guarda en
+                      Blast_result.npz junto a Blast_result
+        - index: índice de k-mers del prefiltro (output de make_kmer_index)
+                 o None para crearlo/cargarlo. Si se analizan varias querys
+                 a la vez conviene cargarlo antes una sola vez
 
-    Output: lista que contiene los nombres de las proteinas filtradas
-    '''
-    #Se abre el archivo donde guardar el resultado de blast
-    #Y se realiza la llamada que se dirige a ese archivo
-    with open('blast_temporal','w') as blast_file:
-        call(['blastp','-query',query_path,'-subject', 'MultifaDB.fasta', \
-              '-evalue', str(eval), '-outfmt', '6 qseqid sseqid qcovs \
-              pident sseq'], stdout=blast_file)
-
-    #Posteriormente se vuelve a abrir el archivo pero como lectura,
-    #Se separan las líneas por tabulación y se recogen los campos
-    #De nombres de genes, cov e id
-    with open('blast_temporal','r') as blast_file:
-        hits = []
-        lines = blast_file.readlines()
-        for line in lines:
-            name = line.split('\t')[1]
-            cov = float(line.split('\t')[2])
-            iden = float(line.split('\t')[3])
-            #Si pasan los filtros de cov e iden se guardan en la lista de hits
-            #con la que se filtra luego
-            if cov >= cov_t and iden >= iden_t:
-                hits.append(name)
-
-    #Finalmente se crea el archivo final de resultado en la carpeta
-    #correspondiente. El archivo temporal carece de header porque
-    #facilita el tratamiento, y ahora se le añade
-    with open(result_path+'/Blast_result', 'w') as blast_final:
-        call(['echo', 'Query\tSubject\t% Coverage\t% Identity\t Sequence'], \
-              stdout=blast_final)
-        call(['cat', 'blast_temporal'], stdout=blast_final)
+    Output: lista que contiene los nombres de las proteinas filtradas, o
+            tupla (hits, table) con return_rows (ver _write_blast_result)
+    '''
+    #Se realiza la llamada a blast y a medida que se lee su output se
+    #obtienen los hits y se crea el archivo final de resultado en la
+    #carpeta correspondiente
+    if prefilter:
+        candidates, residues = prefilter_candidates(query_path, cov_t, iden_t, \
+                                                    index)
+        lines = run_blastp_subset(query_path, eval, candidates, db, threads, \
+                                  dbsize or residues)
+    else:
+        search = cached_blastp if cache else run_blastp
+        lines = search(query_path, eval, db, threads, shards, executor, \
+                       dbsize)
+    hits, table = _write_blast_result(result_path, lines, cov_t, iden_t, \
+                                      members, save_table)
 
+    if return_rows:
+        return hits, table
     return hits
 
 #end blastp_hits()
 
 
-def filter_database (result_path, query_path, hits):
+@imetrics.stage('blastp_batch')
+def blastp_batch (queries, eval, cov_t, iden_t, db=None, threads=1, \
+                  shards=1, executor=None, return_rows=False, members=None, \
+                  dbsize=None, cache=True, prefilter=False, save_table=False, \
+                  index=None):
+    '''
+    Versión por lotes de blastp_hits(): todas las querys se buscan en una
+    sola llamada a blastp (que así carga la base de datos una sola vez) y
+    el resultado se separa por query (campo qseqid).
+
+    Cada query se renombra en el lote con su posición para que dos querys
+    con el mismo id no se confundan, y en el Blast_result de cada una se
+    escribe su id original. Los thresholds se aplican igual que en
+    blastp_hits() a cada query por separado.
+
+    Input:
+        - queries: lista de tuplas (query_path, result_path), con una única
+                   secuencia por archivo query
+        - eval, cov_t, iden_t, db, threads, shards, executor, return_rows,
+          members, dbsize, cache, prefilter, save_table, index: igual que
+          en blastp_hits() (con prefiltro se busca en los candidatos de
+          todas las querys)
+
+    Output: dict result_path :: lista de nombres de proteínas filtradas (o
+            tupla (hits, table) con return_rows)
+    '''
+    ids = []
+    lines = [[] for _ in queries]
+    #El archivo con el lote de querys va a una carpeta temporal propia
+    with tempfile.TemporaryDirectory() as tmp:
+        with open(tmp+'/querys.fasta', 'w') as batch:
+            for n, (query_path, result_path) in enumerate(queries):
+                record = SeqIO.read(query_path, 'fasta')
+                ids.append(record.id)
+                batch.write('>query_'+str(n)+'\n'+str(record.seq)+'\n')
+
+        if prefilter:
+            candidates, residues = prefilter_candidates(tmp+'/querys.fasta', \
+                                                        cov_t, iden_t, index)
+            output = run_blastp_subset(tmp+'/querys.fasta', eval, \
+                                       candidates, db, threads, \
+                                       dbsize or residues)
+        else:
+            search = cached_blastp if cache else run_blastp
+            output = search(tmp+'/querys.fasta', eval, db, threads, shards, \
+                            executor, dbsize)
+        #Cada línea se asigna a su query según el número del qseqid y se
+        #le devuelve el id original
+        for line in output:
+            qseqid, rest = line.split('\t', 1)
+            n = int(qseqid.split('_')[-1])
+            lines[n].append(ids[n]+'\t'+rest)
+
+    hits = {}
+    for (query_path, result_path), query_lines in zip(queries, lines):
+        query_hits, table = _write_blast_result(result_path, query_lines, \
+                                                cov_t, iden_t, members, \
+                                                save_table)
+        hits[result_path] = (query_hits, table) if return_rows \
+                            else query_hits
+
+    return hits
+
+#end blastp_batch()
+
+
+@imetrics.stage('filter_database')
+def filter_database (result_path, query_path, hits, members=None):
     '''
     Crea el archivo multifasta con las secuencias filtradas por blastp
 
+    Las secuencias de los hits se obtienen con el índice de MultifaDB
+    (fetch_fasta), leyendo solo sus entradas en vez de recorrer todo el
+    multifasta.
+
     Input:
         - result_path: ruta de la carpeta donde se guarda el archivo output
         - query_path: ruta de la query usada para el filtrado
         - hits: lista de nombres de proteinas filtradas
+        - members: tabla de miembros de MultifaDB (ver load_members). Las
+                   secuencias de los miembros se leen de su representante
 
     Output: genera el archivo MultifaFiltered. El return se silencia a 'None'
     '''
@@ -135,55 +1867,77 @@ def filter_database (result_path, query_path, hits):
                 output.write(">"+record.id+"\n")
                 output.write(str(record.seq)+"\n\n")
 
-        #Posteriormente se abre y parsea el multifasta
-        with open('MultifaDB.fasta','r') as handle:
-            for record in SeqIO.parse(handle, 'fasta'):
-                #Si el nombre de la secuencia es un hit -> output
-                if str(record.id) in hits:
-                    output.write(">"+record.id+"\n")
-                    output.write(str(record.seq)+"\n\n")
+        #Posteriormente se añaden las secuencias de los hits (en el orden
+        #en el que están en el multifasta). Sin repetidas en MultifaDB cada
+        #miembro se busca por su representante
+        representatives = {}
+        for representative, names in (members or {}).items():
+            for name in names:
+                representatives[name] = representative
+        wanted = set(hits)
+        written = 0
+        for record_id, sequence in fetch_fasta(multifa_path(), \
+                [representatives.get(name, name) for name in wanted]):
+            for name in (members or {}).get(record_id, [record_id]):
+                if name in wanted:
+                    output.write(">"+name+"\n")
+                    output.write(sequence+"\n\n")
+                    written += 1
+    imetrics.count('filtered_sequences_written', written)
     return None
 
 #end filter_database()
 
 
-def blast_plot (blast_result):
+@imetrics.stage('blast_plot')
+def blast_plot (blast_result, output_path=None):
     '''
     Dibuja un gráfico resumen del resultado de blast en forma de scatterplot 2D
     con los valores de identidad y coverage obtenidos
-    '''
-    #Se inicializan variables cov e iden donde se guardan los valores
-    cov = []
-    iden = []
 
-    #Se abre el archivo de blast y se sacan del 3er y 4to campo (ver blast call)
-    #los valores de cov e iden y se van añadiendo a la lista
-    with open(blast_result,'r') as blast_file:
-        lines = blast_file.readlines()
-        for line in lines:
-            str_cov = line.split('\t')[2]
-            str_iden = line.split('\t')[3]
-            cov.append(float(str_cov))
-            iden.append(float(str_iden))
+    Input:
+        - blast_result: tabla de hits (HitTable de blastp_hits) o ruta de
+                        la tabla guardada (Blast_result.npz) o del resultado
+                        de blast (con o sin header)
+        - output_path: si se da, el gráfico se guarda en este archivo (.png,
+                       .svg...) en vez de mostrarse en una ventana
+    '''
+    #Si los hits ya están en una tabla se usan directamente sus columnas
+    if isinstance(blast_result, HitTable):
+        cov = blast_result.hits['cov']
+        iden = blast_result.hits['iden']
+    elif blast_result.endswith('.npz'):
+        table = load_hit_table(blast_result)
+        cov = table.hits['cov']
+        iden = table.hits['iden']
 
-    #Finalmente la lista se convierte en array para el plotting
-    cov = np.array(cov)
-    iden = np.array(iden)
+    #Si no, se leen del archivo de blast el 3er y 4to campo (ver blast call),
+    #que son los valores de cov e iden. Si el archivo tiene header
+    #(Blast_result) se salta
+    else:
+        with open(blast_result,'r') as blast_file:
+            header = int(blast_file.readline().startswith('Query\tSubject'))
+        columns = np.loadtxt(blast_result, delimiter='\t', usecols=(2, 3), \
+                             skiprows=header, comments=None, ndmin=2)
+        cov = columns[:, 0]
+        iden = columns[:, 1]
 
     #Códigos del plot
     #################
     #Scatter plot con tamaño grande y transparencia
     #para que al acumularse varios puntos haya más color
-    plt.scatter(cov,iden,s=200, alpha=1/len(cov))
-    plt.xlabel('Cobertura de alineamiento (%)')
-    plt.ylabel('Identidad de alineamiento (%)')
-    plt.title('Distribución de cobertura e identidad de los alineamientos')
+    figure = new_figure(output_path)
+    ax = figure.add_subplot()
+    ax.scatter(cov,iden,s=200, alpha=1/len(cov))
+    ax.set_xlabel('Cobertura de alineamiento (%)')
+    ax.set_ylabel('Identidad de alineamiento (%)')
+    ax.set_title('Distribución de cobertura e identidad de los alineamientos')
     props = dict(boxstyle='round', facecolor='wheat', alpha=0.5)
     #Se dibuja una caja con texto que indica el nº de hits
-    plt.text(5,90,'Nº of hits: '+str(len(cov)), bbox=props)
-    plt.xlim(0,100)
-    plt.ylim(0,100)
-    plt.show()
+    ax.text(5,90,'Nº of hits: '+str(len(cov)), bbox=props)
+    ax.set_xlim(0,100)
+    ax.set_ylim(0,100)
+    finish_figure(figure, output_path)
 
     return None
 
@@ -0,0 +1,334 @@
+import os
+import sys
+import json
+import time
+import threading
+import contextvars
+from contextlib import contextmanager
+
+#Versión del formato del archivo de métricas
+METRICS_VERSION = 1
+
+#Registro de métricas de la ejecución. None mientras no se activan con
+#enable(), de forma que sin métricas stage() y count() no hacen nada
+_run = None
+_lock = threading.Lock()
+#Etapa y query que se están ejecutando en el hilo (o la corrutina) actual
+_current_stage = contextvars.ContextVar('identipy_stage', default=None)
+_current_query = contextvars.ContextVar('identipy_query', default=None)
+
+def memory ():
+    '''
+    Memoria residente actual y pico de memoria residente del proceso (MB).
+    En Linux se leen VmRSS y VmHWM de /proc; en otros sistemas solo se
+    obtiene el pico (ru_maxrss) y la memoria actual es None
+
+    Output: tupla (rss, peak)
+    '''
+    rss = peak = None
+    try:
+        with open('/proc/self/status') as handle:
+            for line in handle:
+                if line.startswith('VmRSS:'):
+                    rss = int(line.split()[1]) / 1024
+                elif line.startswith('VmHWM:'):
+                    peak = int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    if peak is None:
+        try:
+            import resource
+        except ImportError:
+            return rss, peak
+        #ru_maxrss está en KB en Linux y en bytes en macOS
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss \
+               / (1024 * 1024 if sys.platform == 'darwin' else 1024)
+
+    return rss, peak
+
+#end memory()
+
+
+def _children_cpu ():
+    '''
+    Tiempo de CPU (s) de los procesos hijos ya terminados (workers, blastp,
+    muscle...), o None si el sistema no lo permite
+    '''
+    try:
+        import resource
+    except ImportError:
+        return None
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+
+    return usage.ru_utime + usage.ru_stime
+
+#end _children_cpu()
+
+
+def enable (profile_stage=None, profile_path=None):
+    '''
+    Activa (o reinicia) el registro de métricas de la ejecución: tiempo real,
+    de CPU y memoria de cada etapa y de cada query, contadores y duración de
+    los procesos externos. Se guardan con write()
+
+    Input:
+        - profile_stage: nombre de la etapa (ver stage) que se perfila con
+                         cProfile, acumulando todas sus ejecuciones
+        - profile_path: archivo en el que write() guarda el perfil (formato
+                        de pstats)
+    '''
+    global _run
+    profiler = None
+    if profile_stage is not None:
+        import cProfile
+        profiler = cProfile.Profile()
+    _run = {'started': time.strftime('%Y-%m-%dT%H:%M:%S'), \
+            'wall': time.perf_counter(), 'cpu': time.process_time(), \
+            'children_cpu': _children_cpu(), 'counters': {}, 'queries': {}, \
+            'stages': [], 'tools': [], 'profile_stage': profile_stage, \
+            'profile_path': profile_path, 'profiler': profiler, \
+            'profiling': False, 'profiled': 0}
+
+    return None
+
+#end enable()
+
+
+def enabled ():
+    '''
+    Indica si el registro de métricas está activo
+    '''
+    return _run is not None
+
+#end enabled()
+
+
+def count (name, n=1):
+    '''
+    Suma n al contador name del total de la ejecución, de la etapa que se
+    está ejecutando y de su query. Sin métricas activas no hace nada
+
+    Use:
+        count('hits_kept', len(hits))
+    '''
+    run = _run
+    if run is None or not n:
+        return None
+    stage_record = _current_stage.get()
+    query_name = _current_query.get()
+    with _lock:
+        counters = run['counters']
+        counters[name] = counters.get(name, 0) + n
+        if stage_record is not None:
+            counters = stage_record['counters']
+            counters[name] = counters.get(name, 0) + n
+        if query_name is not None:
+            counters = run['queries'].setdefault(query_name, \
+                                                 {'counters': {}})['counters']
+            counters[name] = counters.get(name, 0) + n
+
+    return None
+
+#end count()
+
+
+def _start_profile (run, name):
+    '''
+    Activa cProfile si name es la etapa perfilada y no hay ya otra ejecución
+    suya perfilándose (p.ej. en otro hilo con jobs > 1)
+
+    Output: True si se ha activado
+    '''
+    if name != run['profile_stage']:
+        return False
+    with _lock:
+        if run['profiling']:
+            return False
+        run['profiling'] = True
+    run['profiler'].enable()
+
+    return True
+
+#end _start_profile()
+
+
+@contextmanager
+def stage (name):
+    '''
+    Mide una etapa del análisis mientras dura el bloque with (o la llamada a
+    la función decorada): tiempo real, tiempo de CPU del hilo, memoria al
+    empezar y al terminar, pico de memoria del proceso al terminar y los
+    contadores sumados con count() durante la etapa. Sin métricas activas no
+    hace nada.
+
+    El tiempo de CPU es el del hilo que ejecuta la etapa: el de los procesos
+    worker y externos se ve en el total de la ejecución (children_cpu_s) y
+    en la duración de cada proceso externo (ver tool_call)
+
+    Use:
+        @stage('make_multifa')
+        def make_multifa (...):
+
+        with stage('plots'):
+            ...
+    '''
+    run = _run
+    if run is None:
+        yield
+        return
+    rss, _ = memory()
+    record = {'stage': name, 'query': _current_query.get(), \
+              'parent': (_current_stage.get() or {}).get('stage'), \
+              'thread': threading.current_thread().name, \
+              'start_s': time.perf_counter() - run['wall'], \
+              'rss_start_mb': rss, 'status': 'ok', 'counters': {}}
+    token = _current_stage.set(record)
+    profiling = _start_profile(run, name)
+    wall = time.perf_counter()
+    cpu = time.thread_time()
+    try:
+        yield
+    except BaseException as exception:
+        record['status'] = 'error: '+type(exception).__name__
+        raise
+    finally:
+        record['wall_s'] = time.perf_counter() - wall
+        record['cpu_s'] = time.thread_time() - cpu
+        if profiling:
+            run['profiler'].disable()
+            with _lock:
+                run['profiling'] = False
+                run['profiled'] += 1
+        record['rss_mb'], record['peak_rss_mb'] = memory()
+        _current_stage.reset(token)
+        with _lock:
+            run['stages'].append(record)
+
+#end stage()
+
+
+@contextmanager
+def query (name):
+    '''
+    Mide el análisis de una query como la etapa 'query' y hace que las
+    etapas, contadores y procesos externos de dentro del bloque with se
+    asignen a esa query. Sin métricas activas no hace nada
+    '''
+    run = _run
+    if run is None:
+        yield
+        return
+    token = _current_query.set(name)
+    try:
+        with stage('query'):
+            yield
+    finally:
+        _current_query.reset(token)
+        #El resumen de la query es su etapa 'query' (la última que termina)
+        with _lock:
+            summary = run['queries'].setdefault(name, {'counters': {}})
+            for record in reversed(run['stages']):
+                if record['stage'] == 'query' and record['query'] == name:
+                    summary.update({key: record[key] for key in \
+                                    ['wall_s', 'cpu_s', 'rss_mb', \
+                                     'peak_rss_mb', 'status']})
+                    break
+
+#end query()
+
+
+def tool_call (tool, wait, wall):
+    '''
+    Registra la ejecución de un proceso externo (ver iutils.tool_slot) con
+    la etapa y la query en la que se ha hecho. Sin métricas activas no hace
+    nada
+
+    Input:
+        - tool: nombre del programa (blastp, muscle...)
+        - wait: segundos esperando un hueco libre para procesos externos
+        - wall: segundos de ejecución
+    '''
+    run = _run
+    if run is None or tool is None:
+        return None
+    record = {'tool': tool, 'stage': (_current_stage.get() or {}).get('stage'), \
+              'query': _current_query.get(), 'wait_s': wait, 'wall_s': wall}
+    with _lock:
+        run['tools'].append(record)
+
+    return None
+
+#end tool_call()
+
+
+def report ():
+    '''
+    Resumen de las métricas registradas hasta el momento
+
+    Output: dict con el formato del archivo de métricas (ver write), o None
+            sin métricas activas
+    '''
+    run = _run
+    if run is None:
+        return None
+    rss, peak = memory()
+    children = _children_cpu()
+    with _lock:
+        tools = [dict(record) for record in run['tools']]
+        totals = {}
+        for record in tools:
+            total = totals.setdefault(record['tool'], {'calls': 0, \
+                                                       'wall_s': 0.0, \
+                                                       'wait_s': 0.0})
+            total['calls'] += 1
+            total['wall_s'] += record['wall_s']
+            total['wait_s'] += record['wait_s']
+        data = {'version': METRICS_VERSION, 'argv': sys.argv, \
+                'pid': os.getpid(), 'started': run['started'], \
+                'wall_s': time.perf_counter() - run['wall'], \
+                'cpu_s': time.process_time() - run['cpu'], \
+                'children_cpu_s': None if children is None \
+                                  else children - run['children_cpu'], \
+                'rss_mb': rss, 'peak_rss_mb': peak, \
+                'counters': dict(run['counters']), \
+                'queries': json.loads(json.dumps(run['queries'])), \
+                'stages': [dict(record, counters=dict(record['counters'])) \
+                           for record in run['stages']], \
+                'tools': tools, 'tool_totals': totals}
+    if run['profile_stage'] is not None:
+        data['profile'] = {'stage': run['profile_stage'], \
+                           'path': run['profile_path'], \
+                           'runs': run['profiled']}
+
+    return data
+
+#end report()
+
+
+def write (path):
+    '''
+    Escribe las métricas de la ejecución en un archivo JSON y, si se ha
+    perfilado alguna etapa, el perfil de cProfile en profile_path (ver
+    enable). Los archivos se escriben de forma atómica
+
+    Input:
+        - path: ruta del archivo JSON de métricas
+
+    Output: dict escrito (ver report), o None sin métricas activas
+    '''
+    data = report()
+    if data is None:
+        return None
+    suffix = '.'+str(os.getpid())+'.'+str(threading.get_ident())+'.tmp'
+    with open(path+suffix, 'w') as handle:
+        json.dump(data, handle, indent=1)
+    os.replace(path+suffix, path)
+
+    run = _run
+    if run['profiled'] and run['profile_path'] is not None:
+        run['profiler'].dump_stats(run['profile_path']+suffix)
+        os.replace(run['profile_path']+suffix, run['profile_path'])
+
+    return data
+
+#end write()
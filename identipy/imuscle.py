@@ -1,22 +1,178 @@
 import os
+import math
+import asyncio
+from collections import Counter
 from subprocess import call
-from Bio import Phylo
+import numpy as np
+from Bio import SeqIO
+from Bio.Align import PairwiseAligner
+from .iutils import tool_slot, async_tool_slot, new_figure, finish_figure
+from . import imetrics
 
-def build_muscle (result_path):
+#Alineador global usado para calcular identidades en cluster_sequences
+_aligner = PairwiseAligner()
+_aligner.mode = 'global'
+_aligner.match_score = 1
+_aligner.mismatch_score = 0
+_aligner.open_gap_score = -2
+_aligner.extend_gap_score = -0.5
+
+def word_length (identity):
+    '''
+    Longitud de palabra (k-mer) del prefiltro de cluster_sequences según el
+    umbral de identidad, igual que en CD-HIT: cuanto menor es la identidad
+    más cortas tienen que ser las palabras para que el filtro no descarte
+    pares que sí la cumplen
+    '''
+    if identity >= 0.7:
+        return 5
+    if identity >= 0.6:
+        return 4
+    if identity >= 0.5:
+        return 3
+
+    return 2
+
+#end word_length()
+
+
+def _sequence_identity (a, b):
+    '''
+    Identidad de dos secuencias: nº de posiciones idénticas del alineamiento
+    global (PairwiseAligner) entre la longitud de la más corta
+    '''
+    alignment = _aligner.align(a, b)[0]
+
+    return alignment.counts().identities / min(len(a), len(b))
+
+#end _sequence_identity()
+
+
+def cluster_sequences (records, identity=0.9, k=None):
+    '''
+    Agrupa las secuencias por identidad de forma voraz (como CD-HIT): las
+    secuencias se recorren de mayor a menor longitud y cada una se une al
+    primer representante con el que tiene al menos la identidad pedida, o
+    pasa a ser un representante nuevo. La primera secuencia de records (la
+    query en MultifaFiltered) siempre es representante.
+
+    Para no alinear con todos los representantes se usa un prefiltro de
+    k-mers: dos secuencias con identidad >= identity sobre una longitud L
+    comparten al menos L-k+1 - k*ceil((1-identity)*L) k-mers, así que solo se
+    alinean (Bio.Align.PairwiseAligner) los representantes que llegan a ese
+    mínimo, empezando por los que comparten más. Los k-mers se cuentan con
+    sus repeticiones (cada k-mer cuenta tantas veces como aparezca en la
+    secuencia en la que aparece menos), porque en secuencias repetitivas o
+    de baja complejidad contar solo los k-mers distintos se queda por
+    debajo del mínimo y descartaría pares que sí tienen la identidad. Si el
+    mínimo es <= 0 (identidades bajas o secuencias más cortas que k) el
+    prefiltro no descarta nada y se alinea también con los representantes
+    que no comparten ningún k-mer.
+
+    Input:
+        - records: lista de tuplas (id, secuencia)
+        - identity: identidad mínima (0-1) para unirse a un grupo
+        - k: longitud de los k-mers (por defecto según word_length)
+
+    Output: lista de tuplas (representante, lista de ids del grupo con el
+            representante el primero) en el orden de records
+    '''
+    k = k or word_length(identity)
+    order = list(range(len(records)))
+    order = order[:1] + sorted(order[1:], key=lambda n: -len(records[n][1]))
+
+    members = {}
+    index = {}     #k-mer :: lista de (representante, nº de apariciones)
+    for n in order:
+        record_id, sequence = records[n]
+        kmers = Counter(sequence[i:i+k] for i in range(len(sequence) - k + 1))
+        shared = {}
+        for kmer, count in kmers.items():
+            for representative, times in index.get(kmer, ()):
+                shared[representative] = shared.get(representative, 0) \
+                                         + min(count, times)
+
+        #Después de los que comparten k-mers van el resto de representantes,
+        #que solo se alinean si el mínimo de k-mers es <= 0
+        candidates = sorted(shared, key=lambda r: -shared[r]) \
+                     + [r for r in members if r not in shared]
+        cluster = None
+        for representative in candidates:
+            length = min(len(sequence), len(records[representative][1]))
+            minimum = length - k + 1 - k * math.ceil((1 - identity) * length)
+            if shared.get(representative, 0) < minimum:
+                continue
+            if _sequence_identity(sequence, \
+                                  records[representative][1]) >= identity:
+                cluster = representative
+                break
+
+        if cluster is None:
+            members[n] = [record_id]
+            for kmer, count in kmers.items():
+                index.setdefault(kmer, []).append((n, count))
+        else:
+            members[cluster].append(record_id)
+
+    return [(records[n][0], members[n]) for n in sorted(members)]
+
+#end cluster_sequences()
+
+
+def cluster_filtered (result_path, identity):
+    '''
+    Agrupa las secuencias de MultifaFiltered.fasta (ver cluster_sequences) y
+    escribe los representantes en MultifaClustered.fasta (el input de muscle)
+    y la tabla de grupos en MuscleClusters.tsv (representante y todos los
+    miembros separados por comas)
+
+    Input:
+        - result_path: carpeta de resultados de la query
+        - identity: identidad mínima (0-1) para unirse a un grupo
+
+    Output: ruta de MultifaClustered.fasta
+    '''
+    with open(result_path+'/MultifaFiltered.fasta', 'r') as handle:
+        records = [(record.id, str(record.seq)) \
+                   for record in SeqIO.parse(handle, 'fasta')]
+    clusters = cluster_sequences(records, identity)
+    sequences = dict(records)
+
+    with open(result_path+'/MultifaClustered.fasta', 'w') as output:
+        for representative, names in clusters:
+            output.write('>'+representative+'\n'+sequences[representative] \
+                         +'\n\n')
+    with open(result_path+'/MuscleClusters.tsv', 'w') as table:
+        for representative, names in clusters:
+            table.write(representative+'\t'+','.join(names)+'\n')
+
+    return result_path+'/MultifaClustered.fasta'
+
+#end cluster_filtered()
+
+
+@imetrics.stage('build_muscle')
+def build_muscle (result_path, identity=None):
     '''
     Crea el árbol filogenético de un grupo de proteinas filtradas
 
     Input:
         - result_path: ruta donde está el archivo input y
           donde dejar el resultado
+        - identity: si se da (0-1) las secuencias se agrupan antes por
+                    identidad y solo se alinean los representantes (ver
+                    cluster_filtered)
 
     Output: genera el archivo newick del árbol filogenético.
             El return se silencia a 'None'.
     '''
+    input_path = result_path+'/MultifaFiltered.fasta'
+    if identity:
+        input_path = cluster_filtered(result_path, identity)
     #Se abre devnull para silenciar el mensaje de stderr que genera muscle
     #(que no es un error en realidad)
-    with open(os.devnull,'w') as devnull:
-        call(['muscle', '-in',result_path+'/MultifaFiltered.fasta', '-out', \
+    with open(os.devnull,'w') as devnull, tool_slot('muscle'):
+        call(['muscle', '-in', input_path, '-out', \
               result_path+'/MuscleAlign'], stderr=devnull)
 
     return None
@@ -24,18 +180,314 @@ def build_muscle (result_path):
 #end build_muscle()
 
 
-def plot_muscle (result_path):
+def read_alignment (align_path):
     '''
-    Dibuja el árbol filogenético de un archivo .nw
+    Lee un alineamiento en formato fasta (MuscleAlign) como array de NumPy
+
+    Input:
+        - align_path: ruta del alineamiento
+
+    Output: tupla (names, alignment) con la lista de ids y un array uint8 de
+            forma (nº de secuencias, longitud del alineamiento) con el código
+            ASCII (en mayúsculas) de cada posición
+    '''
+    names = []
+    rows = []
+    for record in SeqIO.parse(align_path, 'fasta'):
+        names.append(record.id)
+        rows.append(str(record.seq).upper().encode())
+    length = max((len(row) for row in rows), default=0)
+    #Si alguna fila es más corta se completa con gaps
+    alignment = np.frombuffer(b''.join(row.ljust(length, b'-') \
+                                       for row in rows), dtype=np.uint8)
+
+    return names, alignment.reshape(len(rows), length)
+
+#end read_alignment()
+
+
+def distance_matrix (alignment, kimura=True):
     '''
-    #De nuevo se abre devnull para silenciar muscle
-    with open(os.devnull, 'w') as devnull:
-        call(['muscle', '-maketree', '-in', result_path+'/MuscleAlign', '-out',\
-              result_path+'/MuscleTree.nw'], stderr=devnull)
-              
-        #El Árbol se parsea y se gráfica con el Phylo de Biopython
-        tree = Phylo.read(result_path+'/MuscleTree.nw', 'newick')
-        Phylo.draw(tree)
+    Calcula la matriz de distancias entre todas las secuencias de un
+    alineamiento. La proporción de diferencias p de cada par se calcula solo
+    con las posiciones en las que ninguna de las dos tiene gap.
+
+    Los pares idénticos se cuentan letra a letra con productos de matrices
+    (uno por letra) sobre el alineamiento codificado, sin bucles de Python
+    sobre los pares.
+
+    Input:
+        - alignment: array uint8 (ver read_alignment)
+        - kimura: aplicar la corrección de Kimura para proteínas
+                  d = -ln(1 - p - 0.2p²), con p limitado a 0.85. Si es False
+                  se devuelve p
+
+    Output: array float64 simétrico (nº de secuencias x nº de secuencias)
+    '''
+    gaps = np.isin(alignment, np.frombuffer(b'-.', dtype=np.uint8))
+    valid = (~gaps).astype(np.float32)
+    compared = valid @ valid.T
+    identical = np.zeros_like(compared)
+    for letter in np.unique(alignment[~gaps]):
+        column = (alignment == letter).astype(np.float32)
+        identical += column @ column.T
+
+    #Los pares sin posiciones comparables se consideran a la máxima distancia
+    p = np.ones(compared.shape)
+    np.divide(compared - identical, compared, out=p, where=compared > 0)
+    np.fill_diagonal(p, 0)
+    if not kimura:
+        return p
+
+    p = np.minimum(p, 0.85)
+    return -np.log(1 - p - 0.2 * p**2)
+
+#end distance_matrix()
+
+
+def _newick_name (name):
+    '''
+    Pone entre comillas los nombres con caracteres especiales de newick
+    '''
+    if any(char in name for char in " ()[]':;,"):
+        return "'"+name.replace("'", "''")+"'"
+
+    return name
+
+#end _newick_name()
+
+
+def upgma (distances, names):
+    '''
+    Construye un árbol UPGMA (el método de muscle -maketree por defecto)
+
+    En cada paso se unen los dos grupos más cercanos. Para no buscar el
+    mínimo en toda la matriz en cada paso se guarda el vecino más cercano de
+    cada fila y solo se recalculan las filas afectadas por la unión.
+
+    Input:
+        - distances: matriz de distancias (ver distance_matrix)
+        - names: ids de las secuencias
+
+    Output: string con el árbol en formato newick
+    '''
+    n = len(names)
+    nodes = [_newick_name(name) for name in names]
+    if n == 1:
+        return '('+nodes[0]+');'
+    d = np.array(distances, dtype=np.float64)
+    np.fill_diagonal(d, np.inf)
+    size = np.ones(n)
+    height = np.zeros(n)
+    active = np.ones(n, dtype=bool)
+    nearest = d.argmin(axis=1)
+    nearest_d = d[np.arange(n), nearest]
+
+    for _ in range(n - 1):
+        i = int(nearest_d.argmin())
+        j = int(nearest[i])
+        h = d[i, j] / 2
+        nodes[i] = '('+nodes[i]+':%.5f,' % max(0, h - height[i]) \
+                   + nodes[j]+':%.5f)' % max(0, h - height[j])
+        #La distancia del nuevo grupo es la media ponderada por tamaño
+        merged = (d[i] * size[i] + d[j] * size[j]) / (size[i] + size[j])
+        merged[i] = np.inf
+        d[i, :] = merged
+        d[:, i] = merged
+        d[j, :] = np.inf
+        d[:, j] = np.inf
+        size[i] += size[j]
+        height[i] = h
+        active[j] = False
+        nearest_d[j] = np.inf
+
+        #Las filas cuyo vecino era i o j se recalculan y el resto solo
+        #comprueban si el nuevo grupo está más cerca
+        stale = np.flatnonzero(active & ((nearest == i) | (nearest == j) \
+                                         | (np.arange(n) == i)))
+        nearest[stale] = d[stale].argmin(axis=1)
+        nearest_d[stale] = d[stale, nearest[stale]]
+        closer = d[:, i] < nearest_d
+        nearest[closer] = i
+        nearest_d[closer] = d[closer, i]
+
+    return nodes[int(np.flatnonzero(active)[0])]+';'
+
+#end upgma()
+
+
+def neighbor_joining (distances, names):
+    '''
+    Construye un árbol por neighbor-joining. Cada paso calcula la matriz Q
+    de los grupos que quedan de forma vectorizada. La matriz se mantiene
+    compacta: el grupo que desaparece se sustituye por el último, así que
+    cada paso trabaja solo con los grupos que quedan
+
+    Input:
+        - distances: matriz de distancias (ver distance_matrix)
+        - names: ids de las secuencias
+
+    Output: string con el árbol en formato newick
+    '''
+    nodes = [_newick_name(name) for name in names]
+    if len(nodes) == 1:
+        return '('+nodes[0]+');'
+    d = np.array(distances, dtype=np.float64)
+    r = d.sum(axis=1)
+    q = np.empty_like(d)
+    m = len(nodes)
+
+    while m > 2:
+        sub = d[:m, :m]
+        work = q[:m, :m]
+        np.multiply(sub, m - 2, out=work)
+        work -= r[:m, None]
+        work -= r[None, :m]
+        np.fill_diagonal(work, np.inf)
+        i, j = np.unravel_index(work.argmin(), work.shape)
+        i, j = min(i, j), max(i, j)
+        length_i = sub[i, j] / 2 + (r[i] - r[j]) / (2 * (m - 2))
+        length_j = sub[i, j] - length_i
+        nodes[i] = '('+nodes[i]+':%.5f,' % max(0, length_i) \
+                   + nodes[j]+':%.5f)' % max(0, length_j)
+        #El nuevo nodo ocupa la fila de i y la fila de j pasa a ocuparla el
+        #último grupo
+        merged = (sub[i] + sub[j] - sub[i, j]) / 2
+        merged[i] = 0
+        r[:m] += merged - sub[:, i] - sub[:, j]
+        r[i] = merged.sum() - merged[j]
+        sub[i, :] = merged
+        sub[:, i] = merged
+        last = m - 1
+        if j != last:
+            sub[j, :] = sub[last, :]
+            sub[:, j] = sub[:, last]
+            sub[j, j] = 0
+            r[j] = r[last]
+            nodes[j] = nodes[last]
+        m -= 1
+
+    return '('+nodes[0]+':%.5f,' % (d[0, 1] / 2) \
+           + nodes[1]+':%.5f);' % (d[0, 1] / 2)
+
+#end neighbor_joining()
+
+
+@imetrics.stage('make_tree')
+def make_tree (result_path, method='upgma'):
+    '''
+    Crea el árbol filogenético (MuscleTree.nw) a partir del alineamiento
+    (MuscleAlign) sin llamar otra vez a muscle: calcula la matriz de
+    distancias con NumPy y construye el árbol por UPGMA o neighbor-joining
+
+    Input:
+        - result_path: ruta donde está el alineamiento y donde dejar el árbol
+        - method: 'upgma', 'nj' o 'muscle' (muscle -maketree, el método
+                  anterior)
+
+    Output: genera el archivo newick. El return se silencia a 'None'
+    '''
+    tree_path = result_path+'/MuscleTree.nw'
+    if method == 'muscle':
+        #De nuevo se abre devnull para silenciar muscle
+        with open(os.devnull, 'w') as devnull, tool_slot('muscle'):
+            call(['muscle', '-maketree', '-in', result_path+'/MuscleAlign', \
+                  '-out', tree_path], stderr=devnull)
+        return None
+    if method not in ('upgma', 'nj'):
+        raise Exception('Método de árbol desconocido: '+str(method))
+
+    names, alignment = read_alignment(result_path+'/MuscleAlign')
+    distances = distance_matrix(alignment)
+    if method == 'upgma':
+        newick = upgma(distances, names)
+    else:
+        newick = neighbor_joining(distances, names)
+    with open(tree_path+'.tmp', 'w') as handle:
+        handle.write(newick+'\n')
+    os.replace(tree_path+'.tmp', tree_path)
+
+    return None
+
+#end make_tree()
+
+
+async def _muscle_async (args):
+    '''
+    Ejecuta muscle como subproceso de asyncio (silenciando su stderr) y
+    espera a que termine sin bloquear el bucle de eventos
+    '''
+    async with async_tool_slot('muscle'):
+        process = await asyncio.create_subprocess_exec('muscle', *args, \
+                                    stderr=asyncio.subprocess.DEVNULL)
+        await process.wait()
+
+    return None
+
+#end _muscle_async()
+
+
+async def build_muscle_async (result_path, tree='upgma', identity=None):
+    '''
+    Versión asíncrona de build_muscle: crea el alineamiento de muscle y, si
+    tree es True, también el árbol filogenético (MuscleTree.nw), de manera
+    que mientras muscle trabaja se pueden ejecutar otras etapas del análisis
+    (p.ej. la búsqueda de dominios)
+
+    Input:
+        - result_path: ruta donde está el archivo input y
+          donde dejar el resultado
+        - tree: método con el que se crea también el árbol (ver make_tree),
+                así plot_muscle no lo tiene que crear. Si es None no se crea
+        - identity: agrupar antes las secuencias (ver build_muscle)
+
+    Use:
+        asyncio.run(build_muscle_async('Result_query'))
+    '''
+    #Las funciones síncronas se ejecutan en hilos con asyncio.to_thread, que
+    #mantiene la etapa y la query de las métricas
+    with imetrics.stage('build_muscle'):
+        input_path = result_path+'/MultifaFiltered.fasta'
+        if identity:
+            input_path = await asyncio.to_thread(cluster_filtered, \
+                                                 result_path, identity)
+        await _muscle_async(['-in', input_path, '-out', \
+                             result_path+'/MuscleAlign'])
+    if tree == 'muscle':
+        with imetrics.stage('make_tree'):
+            await _muscle_async(['-maketree', '-in', result_path \
+                                 +'/MuscleAlign', '-out', result_path \
+                                 +'/MuscleTree.nw'])
+    #El árbol calculado con NumPy se hace en un hilo para no bloquear el
+    #bucle de eventos
+    elif tree:
+        await asyncio.to_thread(make_tree, result_path, tree)
+
+    return None
+
+#end build_muscle_async()
+
+
+@imetrics.stage('plot_muscle')
+def plot_muscle (result_path, method='upgma', output_path=None):
+    '''
+    Dibuja el árbol filogenético de un archivo .nw. Si el árbol no se ha
+    creado antes (build_muscle_async) o es más antiguo que el alineamiento,
+    se crea con make_tree (con el método method). Con output_path el gráfico
+    se guarda en ese archivo (.png, .svg...) en vez de mostrarse
+    '''
+    tree_path = result_path+'/MuscleTree.nw'
+    if not os.path.isfile(tree_path) or os.path.getmtime(tree_path) \
+       < os.path.getmtime(result_path+'/MuscleAlign'):
+        make_tree(result_path, method)
+
+    #El Árbol se parsea y se gráfica con el Phylo de Biopython (que solo se
+    #importa para dibujarlo)
+    from Bio import Phylo
+    tree = Phylo.read(tree_path, 'newick')
+    figure = new_figure(output_path)
+    Phylo.draw(tree, axes=figure.add_subplot(), do_show=False)
+    finish_figure(figure, output_path)
     return None
 
 #end plot_muscle()
@@ -1,9 +1,21 @@
 import os
 import re
-import matplotlib.pyplot as plt
-import matplotlib.patches as mpatch
+import functools
+import json
+import pickle
+import sqlite3
+import hashlib
+import threading
+from collections import namedtuple
+import numpy as np
 from Bio import SeqIO
-from Bio.ExPASy import Prosite
+from .iutils import file_stamp, cache_path, worker_context, new_figure, \
+                    finish_figure
+from . import imetrics
+
+#Versión del formato del índice de patrones guardado en disco. Si se cambia
+#la estructura del índice se aumenta para que los índices viejos se rehagan
+PROSITE_INDEX_VERSION = 1
 
 def adapt_pattern (pattern):
     '''
@@ -24,80 +36,637 @@ def adapt_pattern (pattern):
 #end adapt_pattern()
 
 
-def make_domain (result_path):
+def prosite_checksum (prosite_path='prosite.dat'):
+    '''
+    Checksum de prosite.dat. Su huella (ver file_stamp) se guarda junto al
+    índice de patrones (prosite.idx.json), de forma que mientras no cambien
+    el tamaño ni la fecha de modificación no se vuelve a leer el archivo
+    '''
+    stamp_path = cache_path('prosite.idx.json')
+    path = os.path.abspath(prosite_path)
+    try:
+        with open(stamp_path, 'r') as handle:
+            previous = json.load(handle)
+        if previous.get('path') != path:
+            previous = None
+    except Exception:
+        previous = None
+    stamp = file_stamp(prosite_path, previous)
+    if stamp != previous:
+        stamp['path'] = path
+        temporal = stamp_path+'.'+str(os.getpid())+'.' \
+                   +str(threading.get_ident())
+        with open(temporal, 'w') as handle:
+            json.dump(stamp, handle)
+        os.replace(temporal, stamp_path)
+
+    return stamp['sha256']
+
+#end prosite_checksum()
+
+
+#Cerrojo para que dos hilos no parseen a la vez prosite.dat
+_prosite_lock = threading.Lock()
+
+def load_prosite (prosite_path='prosite.dat', checksum=None):
+    '''
+    Carga la librería de patrones de prosite ya traducidos al formato de re.
+
+    La primera vez se parsea prosite.dat y se guarda un índice en la carpeta
+    de caché. Las siguientes veces se carga directamente el índice, siempre
+    que coincidan la versión del índice y el checksum de prosite.dat (si no
+    coinciden se vuelve a parsear el archivo y se reescribe el índice).
+
+    Input:
+        - prosite_path: ruta del archivo prosite.dat
+        - checksum: checksum de prosite.dat si ya se conoce (p.ej. en los
+                    workers de make_domain) o None para obtenerlo con
+                    prosite_checksum
+
+    Output: lista de tuplas (nombre, accesión, descripción, regex compilado)
+            en el mismo orden en el que aparecen en prosite.dat
+    '''
+    if checksum is None:
+        checksum = prosite_checksum(prosite_path)
+
+    return [(name, accession, description, re.compile(pattern)) \
+            for name, accession, description, pattern \
+            in _prosite_index(prosite_path, checksum)]
+
+#end load_prosite()
+
+
+def _prosite_index (prosite_path, checksum):
+    '''
+    Patrones del índice de prosite.dat en la carpeta de caché (ver
+    load_prosite), sin compilar. Si no existe o no corresponde a este
+    prosite.dat se parsea el archivo y se reescribe
+
+    Output: lista de tuplas (nombre, accesión, descripción, patrón de re)
+    '''
+    index_path = cache_path('prosite.idx')
+
+    #Si varias querys cargan la librería a la vez solo una parsea el archivo
+    with _prosite_lock:
+        #Se intenta cargar el índice existente. Si no existe, está corrupto o
+        #no corresponde a este prosite.dat se considera que no hay índice
+        index = None
+        try:
+            with open(index_path, 'rb') as handle:
+                index = pickle.load(handle)
+        except Exception:
+            pass
+        if not index or index.get('version') != PROSITE_INDEX_VERSION \
+           or index.get('checksum') != checksum:
+            #Se parsea prosite.dat una única vez guardando solo los dominios
+            #que tienen patrón (ya adaptado al formato de re)
+            #(el parser de prosite solo se importa cuando hace falta)
+            from Bio.ExPASy import Prosite
+            patterns = []
+            with open(prosite_path, 'r') as prosite_file:
+                for domain in Prosite.parse(prosite_file):
+                    if domain.pattern:
+                        patterns.append((domain.name, domain.accession, \
+                                         domain.description, \
+                                         adapt_pattern(domain.pattern)))
+            index = {'version': PROSITE_INDEX_VERSION, \
+                     'checksum': checksum, 'patterns': patterns}
+            #Se escribe primero a un temporal y luego se renombra para que
+            #otro proceso nunca lea un índice a medio escribir
+            #El temporal es propio de cada proceso e hilo
+            temporal = index_path+'.'+str(os.getpid())+'.' \
+                       +str(threading.get_ident())
+            with open(temporal, 'wb') as handle:
+                pickle.dump(index, handle, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(temporal, index_path)
+
+    return index['patterns']
+
+#end _prosite_index()
+
+
+def pattern_requirements (pattern):
+    '''
+    Extrae de un patrón ya adaptado (output de adapt_pattern) lo que
+    obligatoriamente tiene que contener una secuencia para que el patrón
+    pueda matchear.
+
+    Input:
+        - pattern: patrón en formato de re
+
+    Output: tupla (letras, conteos, ventanas) donde:
+            - letras: set de residuos fijos que deben aparecer
+            - conteos: dict residuo :: nº mínimo de apariciones (si es > 1)
+            - ventanas: lista de sets de subcadenas de 2-3 residuos (de más
+              a menos selectivo). De cada set tiene que aparecer al menos
+              una subcadena en la secuencia
+            Si el patrón no se puede analizar se devuelve None (sin filtro)
+    '''
+    #Primero se trocea el patrón en elementos (set de residuos permitidos o
+    #None si vale cualquier residuo) con su repetición mínima y máxima
+    elements = []
+    i = 0
+    try:
+        while i < len(pattern):
+            char = pattern[i]
+            if char in '^$':
+                i += 1
+                continue
+            if char == '[':
+                end = pattern.index(']', i)
+                body = pattern[i+1:end]
+                #Las clases negadas o que contienen algo que no es un residuo
+                #(p.ej. [G$] que viene de [G>]) no imponen ningún residuo
+                if body.startswith('^') or not body.isalpha():
+                    residues = None
+                else:
+                    residues = frozenset(body)
+                i = end + 1
+            elif char == '.':
+                residues = None
+                i += 1
+            elif char.isalpha():
+                residues = frozenset(char)
+                i += 1
+            else:
+                return None
+            low = high = 1
+            if i < len(pattern) and pattern[i] == '{':
+                end = pattern.index('}', i)
+                numbers = pattern[i+1:end].split(',')
+                low, high = int(numbers[0]), int(numbers[-1])
+                i = end + 1
+            elements.append((residues, low, high))
+    except ValueError:
+        return None
+
+    #Los residuos fijos con repetición mínima >= 1 son obligatorios
+    letters = set()
+    counts = {}
+    for residues, low, high in elements:
+        if residues and len(residues) == 1 and low > 0:
+            letter = next(iter(residues))
+            letters.add(letter)
+            counts[letter] = counts.get(letter, 0) + low
+
+    #Los tramos de elementos consecutivos con residuos y repetición fijos
+    #aparecen siempre seguidos en cualquier match. De cada tramo se sacan
+    #ventanas de 3 residuos (o de 2 si el tramo es de 2) y se expanden en
+    #todas sus variantes si no son demasiadas
+    runs = [[]]
+    for residues, low, high in elements:
+        if residues and low == high and low > 0:
+            runs[-1].extend([residues] * low)
+        else:
+            runs.append([])
+    windows = []
+    for run in runs:
+        width = min(3, len(run))
+        for start in range(len(run) - width + 1) if width > 1 else []:
+            variants = ['']
+            for residues in run[start:start+width]:
+                variants = [v + r for v in variants for r in residues]
+            if len(variants) <= 64:
+                windows.append(frozenset(variants))
+    #Se ordenan por selectividad (probabilidad de aparecer por azar) y se
+    #guardan las 3 mejores
+    windows.sort(key=lambda w: len(w) / 20 ** len(next(iter(w))))
+
+    return letters, {l: n for l, n in counts.items() if n > 1}, windows[:3]
+
+#end pattern_requirements()
+
+
+def sequence_grams (sequence):
+    '''
+    Devuelve el set de subcadenas de 2 y 3 residuos de una secuencia
+    '''
+    return {sequence[i:i+k] for k in (2, 3) \
+            for i in range(len(sequence) - k + 1)}
+
+#end sequence_grams()
+
+
+def build_prefilter (library):
+    '''
+    Construye el prefiltro compartido de una librería de patrones.
+
+    Se compone de dos índices de bitmaps (enteros cuyos bits marcan patrones):
+        - Por residuo: patrones que obligatoriamente contienen ese residuo. Para
+          una secuencia se quitan los patrones de los residuos ausentes.
+        - Por subcadena de 2-3 residuos: patrones cuya ventana más selectiva
+          contiene esa subcadena. Para una secuencia solo son candidatos los
+          patrones de sus subcadenas (funciona como un autómata multipatrón).
+    Además se guardan los conteos mínimos y el resto de ventanas de cada
+    patrón, que se comprueban antes de lanzar la búsqueda completa con re.
+
+    Input:
+        - library: lista de patrones (output de load_prosite)
+
+    Output: tupla (sin_ventana, por_residuo, por_subcadena, requisitos) que
+            se pasa a scan_sequence
+    '''
+    unindexed = 0
+    by_letter = {}
+    by_gram = {}
+    requirements = []
+    for idx, (name, accession, description, regex) in enumerate(library):
+        required = pattern_requirements(regex.pattern)
+        if required is None:
+            unindexed |= 1 << idx
+            requirements.append(({}, []))
+            continue
+        letters, counts, windows = required
+        for letter in letters:
+            by_letter[letter] = by_letter.get(letter, 0) | 1 << idx
+        if windows:
+            for gram in windows[0]:
+                by_gram[gram] = by_gram.get(gram, 0) | 1 << idx
+        else:
+            unindexed |= 1 << idx
+        requirements.append((counts, windows[1:]))
+
+    return unindexed, by_letter, by_gram, requirements
+
+#end build_prefilter()
+
+
+def scan_sequence (sequence, library, prefilter=None, stats=None):
+    '''
+    Busca todos los patrones de la librería en una secuencia de proteína.
+
+    Si se da el prefiltro (output de build_prefilter) solo se lanza re.search
+    para los patrones que pueden matchear según los residuos de la secuencia.
+    El resultado es el mismo que probando todos los patrones uno a uno.
+
+    Input:
+        - sequence: secuencia de la proteína (string)
+        - library: lista de patrones (output de load_prosite)
+        - prefilter: prefiltro de la librería (output de build_prefilter)
+        - stats: si se da un dict, se suma a stats['patterns_tested'] el nº
+                 de patrones probados con re.search
+
+    Output: lista de tuplas (nombre, accesión, descripción, match) en el
+            orden de la librería
+    '''
+    found = []
+    if prefilter is None:
+        for name, accession, description, regex in library:
+            match = regex.search(sequence)
+            if match:
+                found.append((name, accession, description, match))
+        if stats is not None:
+            stats['patterns_tested'] = stats.get('patterns_tested', 0) \
+                                       + len(library)
+        return found
+
+    #Candidatos: patrones sin ventana y los de las subcadenas presentes,
+    #quitando los que exigen algún residuo ausente
+    candidates, by_letter, by_gram, requirements = prefilter
+    grams = sequence_grams(sequence)
+    for gram in grams:
+        candidates |= by_gram.get(gram, 0)
+    present = set(sequence)
+    for letter, bitmap in by_letter.items():
+        if letter not in present:
+            candidates &= ~bitmap
+
+    #Se recorren los bits de los candidatos de menor a mayor (orden de la
+    #librería) comprobando ventanas y conteos antes del re.search
+    tested = 0
+    while candidates:
+        lowest = candidates & -candidates
+        idx = lowest.bit_length() - 1
+        candidates ^= lowest
+        counts, windows = requirements[idx]
+        if windows and not all(not grams.isdisjoint(w) for w in windows):
+            continue
+        if counts and any(sequence.count(l) < n for l, n in counts.items()):
+            continue
+        name, accession, description, regex = library[idx]
+        match = regex.search(sequence)
+        tested += 1
+        if match:
+            found.append((name, accession, description, match))
+    if stats is not None:
+        stats['patterns_tested'] = stats.get('patterns_tested', 0) + tested
+
+    return found
+
+#end scan_sequence()
+
+
+#Librería y prefiltro de cada proceso worker de make_domain. Se cargan una
+#sola vez por proceso en _init_domain_worker() (en el proceso principal no
+#se usan: ahí se pasan a _scan_domain_worker)
+_worker_library = None
+_worker_prefilter = None
+
+def _init_domain_worker (prosite_path, checksum=None):
+    '''
+    Inicializador de los procesos worker de make_domain: carga la librería de
+    patrones (desde el índice en caché, con el checksum de prosite.dat ya
+    calculado por make_domain) y su prefiltro una sola vez
+    '''
+    global _worker_library, _worker_prefilter
+    _worker_library = load_prosite(prosite_path, checksum)
+    _worker_prefilter = build_prefilter(_worker_library)
+
+#end _init_domain_worker()
+
+
+def _scan_domain_worker (sequence, library=None, prefilter=None):
+    '''
+    Escanea una secuencia en un proceso worker (con su librería y prefiltro)
+    o, si se dan library y prefilter, en el proceso principal. Los objetos
+    match no se pueden enviar entre procesos, así que se devuelven tuplas
+    (nombre, accesión, descripción, secuencia del match, start, end), junto
+    con el nº de patrones probados (para las métricas)
+    '''
+    if library is None:
+        library, prefilter = _worker_library, _worker_prefilter
+    stats = {}
+    found = [(name, accession, description, match.group(), match.start(), \
+              match.end()) for name, accession, description, match in \
+             scan_sequence(sequence, library, prefilter, stats)]
+
+    return found, stats.get('patterns_tested', 0)
+
+#end _scan_domain_worker()
+
+
+def _open_domain_cache ():
+    '''
+    Abre (creándola si no existe) la base de datos SQLite de la caché de
+    dominios: tabla domains con el digest de cada secuencia, la versión de
+    prosite.dat con la que se escaneó y los dominios encontrados (json)
+    '''
+    connection = sqlite3.connect(cache_path('domains.sqlite'), timeout=60)
+    #En modo WAL varias querys analizadas a la vez pueden leer mientras
+    #otra escribe
+    connection.execute('PRAGMA journal_mode=WAL')
+    connection.execute('CREATE TABLE IF NOT EXISTS domains (digest BLOB, '\
+                       + 'prosite TEXT, found TEXT, '\
+                       + 'PRIMARY KEY (digest, prosite))')
+
+    return connection
+
+#end _open_domain_cache()
+
+
+def _sequence_digest (sequence):
+    '''
+    Digest de una secuencia para la caché de dominios
+    '''
+    return hashlib.blake2b(sequence.encode(), digest_size=16).digest()
+
+#end _sequence_digest()
+
+
+def cached_domains (sequences, version, chunk_size=500):
+    '''
+    Busca en la caché de dominios los resultados ya conocidos de un grupo de
+    secuencias
+
+    Input:
+        - sequences: lista de secuencias
+        - version: versión de prosite.dat (ver make_domain)
+        - chunk_size: nº de secuencias por consulta a SQLite
+
+    Output: dict secuencia :: lista de tuplas (nombre, accesión, descripción,
+            secuencia del match, start, end) con las secuencias encontradas
+    '''
+    digests = {_sequence_digest(sequence): sequence for sequence in sequences}
+    found = {}
+    connection = _open_domain_cache()
+    try:
+        keys = list(digests)
+        for start in range(0, len(keys), chunk_size):
+            chunk = keys[start:start+chunk_size]
+            query = 'SELECT digest, found FROM domains WHERE prosite = ? '\
+                    + 'AND digest IN ('+','.join('?'*len(chunk))+')'
+            for digest, text in connection.execute(query, [version]+chunk):
+                found[digests[digest]] = [tuple(domain) \
+                                          for domain in json.loads(text)]
+    finally:
+        connection.close()
+
+    return found
+
+#end cached_domains()
+
+
+def store_domains (found, version):
+    '''
+    Guarda en la caché de dominios los resultados de un grupo de secuencias
+
+    Input:
+        - found: dict secuencia :: lista de dominios (ver cached_domains)
+        - version: versión de prosite.dat (ver make_domain)
+    '''
+    connection = _open_domain_cache()
+    try:
+        with connection:
+            connection.executemany('INSERT OR REPLACE INTO domains VALUES '\
+                                   + '(?, ?, ?)', \
+                                   ((_sequence_digest(sequence), version, \
+                                     json.dumps(domains)) \
+                                    for sequence, domains in found.items()))
+    finally:
+        connection.close()
+
+    return None
+
+#end store_domains()
+
+
+#Tabla de dominios encontrados por make_domain en formato columnar:
+#   - proteins: ids de las proteínas con algún dominio (en el orden del
+#               multifasta) y lengths: su longitud
+#   - names: nombres de dominio distintos (cada uno se guarda una vez)
+#   - protein, domain, start, end: una posición por cada dominio encontrado
+#     con el índice de su proteína en proteins, el de su nombre en names y
+#     sus posiciones de inicio y fin. Están ordenadas por proteína
+DomainTable = namedtuple('DomainTable', ['proteins', 'lengths', 'names', \
+                                         'protein', 'domain', 'start', 'end'])
+
+#Nº mínimo de secuencias por escanear para que make_domain use el pool de
+#procesos (con menos se escanean en serie)
+DOMAIN_POOL_MIN_SEQUENCES = 500
+
+@imetrics.stage('make_domain')
+def make_domain (result_path, prosite_path='prosite.dat', workers=1, \
+                 table_path=None, cache=True):
     '''
     Crea un archivo que contiene los dominios encontrados en el multifasta
     de proteinas filtadas.
 
+    Con workers > 1 y al menos DOMAIN_POOL_MIN_SEQUENCES secuencias por
+    escanear las proteínas se reparten entre un pool de procesos (cada
+    uno carga la librería de patrones una única vez) y los resultados se
+    escriben en el mismo orden que en el multifasta. Las secuencias repetidas
+    (p.ej. la misma proteína en varios ensamblados) solo se escanean una vez.
+
+    Con cache los dominios de cada secuencia se guardan en una caché
+    persistente (.identipy_cache/domains.sqlite) identificados por el digest
+    de la secuencia y la versión de prosite.dat, y solo se escanean las
+    secuencias que no se habían escaneado antes (en esta u otra query).
+
     Input:
         - result_path: ruta donde esta el multifasta input y donde se guarda
                        el resultado
+        - prosite_path: ruta del archivo prosite.dat
+        - workers: número de procesos usados para el escaneo
+        - table_path: si se da, la tabla de dominios se guarda también en
+                      este archivo .npz (ver load_domain_table)
+        - cache: usar la caché persistente de dominios
 
     Output: archivo que contiene los dominios encontrados con un header que
             precede a cada proteina y los campos:
             "dominio, accesion, descripcion, patron encontrado"
 
-            El return se silencia a 'None'.
-    '''
-    #Para hacer el plot posterior de dominios de proteinas se hacen unos
-    #archivos temporales que contienen el start y el end y la longitud total.
-    #Se almacenan en una carpeta temporal
-    os.mkdir('Temporal')
-
-    #Se abren el archivo output y el multifasta que se parsea
-    with open(result_path+'/Domains.txt', 'w') as output:
-        with open(result_path+'/MultifaFiltered.fasta','r') as handle:
-            for record in SeqIO.parse(handle, 'fasta'):
-                #Si una proteína no matchea con ningún patrón se va a eliminar
-                #su archivo temporal. Inicialmente se supone que una proteína
-                #no matchea ningun patrón
-                has_matched = False
+            Se devuelve la tabla de dominios (DomainTable) para plot_domains
+    '''
+    #Se leen los ids y secuencias del multifasta
+    with open(result_path+'/MultifaFiltered.fasta','r') as handle:
+        records = [(record.id, str(record.seq)) \
+                   for record in SeqIO.parse(handle, 'fasta')]
+
+    #Cada secuencia distinta se escanea una sola vez, y con caché solo las
+    #que no estén ya en ella. La versión de prosite.dat incluye la del
+    #formato de los patrones adaptados
+    sequences = list(dict.fromkeys(sequence for _, sequence in records))
+    found_by_sequence = {}
+    checksum = prosite_checksum(prosite_path)
+    if cache:
+        version = str(PROSITE_INDEX_VERSION)+':'+checksum
+        found_by_sequence = cached_domains(sequences, version)
+        sequences = [sequence for sequence in sequences \
+                     if sequence not in found_by_sequence]
+
+    #El pool solo se usa con suficientes secuencias: arrancar los workers
+    #(cada uno carga la librería y su prefiltro) cuesta más que escanear en
+    #serie un MultifaFiltered típico
+    pool = None
+    if workers > 1 and len(sequences) >= DOMAIN_POOL_MIN_SEQUENCES:
+        #Solo se crea aquí el índice en caché, para que ya exista cuando
+        #arranquen los workers. Los workers no se crean con fork para no
+        #heredar los hilos del análisis (con jobs > 1 make_domain se llama
+        #desde varios hilos)
+        _prosite_index(prosite_path, checksum)
+        pool = worker_context().Pool(workers, \
+                                     initializer=_init_domain_worker, \
+                                     initargs=(prosite_path, checksum))
+        #imap devuelve los resultados en el orden de entrada
+        chunksize = max(1, len(sequences) // (workers*4))
+        results = pool.imap(_scan_domain_worker, sequences, chunksize)
+    elif sequences:
+        #En serie la librería y su prefiltro se pasan a cada escaneo (no se
+        #guardan en los globales de los workers, que comparten los hilos)
+        library = load_prosite(prosite_path, checksum)
+        results = map(functools.partial(_scan_domain_worker, \
+                                        library=library, \
+                                        prefilter=build_prefilter(library)), \
+                      sequences)
+    else:
+        results = []
+
+    try:
+        scanned = {}
+        tested = 0
+        for sequence, (found, patterns) in zip(sequences, results):
+            scanned[sequence] = found
+            tested += patterns
+        imetrics.count('sequences_scanned', len(scanned))
+        imetrics.count('patterns_tested', tested)
+        imetrics.count('regex_matches', sum(len(found) for found \
+                                            in scanned.values()))
+        imetrics.count('domain_cache_hits', len(found_by_sequence))
+        if cache and scanned:
+            store_domains(scanned, version)
+        found_by_sequence.update(scanned)
+        #Para el plot de dominios se guardan en columnas la proteína, el
+        #dominio (como índice en la lista de nombres) y el inicio y el fin
+        #de cada dominio encontrado
+        proteins, lengths, names = [], [], {}
+        hit_protein, hit_domain, hit_start, hit_end = [], [], [], []
+        #Se abre el archivo output y se escriben los dominios de cada proteína
+        with open(result_path+'/Domains.txt', 'w') as output:
+            for record_id, sequence in records:
+                found = found_by_sequence[sequence]
                 #Se escribe el header del archivo de dominios:
-                output.write('>'+record.id+"\n-------------\n")
+                output.write('>'+record_id+"\n-------------\n")
                 output.write('Nombre dominio\tAccesión\tDescripción\tSecuencia\n')
-                #Se abre el archivo temporal:
-                with open('Temporal/'+record.id,'w') as temporal_output:
-                    #Para cada dominio de prosite se comprueba si existe patrón,
-                    #se adapta al formato de re y se intenta matchear
-                    #El archivo prosite.dat se tiene que abrir para cada record
-                    #ya que al escanear por el, como es un iterador se "consume"
-                    #(si se abre al principio funciona para el primer record
-                    #pero para los demás es como si estuviera vacío)
-                    with open('prosite.dat', 'r') as prosite_file:
-                        for domain in Prosite.parse(prosite_file):
-                            if domain.pattern:
-                                adapted_pattern = adapt_pattern(domain.pattern)
-                                match = re.search(adapted_pattern, str(record.seq))
-                                #Si ha matcheado se escriben los datos al
-                                #resultado y al output temporal y se cambia
-                                #has_matched -> True
-                                if match:
-                                    output.write(domain.name+'\t'+domain.accession \
-                                                +'\t'+domain.description+'\t' \
-                                                + match.group()+'\n')
-
-                                    temporal_output.write(domain.name+'\t' \
-                                    +str(match.start())+'\t'+str(match.end()) \
-                                    +'\t'+str(len(record.seq))+'\n')
-
-                                    has_matched = True
-
-                        #Una vez se termina de escanear todos los dominios se
-                        #añade un newline extra al output para separar de la
-                        #proxima proteina
-                        output.write('\n')
-
-                #Finalmente una vez se ha acabado con la proteina y se ha
-                #cerrado el archivo.
-                #Si no se ha matcheado se elimina el temporal output creado
-                if not has_matched:
-                    os.remove('Temporal/'+record.id)
+                #Se escriben los dominios de prosite que matchean con la
+                #proteina al resultado
+                for name, accession, description, group, start, end in found:
+                    output.write(name+'\t'+accession+'\t'+description \
+                                 +'\t'+group+'\n')
+                #Una vez se escriben todos los dominios se añade un newline
+                #extra al output para separar de la proxima proteina
+                output.write('\n')
 
-    return None
+                #Solo las proteinas que han matcheado algún patrón van a la
+                #tabla
+                if found:
+                    for name, accession, description, group, first, last \
+                            in found:
+                        hit_protein.append(len(proteins))
+                        hit_domain.append(names.setdefault(name, len(names)))
+                        hit_start.append(first)
+                        hit_end.append(last)
+                    proteins.append(record_id)
+                    lengths.append(len(sequence))
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+
+    imetrics.count('proteins_with_domains', len(proteins))
+    imetrics.count('domains_written', len(hit_start))
+    table = DomainTable(np.array(proteins, dtype=str), \
+                        np.array(lengths, dtype=np.int32), \
+                        np.array(list(names), dtype=str), \
+                        np.array(hit_protein, dtype=np.int32), \
+                        np.array(hit_domain, dtype=np.int32), \
+                        np.array(hit_start, dtype=np.int32), \
+                        np.array(hit_end, dtype=np.int32))
+    if table_path is not None:
+        save_domain_table(table, table_path)
+
+    return table
 
 #end make_domain()
 
 
+def save_domain_table (table, table_path):
+    '''
+    Guarda una tabla de dominios (DomainTable) en un único archivo .npz
+    (se escribe a un temporal que luego se renombra)
+    '''
+    temporal = table_path+'.'+str(os.getpid())+'.' \
+               +str(threading.get_ident())+'.tmp'
+    with open(temporal, 'wb') as handle:
+        np.savez(handle, **table._asdict())
+    os.replace(temporal, table_path)
+
+    return None
+
+#end save_domain_table()
+
+
+def load_domain_table (table_path):
+    '''
+    Carga una tabla de dominios guardada con save_domain_table
+
+    Output: DomainTable
+    '''
+    with np.load(table_path) as arrays:
+        return DomainTable(*(arrays[field] for field in DomainTable._fields))
+
+#end load_domain_table()
+
+
 def color_dispenser():
     '''
     Generador para la obtención de un nuevo color
@@ -111,7 +680,8 @@ def color_dispenser():
     #Estimando hasta 15 colores distintos (puede que haya más dominios
     #y en ese caso se repetirán colores pero si se generan más las dif
     #entre colores son inapreciables)
-    cm = plt.get_cmap('gist_rainbow')
+    import matplotlib
+    cm = matplotlib.colormaps['gist_rainbow']
     color_list = [cm(1.*i/15) for i in range(15)]
     idx = 0 #indice del color de la lista por el que se va
 
@@ -128,7 +698,8 @@ def color_dispenser():
 
 #end color_dispenser()
 
-def plot_domains (temporal_path):
+@imetrics.stage('plot_domains')
+def plot_domains (domains, output_path=None):
     '''
     Crea los gráficos que muestran los dominios encontrados en las
     proteínas filtradas.
@@ -137,14 +708,22 @@ def plot_domains (temporal_path):
     hay cajas de colores que representan cada dominio encontrado.
 
     Input:
-        - temporal_path: ruta de los archivos que contienen la información de
-        los dominios (domain_id match_start match_end total_len_prot)
-        siendo que cada archivo corresponde a UNA proteina.
+        - domains: tabla de dominios (DomainTable) devuelta por make_domain
+                   o ruta del archivo .npz en el que se guardó
+        - output_path: si se da, el gráfico se guarda en este archivo (.png,
+                       .svg...) en vez de mostrarse en una ventana
     '''
+    #matplotlib solo se importa para dibujar
+    import matplotlib.patches as mpatch
+    if isinstance(domains, str):
+        domains = load_domain_table(domains)
+
     #Inicialización de variables y del plot
     height = 3      #Altura a la que se dibuja cada prot
-    biggest = 0     #Maximo tamaño encontrado (para designar el xlim)
-    prot_num = 0    #Número de proteinas encontradas (se plotea un máximo de 20)
+    #Número de proteinas que se dibujan (se plotea un máximo de 21)
+    prot_num = min(len(domains.proteins), 21)
+    #Maximo tamaño de las proteínas dibujadas (para designar el xlim)
+    biggest = int(domains.lengths[:prot_num].max()) if prot_num else 0
 
     #Para hacer la leyenda de color de los dominios se mantiene un diccionario
     #de tipo dict[id] :: color, dpor lo que para cada id de dominio se asigna
@@ -153,43 +732,36 @@ def plot_domains (temporal_path):
     #Generador con el cual se genera un proximo color
     color_generator = color_dispenser()
 
-    ax = plt.subplot()
-
-    #Para cada proteina se abre el archivo y para cada linea se extraen los datos
-    #Almacenados en los ficheros temporales
-    for file in os.listdir(temporal_path):
-        with open(temporal_path+'/'+file, 'r') as input:
-            for line in input.readlines():
-                id = line.split('\t')[0]
-                start = int(line.split('\t')[1])
-                end = int(line.split('\t')[2])
-                total = int(line.split('\t')[3])
-                #Si el tamaño total encontrado es mayor que el anterior mas grande
-                #es el nuevo tamaño más grande
-                if total > biggest:
-                    biggest = total
-                #Si se encuentra un nuevo dominio que no estaba en las keys se añade
-                #como key y se le da como valor un nuevo color mediante el generador
-                if not id in color_dict.keys():
-                    color_dict[id] = next(color_generator)
-                #Se dibuja el dominio como una caja con el color adecuado segun el id
-                box = mpatch.FancyBboxPatch((start,height), end-start, 3, \
-                                             facecolor=color_dict[id])
-                ax.add_patch(box)
-            #Finalmente para cada proteina se dibuja también una caja que
-            #representa la proteína en total
-            box = mpatch.FancyBboxPatch((0,height),total,3, facecolor='yellow',\
-                                         alpha=0.3)
+    figure = new_figure(output_path)
+    ax = figure.add_subplot()
+
+    #Los dominios están ordenados por proteína, así que los de la proteína i
+    #van de bounds[i] a bounds[i+1]
+    bounds = np.searchsorted(domains.protein, np.arange(prot_num+1))
+    for index in range(prot_num):
+        total = int(domains.lengths[index])
+        for hit in range(bounds[index], bounds[index+1]):
+            id = str(domains.names[domains.domain[hit]])
+            start = int(domains.start[hit])
+            end = int(domains.end[hit])
+            #Si se encuentra un nuevo dominio que no estaba en las keys se añade
+            #como key y se le da como valor un nuevo color mediante el generador
+            if not id in color_dict.keys():
+                color_dict[id] = next(color_generator)
+            #Se dibuja el dominio como una caja con el color adecuado segun el id
+            box = mpatch.FancyBboxPatch((start,height), end-start, 3, \
+                                         facecolor=color_dict[id])
             ax.add_patch(box)
-            #Texto que va a la derecha de la caja de proteina y muestra su locus_tag
-            ax.text(total+5, height+1.25, file, fontsize=8)
-            #Finalmente antes de pasar a la siguiente proteina se aumenta la altura
-            #a la que se va a dibujar y se incrementa el num prot
-            height += 5
-            prot_num += 1
-            #Si num prot excede el valor maximo se paran las iteraciones
-            if prot_num > 20:
-                break
+        #Finalmente para cada proteina se dibuja también una caja que
+        #representa la proteína en total
+        box = mpatch.FancyBboxPatch((0,height),total,3, facecolor='yellow',\
+                                     alpha=0.3)
+        ax.add_patch(box)
+        #Texto que va a la derecha de la caja de proteina y muestra su locus_tag
+        ax.text(total+5, height+1.25, str(domains.proteins[index]), fontsize=8)
+        #Finalmente antes de pasar a la siguiente proteina se aumenta la altura
+        #a la que se va a dibujar
+        height += 5
 
     #Creación de lista de Patches para la leyenda:
     #Para cada asociación dominio :: color encontrada se crea un Patch en una lista
@@ -197,10 +769,10 @@ def plot_domains (temporal_path):
     patchlist = []
     for key in color_dict.keys():
         patchlist.append(mpatch.Patch(color=color_dict[key], label=key))
-    plt.legend(handles=patchlist)
+    ax.legend(handles=patchlist)
     #El limite de x se pone algo superior a biggest para el espacio del texto label
-    plt.xlim(-2,biggest+60)
-    plt.ylim(-2,102)
-    plt.show()
+    ax.set_xlim(-2,biggest+60)
+    ax.set_ylim(-2,102)
+    finish_figure(figure, output_path)
 
     return None
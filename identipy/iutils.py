@@ -0,0 +1,290 @@
+import os
+import bz2
+import gzip
+import lzma
+import time
+import hashlib
+import asyncio
+import threading
+import multiprocessing
+from contextlib import contextmanager, asynccontextmanager
+from concurrent.futures import ProcessPoolExecutor
+from . import imetrics
+
+#Carpeta (relativa a donde se ejecuta el análisis) donde se guardan los
+#archivos de caché persistentes entre ejecuciones
+CACHE_DIR = '.identipy_cache'
+
+#Primeros bytes de cada formato comprimido que se acepta como input
+COMPRESSION_MAGIC = {'gzip': b'\x1f\x8b', 'bzip2': b'BZh', \
+                     'xz': b'\xfd7zXZ\x00'}
+
+#Semáforo que limita cuántos procesos externos (blastp, muscle...) se ejecutan
+#a la vez en todo el programa. None es sin límite
+_tool_slots = None
+
+def file_checksum (path, chunk_size=1<<20):
+    '''
+    Calcula el checksum sha256 de un archivo leyéndolo por bloques para no
+    cargarlo entero en memoria
+
+    Input:
+        - path: ruta del archivo
+        - chunk_size: tamaño en bytes de cada bloque leído
+
+    Output: string hexadecimal con el checksum del archivo
+    '''
+    digest = hashlib.sha256()
+    with open(path, 'rb') as handle:
+        for chunk in iter(lambda: handle.read(chunk_size), b''):
+            digest.update(chunk)
+
+    return digest.hexdigest()
+
+#end file_checksum()
+
+
+def cache_path (*parts):
+    '''
+    Devuelve la ruta de un archivo dentro de la carpeta de caché, creando
+    las carpetas intermedias si todavía no existen
+
+    Use:
+        cache_path('prosite.idx') -> '.identipy_cache/prosite.idx'
+    '''
+    path = os.path.join(CACHE_DIR, *parts)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    return path
+
+#end cache_path()
+
+
+def file_stamp (path, previous=None):
+    '''
+    Devuelve la huella de un archivo (tamaño, fecha de modificación y
+    checksum). Si se da la huella anterior y el tamaño y la fecha no han
+    cambiado se reutiliza su checksum en vez de volver a leer el archivo.
+
+    Input:
+        - path: ruta del archivo
+        - previous: huella anterior del mismo archivo (o None)
+
+    Output: dict {'size', 'mtime', 'sha256'}
+    '''
+    stat = os.stat(path)
+    if previous and previous.get('size') == stat.st_size \
+       and previous.get('mtime') == stat.st_mtime_ns:
+        return dict(previous)
+
+    return {'size': stat.st_size, 'mtime': stat.st_mtime_ns, \
+            'sha256': file_checksum(path)}
+
+#end file_stamp()
+
+
+def compression (path):
+    '''
+    Detecta por sus primeros bytes (no por la extensión) si un archivo está
+    comprimido
+
+    Output: 'gzip' (también BGZF), 'bzip2', 'xz' o None si no está
+            comprimido
+    '''
+    with open(path, 'rb') as handle:
+        head = handle.read(6)
+    for name, magic in COMPRESSION_MAGIC.items():
+        if head.startswith(magic):
+            return name
+
+    return None
+
+#end compression()
+
+
+def open_input (path, mode='r'):
+    '''
+    Abre un archivo para leerlo descomprimiéndolo al vuelo si está
+    comprimido con gzip, bzip2 o xz, sin descomprimirlo antes a disco
+
+    Input:
+        - path: ruta del archivo
+        - mode: 'r' (texto) o 'rb' (binario)
+
+    Use:
+        with open_input('ensamblado.gbk.gz') as handle:
+            for line in handle:
+                ...
+    '''
+    kind = compression(path)
+    if kind is None:
+        return open(path, mode)
+    opener = {'gzip': gzip.open, 'bzip2': bz2.open, 'xz': lzma.open}[kind]
+
+    return opener(path, 'rt' if mode == 'r' else mode)
+
+#end open_input()
+
+
+def set_tool_limit (limit):
+    '''
+    Establece el máximo de procesos externos (blastp, makeblastdb, muscle)
+    que se pueden ejecutar a la vez, sumando los de todos los hilos. Sirve
+    para que al analizar varias querys a la vez no se lancen más procesos
+    que CPUs. Con limit None o 0 no hay límite
+    '''
+    global _tool_slots
+    _tool_slots = threading.BoundedSemaphore(limit) if limit else None
+
+    return None
+
+#end set_tool_limit()
+
+
+@contextmanager
+def tool_slot (tool=None):
+    '''
+    Reserva uno de los huecos para procesos externos (ver set_tool_limit)
+    mientras dura el bloque with, esperando si están todos ocupados. Si se
+    da el nombre del programa, la espera y la duración del bloque se
+    registran en las métricas de la ejecución (ver imetrics.tool_call)
+
+    Use:
+        with tool_slot('muscle'):
+            call(['muscle', ...])
+    '''
+    slots = _tool_slots
+    requested = time.perf_counter()
+    if slots is not None:
+        slots.acquire()
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        if slots is not None:
+            slots.release()
+        imetrics.tool_call(tool, started - requested, \
+                           time.perf_counter() - started)
+
+#end tool_slot()
+
+
+@asynccontextmanager
+async def async_tool_slot (tool=None):
+    '''
+    Versión de tool_slot para corrutinas de asyncio: mientras no hay un
+    hueco libre se cede el bucle de eventos. La espera no se hace en un hilo
+    para que si la corrutina se cancela no quede un hueco reservado que
+    nadie libera
+
+    Use:
+        async with async_tool_slot('muscle'):
+            process = await asyncio.create_subprocess_exec('muscle', ...)
+    '''
+    slots = _tool_slots
+    requested = time.perf_counter()
+    if slots is not None:
+        while not slots.acquire(blocking=False):
+            await asyncio.sleep(0.05)
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        if slots is not None:
+            slots.release()
+        imetrics.tool_call(tool, started - requested, \
+                           time.perf_counter() - started)
+
+#end async_tool_slot()
+
+
+def new_figure (output_path=None):
+    '''
+    Crea la figura en la que se dibuja un gráfico. Sin output_path es una
+    figura de pyplot que se muestra en una ventana (finish_figure). Con
+    output_path es una Figure suelta que no pasa por pyplot ni por ningún
+    backend gráfico, así que se puede dibujar en cualquier hilo o proceso
+    sin pantalla
+
+    Output: figura de matplotlib
+    '''
+    #matplotlib se importa al dibujar el primer gráfico para que importar
+    #identipy sea rápido
+    if output_path is None:
+        import matplotlib.pyplot as plt
+        return plt.figure()
+
+    from matplotlib.figure import Figure
+    return Figure()
+
+#end new_figure()
+
+
+def finish_figure (figure, output_path=None):
+    '''
+    Termina un gráfico creado con new_figure: sin output_path se muestra en
+    una ventana (y espera a que se cierre) y con output_path se guarda en ese
+    archivo, en el formato de su extensión (.png, .svg...)
+    '''
+    if output_path is None:
+        import matplotlib.pyplot as plt
+        plt.show()
+        return None
+
+    figure.savefig(output_path)
+    return None
+
+#end finish_figure()
+
+
+#Módulos que importa el servidor de forkserver antes de crear los workers,
+#para que arranquen sin volver a importar NumPy y Biopython
+WORKER_PRELOAD = ['identipy.iblast', 'identipy.iprosite']
+
+def worker_context ():
+    '''
+    Contexto de multiprocessing con el que se crean los pools de procesos
+    worker del paquete (make_multifa, make_domain). No se usa fork porque el
+    proceso puede tener ya hilos (querys analizadas a la vez, etapas en
+    asyncio.to_thread...) y hacer fork de un proceso con hilos puede
+    bloquearse: se usa forkserver (con WORKER_PRELOAD ya importados) si
+    está disponible y si no spawn
+
+    Use:
+        pool = worker_context().Pool(workers)
+    '''
+    if 'forkserver' in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context('forkserver')
+        context.set_forkserver_preload(WORKER_PRELOAD)
+        return context
+
+    return multiprocessing.get_context('spawn')
+
+#end worker_context()
+
+
+def _init_plot_worker ():
+    '''
+    Inicializa el proceso que dibuja los gráficos en segundo plano: usa el
+    backend Agg, que no necesita pantalla
+    '''
+    import matplotlib
+    matplotlib.use('Agg')
+
+#end _init_plot_worker()
+
+
+def start_plot_worker ():
+    '''
+    Arranca un proceso en segundo plano en el que se dibujan los gráficos
+    a archivo (p.ej. plotter.submit(blast_plot, rows, 'BlastPlot.png')), de
+    forma que el análisis no espera a que se dibujen. El proceso se crea con
+    spawn para no heredar los hilos y procesos del análisis
+
+    Output: ProcessPoolExecutor con un solo proceso (hay que cerrarlo con
+            shutdown, que espera a los gráficos que falten)
+    '''
+    return ProcessPoolExecutor(1, mp_context=multiprocessing.get_context(\
+                               'spawn'), initializer=_init_plot_worker)
+
+#end start_plot_worker()
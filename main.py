@@ -22,7 +22,12 @@ Instrucciones de uso
 
 Ejecución del script:
 
-    \"main.py query_path database_path [evalue=num] [cov=num] [iden=num]\"
+    \"main.py query_path database_path [evalue=num] [cov=num] [iden=num]
+               [workers=num] [threads=num] [blastdb=0/1] [batch=0/1]
+               [shards=num] [dedup=0/1] [compress=0/1] [cache=0/1]
+               [cluster=num] [prefilter=0/1] [jobs=num] [tools=num] [unattended=0/1]
+               [overwrite=ask/yes/no] [plots=png/svg/none]
+               [metrics=file] [profile=stage]\"
 
     - query_path: ruta del directorio donde están contenidas todas las proteinas
                   query (una query por archivo en formato fasta)
@@ -30,6 +35,10 @@ Ejecución del script:
     - database_path: ruta del directorio donde están contenidos todos los
                   genbank referentes a los ensamblados genómicos
 
+    Los archivos query y genbank pueden estar comprimidos con gzip, bzip2 o
+    xz (p.ej. .gbk.gz, .gbff.bz2): se leen descomprimiéndolos al vuelo (los
+    genbank repartidos entre los workers) sin descomprimirlos antes a disco
+
     Opcionales
     - evalue=num: num se sustituye por el número que se quiere aplicar como
                   máximo de evalue a blastp (ej. evalue=0.01)
@@ -37,20 +46,102 @@ Ejecución del script:
                cov a blastp (ej. cov=70)
     - iden=num: num se sustituye por el % que se quiere aplicar como mínimo de
                 id a blastp (ej. id=70)
+    - workers=num: num se sustituye por el número de procesos usados para
+                   extraer las proteínas de los ensamblados y buscar los
+                   dominios de prosite (ej. workers=8)
+    - threads=num: num se sustituye por el número de hilos usados por blastp
+                   (ej. threads=8)
+    - blastdb=0/1: si es 1 (por defecto) se crea con makeblastdb una base de
+                   datos de BLAST formateada (MultifaDB.p*) en la que buscan
+                   las querys. Si es 0 (o makeblastdb no está instalado) se
+                   busca directamente en el multifasta
+    - batch=0/1: si es 1 todas las querys se buscan con una sola llamada a
+                 blastp y el resultado se separa después por query
+    - shards=num: num se sustituye por el número de partes en las que se
+                  divide la base de datos para buscar en ellas a la vez
+                  (ej. shards=4). Los evalues son los de la búsqueda entera
+    - dedup=0/1: si es 1 las proteínas con secuencia idéntica solo se
+                 escriben una vez en MultifaDB (y se buscan y escanean una
+                 vez). Los resultados se repiten para todas ellas
+    - compress=0/1: si es 1 el multifasta se guarda comprimido en BGZF
+                    (MultifaDB.fasta.gz), que ocupa menos en disco y sigue
+                    permitiendo leer directamente las proteínas de los hits
+    - cache=0/1: si es 1 (por defecto) se guardan los resultados de blastp
+                 sin filtrar y se reutilizan al repetir el análisis con otro
+                 cov, iden o un evalue menor en vez de volver a buscar.
+                 También se guardan los dominios de prosite de cada
+                 secuencia, que no se vuelven a buscar en otras querys
+    - cluster=num: num se sustituye por el % de identidad con el que se
+                   agrupan las secuencias filtradas antes de muscle, que
+                   solo alinea un representante por grupo (ej. cluster=90)
+    - prefilter=0/1: si es 1 blastp solo busca en las proteínas que comparten
+                     suficientes k-mers con la query para poder pasar los
+                     thresholds de cov e iden (ver benchmarks/bench_prefilter)
+    - jobs=num: num se sustituye por el número de querys que se analizan a
+                la vez (ej. jobs=4). Con más de 1 no se muestran gráficos
+    - tools=num: num se sustituye por el máximo de procesos externos
+                 (blastp, muscle...) ejecutándose a la vez entre todas las
+                 querys (por defecto el número de CPUs)
+    - unattended=0/1: si es 1 el análisis no hace ninguna pregunta: las
+                      carpetas de resultados que ya existen se tratan según
+                      overwrite y los gráficos se guardan como archivos en
+                      Result_$query$ (ver plots) en vez de mostrarse
+    - overwrite=ask/yes/no: qué hacer si ya existe la carpeta de resultados
+                            de una query: preguntar (por defecto, sin
+                            unattended), sobreescribirla (yes) o saltarse la
+                            query (no, por defecto con unattended)
+    - plots=png/svg/none: con unattended, formato en el que se guardan los
+                          gráficos (por defecto png) o none para no hacerlos.
+                          Se dibujan en un proceso en segundo plano sin
+                          pantalla, sin que el análisis los espere
+    - metrics=file: file se sustituye por el archivo JSON en el que se
+                    guardan las métricas del análisis (ej. metrics=run.json):
+                    tiempo real, de CPU y memoria de cada etapa y de cada
+                    query, contadores (proteínas leídas y escritas, hits
+                    aceptados y descartados, patrones probados, matches...)
+                    y duración de cada proceso externo (blastp, muscle...)
+    - profile=stage: stage se sustituye por el nombre de una etapa
+                     (make_multifa, make_blastdb, blastp_hits, blastp_batch,
+                     filter_database, make_domain, build_muscle, make_tree,
+                     query...) que se perfila con cProfile. El perfil se
+                     guarda junto al archivo de métricas (file.stage.prof,
+                     por defecto identipy_metrics.stage.prof) y se puede
+                     leer con pstats
 
 Archivos resultado
 ------------------
     - MultifaDB.fasta: multifasta con todas las secuencias del ensamblado
+                       (MultifaDB.fasta.gz con compress)
+    - MultifaDB.p*: base de datos de BLAST creada a partir de MultifaDB
+    - MultifaDB.fasta.idx.*: índice de acceso directo de MultifaDB
+    - MultifaDB.members.tsv: con dedup, proteínas con la misma secuencia que
+                             cada representante de MultifaDB
     - ID_Organism_table.csv: tabla con las equivalencias entre @id y organismo
     - Result_$query$: directorio con el resto de archivos para la query $query$
+        - Query.fasta: si el archivo query estaba comprimido, la query
+                       descomprimida (blastp solo lee archivos de texto)
         - Blast_result: resultado del blastp
+        - Blast_result.npz: todos los hits de blastp en una tabla binaria
+                            (id.load_hit_table)
+        - Organism_summary.tsv: proteínas, hits, mejor identidad y coverage
+                                medio por organismo de los hits filtrados
         - MultifaFiltered: secuencias filtradas por el blastp
         - MuscleAlign: alineamiento de muscle de las secuencias filtradas
         - MuscleTree: árbol filogenético con las secuencias filtradas
+        - MultifaClustered, MuscleClusters.tsv: con cluster, representantes
+          alineados por muscle y miembros del grupo de cada representante
         - Domains: tablas que contienen los datos de dominios encontrados
-
-Gráficos durante la ejecución
------------------------------
+        - Domains.npz: posiciones de los dominios para plot_domains
+          (id.load_domain_table)
+        - BlastPlot, MuscleTree, DomainsPlot (.png/.svg): con unattended,
+          los gráficos de la query
+    - .identipy_cache: caché que permite reutilizar el trabajo de ejecuciones
+                       anteriores (índice de prosite, proteínas ya extraídas
+                       de cada ensamblado, resultados de blastp, dominios de
+                       cada secuencia...). Se puede borrar sin problema
+
+Gráficos durante la ejecución (o archivos de Result_$query$ con unattended)
+--------------------------------------------------------------------------
     - Gráfico scatter que resume de los resultados del blast
     - Gráfico de los árboles filogenéticos obtenidos
     - Gráfico de dominios encontrados y su posición en las proteínas
@@ -62,7 +153,9 @@ Gráficos durante la ejecución
 import os
 import sys
 import shutil
+import asyncio
 from subprocess import call
+from concurrent.futures import ThreadPoolExecutor
 from Bio import SeqIO
 import identipy as id
 
@@ -77,169 +170,477 @@ question = '\033[93m'   #Amarillo
 normal = '\033[0m'      #Texto normal
 
 
-#CONTROL DE ARGUMENTOS
-######################
-#Si no hay más 2 argumentos (3 contando el nombre) muestra la ayuda
-if not len(sys.argv) >= 3:
-    print(help_message)
-    exit(1)
-#Si hay suficientes se extraen los path de querys y database
-#y se comprueba que existen
-else:
-    querys_path, database_path = sys.argv[1:3]
-    if not os.path.isdir(querys_path):
-        raise Exception('La ruta de los archivos query no ha sido encontrada')
-    if not os.path.isdir(database_path):
-        raise Exception('La ruta de los archivos database no ha sido encontrada')
-
-    #El archivo prosite.dat DEBE estar en la carpeta donde se ejecuta el script.
-    #Se comprueba que esto es así
-    if not os.path.isfile('prosite.dat'):
-        raise Exception(error+'¡ERROR: falta el archivo prosite.dat en la '\
-                       +'carpeta en la que se hace el análisis!'+normal)
-
-#El evalue, cov e id se inicializan
-eval = 0.01
-cov = 50
-iden = 50
-
-#Los argumentos opcionales son todos los que hay
-#menos el nombre del script y las 2 rutas
-extra_args = len(sys.argv)-3
-#Para cada uno de estos argumentos adicionales
-#se separa por el = el nombre del argumento y su valor
-for i in range(3,3+extra_args):
-    arg, value = sys.argv[i].split('=')
-    #Se intenta convertir a numérico el valor, lo que confirma que es un número
-    try:
-        value = float(value)
-    #Si la conversión numérica falla avisa pero mantiene el valor por defecto
-    except:
-        print(error+'¡ERROR: has aportado un '+arg+' para blast que no es de'\
-        + ' tipo numérico'+normal+' por lo que ha sido omitido, en su lugar se'\
-        + ' usará el valor establecido por defecto\n')
-    #Si el valor era numérico se establece su valor en la variable adecuada
+async def run_stages (result_path, workers, cache=True, identity=None):
+    '''
+    Ejecuta a la vez las etapas de una query que solo necesitan
+    MultifaFiltered.fasta: muscle (alineamiento y árbol) como subprocesos de
+    asyncio y la búsqueda de dominios de prosite en un hilo. Termina cuando
+    han terminado todas, así que tarda lo que la etapa más lenta
+
+    Input:
+        - result_path: carpeta de resultados de la query
+        - workers: número de procesos usados para los dominios de prosite
+        - cache: usar la caché persistente de dominios de prosite
+        - identity: identidad (0-1) con la que se agrupan las secuencias
+                    antes de muscle (None para alinearlas todas)
+
+    Output: tabla de dominios de make_domain (para plot_domains)
+    '''
+    #La búsqueda de dominios va a un hilo con asyncio.to_thread, que
+    #mantiene la query de las métricas
+    domains = asyncio.to_thread(id.make_domain, result_path, \
+                                workers=workers, \
+                                table_path=result_path+'/Domains.npz', \
+                                cache=cache)
+    _, domains = await asyncio.gather(id.build_muscle_async(result_path, \
+                                      identity=identity), domains)
+
+    return domains
+
+#end run_stages()
+
+
+def analyze_query (path, filename, blast_args, workers=1, found=None, \
+                   interactive=True, identity=None, plotter=None, \
+                   plot_format='png'):
+    '''
+    Ejecuta el análisis de una query: blast, filtrado de la base de datos,
+    alineamiento de muscle y búsqueda de dominios de prosite
+
+    Input:
+        - path: ruta del archivo query
+        - filename: nombre de la query (los resultados van a Result_filename)
+        - blast_args: dict con los argumentos de id.blastp_hits (eval, cov_t,
+                      iden_t, db, threads, shards, members, dbsize, cache,
+                      prefilter, save_table, index)
+        - workers: número de procesos usados para los dominios de prosite
+        - found: tupla (hits, table) si el blast ya se ha hecho (modo por
+                 lotes) o None para hacerlo aquí
+        - interactive: si es False no se pregunta si se quieren ver los
+                       gráficos y los mensajes llevan delante el nombre de la
+                       query, para poder analizar varias querys a la vez
+        - identity: identidad (0-1) con la que se agrupan las secuencias
+                    antes de muscle (None para alinearlas todas)
+        - plotter: proceso de id.start_plot_worker en el que se dibujan los
+                   gráficos a archivo sin esperarlos (None para no hacerlos)
+        - plot_format: extensión de los archivos de los gráficos (png, svg)
+
+    Output: lista de tuplas (archivo, future) de los gráficos pedidos a
+            plotter
+    '''
+    #Las etapas de la query se asignan a ella en las métricas
+    with id.imetrics.query(filename):
+        return _analyze_query(path, filename, blast_args, workers, found, \
+                              interactive, identity, plotter, plot_format)
+
+#end analyze_query()
+
+
+def _analyze_query (path, filename, blast_args, workers, found, interactive, \
+                    identity, plotter, plot_format):
+    '''
+    Cuerpo de analyze_query (ver sus argumentos)
+    '''
+    result_path = 'Result_'+filename
+    plots = []
+    #En modo no interactivo los mensajes de varias querys se mezclan, así que
+    #se indica a qué query corresponde cada uno
+    tag = '' if interactive else ' ['+filename+']'
+    if interactive:
+        print('\n> Ejecutando análisis para la query '+filename+'...')
+        print('------------------------------------------------------------')
+
+    #Se obtienen las IDs de las proteínas filtradas por blast
+    #(ya obtenidas en modo por lotes) y la tabla de todos los hits leídos,
+    #que se usa para el plot y el resumen por organismo
+    if found is not None:
+        hits, table = found
     else:
-        if arg == 'evalue':
-            eval = value
-        elif arg == 'cov':
-            cov = value
-        elif arg == 'iden':
-            iden = value
-        #Si el argumento indicado no existe se avisa pero se ignora
-        else:
-            print(error+'¡ERROR: has aportado el argumento opcional '+arg\
-            + ' que no existe!' +normal+' por lo que ha sido ignorado\n')
-
-#SCRIPT
-#######
-print('/**********************************************************************'\
-     + '*****************************************************')
-print('* '+header+'Ejecutando análisis de identipy en: '+os.getcwd()+normal)
-print('\\*********************************************************************'\
-     + '******************************************************')
-
-print('\nValores de parámetros usados en el análisis:')
-print('evalue: '+str(eval))
-print('coverage: '+str(cov)+'%')
-print('identity: '+str(iden)+'%')
-
-print('\n> Creando base de datos multifasta MultifaDB.fasta de los '\
-     + 'ensamblados genómicos...')
-print('-------------------------------------------------------------'\
-     + '----------------------')
-
-#Creación del MultifaDB.fasta a partir de las secuencias de la database
-id.make_multifa(database_path)
-print('\t'+success+'{+}'+normal+' ¡La base de datos se ha creado exitosamente!')
-
-for file in os.listdir(querys_path):
-    #Para cada proteina query se hace un análisis de blast, muscle y prosite
-    path = querys_path+"/"+file
-    #Se obtiene el nombre separando por el punto y tomando con la parte anterior
-    filename = file.split('.')[0]
-
-    print('\n> Ejecutando análisis para la query '+filename+'...')
-    print('------------------------------------------------------------')
-
-    #Control de argumentos para query:
-    try: #Se intenta parsear por seqio
-        SeqIO.read(path, 'fasta')
-    except:
-        print('\t'+error+'{x}'+normal+' El archivo query '+file+' no está en '\
-             + 'formato fasta y se ha omitido para el análisis')
+        hits, table = id.blastp_hits(path, result_path, return_rows=True, \
+                                     **blast_args)
+    #Si no se obtuvieron hits se omite el análisis para esta query
+    if len(hits) == 0:
+        print('\t'+error+'{x}'+normal+tag+' No se encontró ningún hit. '\
+             + 'Análisis abortado.')
+        return plots
+
+    #Resumen por organismo de los hits filtrados
+    #(Result_$query$/Organism_summary.tsv)
+    id.organism_summary(table, id.filter_hits(table, blast_args['cov_t'], \
+                                              blast_args['iden_t']), \
+                        output_path=result_path+'/Organism_summary.tsv')
+
+    #Si se ha filtrado alguna proteina se da la opción de ver el gráfico
+    if interactive:
+        user_choice = input('\t'+question+'{?}'+normal+' ¿Quieres observar'\
+                           +' un gráfico resumen del resultado de blast?'\
+                           + '[y/n]: ')
+
+        if user_choice in ['Y','y','yes']:
+            id.blast_plot(table)
+    #Sin preguntas el gráfico se dibuja en segundo plano a archivo
+    elif plotter is not None:
+        plot_path = result_path+'/BlastPlot.'+plot_format
+        plots.append((plot_path, plotter.submit(id.blast_plot, table, \
+                                                plot_path)))
+
+    #Genera la base de datos filtrada (Result_$query$/MultifaFiltered)
+    id.filter_database(result_path, path, hits, blast_args.get('members'))
+    print('\t'+success+'{+}'+normal+tag+' ¡La base de datos se ha filtrado'\
+         + ' exitosamente!')
+
+    #Se crean a la vez el alineamiento y el árbol de muscle y el archivo con
+    #los dominios encontrados en cada proteina. Una vez creados se pregunta
+    #si se desea visualizar las gráficas.
+    #La tabla de dominios para el plot se devuelve en memoria (y se guarda
+    #en Result_$query$/Domains.npz)
+    domains = asyncio.run(run_stages(result_path, workers, \
+                                     blast_args.get('cache', True), identity))
+    print('\t'+success+'{+}'+normal+tag+' ¡El árbol filogenético se ha '\
+         + 'creado exitósamente!')
+    print('\t'+success+'{+}'+normal+tag+' ¡El archivo de dominios ha '\
+         + 'sido creado exitosamente!')
+
+    if interactive:
+        user_choice = input('\t'+question+'{?}'+normal+' ¿Quieres '\
+                            + 'observar un gráfico del árbol '\
+                            + 'filogenético? [y/n]: ')
+
+        if user_choice in ['Y','y','yes']:
+            id.plot_muscle(result_path)
+
+        user_choice = input('\t'+question+'{?}'+normal+' ¿Quieres '\
+                            + 'observar un gráfico de los dominios '\
+                            + 'encontrados? [y/n]: ')
+
+        if user_choice in ['Y','y','yes']:
+            id.plot_domains(domains)
+
+    elif plotter is not None:
+        plot_path = result_path+'/MuscleTree.'+plot_format
+        plots.append((plot_path, plotter.submit(id.plot_muscle, result_path, \
+                                                output_path=plot_path)))
+        plot_path = result_path+'/DomainsPlot.'+plot_format
+        plots.append((plot_path, plotter.submit(id.plot_domains, domains, \
+                                                plot_path)))
+
+    return plots
+
+#end _analyze_query()
+
+
+def main ():
+    '''
+    Ejecuta el análisis completo con los argumentos de la línea de comandos
+    '''
+    #CONTROL DE ARGUMENTOS
+    ######################
+    #Si no hay más 2 argumentos (3 contando el nombre) muestra la ayuda
+    if not len(sys.argv) >= 3:
+        print(help_message)
+        exit(1)
+    #Si hay suficientes se extraen los path de querys y database
+    #y se comprueba que existen
     else:
-        #Si no da error se procede a intentar crear los directorios de resultado
-        #Si el directorio ya existe se pregunta si se desea sobreescribir el
-        if os.path.isdir('Result_'+filename):
-            print('\t'+error+'{x}'+normal+' ERROR: Ya existe una carpeta de '\
-            + 'resultados para la query '+filename)
-            user_choice = input('\t'+question+'{?}'+normal\
-                               +' Quieres sobreescribirla? [y/n]: ')
-            if user_choice in ['Y','y','yes']:
-                #Si se desea sobreescribir se borra el directorio y sus
-                #contenidos y se crea de nuevo la carpeta
-                shutil.rmtree('Result_'+filename)
-                os.mkdir('Result_'+filename)
+        querys_path, database_path = sys.argv[1:3]
+        if not os.path.isdir(querys_path):
+            raise Exception('La ruta de los archivos query no ha sido encontrada')
+        if not os.path.isdir(database_path):
+            raise Exception('La ruta de los archivos database no ha sido encontrada')
+
+        #El archivo prosite.dat DEBE estar en la carpeta donde se ejecuta el script.
+        #Se comprueba que esto es así
+        if not os.path.isfile('prosite.dat'):
+            raise Exception(error+'¡ERROR: falta el archivo prosite.dat en la '\
+                           +'carpeta en la que se hace el análisis!'+normal)
+
+    #El evalue, cov e id, el nº de procesos/hilos y el uso de base de datos
+    #de BLAST formateada se inicializan
+    eval = 0.01
+    cov = 50
+    iden = 50
+    workers = 1
+    threads = 1
+    blastdb = True
+    batch = False
+    shards = 1
+    dedup = False
+    compress = False
+    cache = True
+    cluster = 0
+    prefilter = False
+    jobs = 1
+    tools = os.cpu_count() or 1
+    unattended = False
+    overwrite = 'ask'
+    plot_format = 'png'
+    metrics = None
+    profile = None
+
+    #Los argumentos opcionales son todos los que hay
+    #menos el nombre del script y las 2 rutas
+    extra_args = len(sys.argv)-3
+    #Para cada uno de estos argumentos adicionales
+    #se separa por el = el nombre del argumento y su valor
+    for i in range(3,3+extra_args):
+        arg, value = sys.argv[i].split('=')
+        #Los argumentos de texto solo admiten ciertos valores
+        if arg in ['overwrite', 'plots', 'metrics', 'profile']:
+            if arg == 'overwrite' and value in ['ask', 'yes', 'no']:
+                overwrite = value
+            elif arg == 'plots' and value in ['png', 'svg', 'none']:
+                plot_format = value
+            elif arg == 'metrics' and value:
+                metrics = value
+            elif arg == 'profile' and value:
+                profile = value
             else:
-                #Pero si no se desea sobreescribir se pasa a la siguiente query
-                continue
-        #Si el directorio no existía simplemente se crea
+                print(error+'¡ERROR: has aportado un '+arg+' que no es válido'\
+                + normal+' por lo que ha sido omitido, en su lugar se usará el'\
+                + ' valor establecido por defecto\n')
+            continue
+        #Se intenta convertir a numérico el valor, lo que confirma que es un número
+        try:
+            value = float(value)
+        #Si la conversión numérica falla avisa pero mantiene el valor por defecto
+        except:
+            print(error+'¡ERROR: has aportado un '+arg+' para blast que no es de'\
+            + ' tipo numérico'+normal+' por lo que ha sido omitido, en su lugar se'\
+            + ' usará el valor establecido por defecto\n')
+        #Si el valor era numérico se establece su valor en la variable adecuada
         else:
-            os.mkdir('Result_'+filename)
-
-        #Se obtienen las IDs de las proteínas filtradas por blast
-        hits = id.blastp_hits(path, 'Result_'+filename, eval, cov, iden)
-        if len(hits) > 0: #Si se obtuvo algún hit se realiza el análisis
-
-            #Si se ha filtrado alguna proteina se da la opción de ver el gráfico
-            #Durante el blast se ha generado el temporal 'blast_temporal'
-            #que se usa para el plot
-            user_choice = input('\t'+question+'{?}'+normal+' ¿Quieres observar'\
-                               +' un gráfico resumen del resultado de blast?'\
-                               + '[y/n]: ')
-
-            if user_choice in ['Y','y','yes']:
-                id.blast_plot('blast_temporal')
-            #Una vez se pasa el plot se haya hecho o no se elimina el temporal
-            os.remove('blast_temporal')
-
-            #Genera la base de datos filtrada (Result_$query$/MultifaFiltered)
-            id.filter_database('Result_'+filename, path, hits)
-            print('\t'+success+'{+}'+normal+' ¡La base de datos se ha filtrado'\
-                 + ' exitosamente!')
-
-            #Se crea el alineamiento de muscle. Una vez creado se pregunta si
-            #se desea visualizar la gráfica
-            id.build_muscle('Result_'+filename)
-            print('\t'+success+'{+}'+normal+' ¡El árbol filogenético se ha '\
-                 + 'creado exitósamente!')
-
-            user_choice = input('\t'+question+'{?}'+normal+' ¿Quieres observar'\
-                                + ' un gráfico del árbol filogenético? [y/n]: ')
-
-            if user_choice in ['Y','y','yes']:
-                id.plot_muscle('Result_'+filename)
-
-            #Se crea el archivo con los dominios encontrados en cada proteina
-            #Una vez creado se pregunta si se desea visualizar la gráfica
-            id.make_domain('Result_'+filename)
-            print('\t'+success+'{+}'+normal+' ¡El archivo de dominios ha sido '\
-                 + 'creado exitosamente!')
-
-            user_choice = input('\t'+question+'{?}'+normal+' ¿Quieres observar'\
-                                + ' un gráfico de los dominios encontrados?'\
-                                + ' [y/n]: ')
-
-            if user_choice in ['Y','y','yes']:
-                #Durante make_domain se crea el archivo Result_$query$/Domains
-                #Y un grupo de archivos en la carpeta Temporal para el plot
-                id.plot_domains('Temporal')
-            #Una vez pasa el plot se haya hecho o no se elimina el temporal
-            shutil.rmtree('Temporal')
-
-        #(viene de if len(hits)) : Si no se obtuvieron hits se omite
-        #el análisis para esta query
+            if arg == 'evalue':
+                eval = value
+            elif arg == 'cov':
+                cov = value
+            elif arg == 'iden':
+                iden = value
+            elif arg == 'workers':
+                workers = max(1, int(value))
+            elif arg == 'threads':
+                threads = max(1, int(value))
+            elif arg == 'blastdb':
+                blastdb = bool(value)
+            elif arg == 'batch':
+                batch = bool(value)
+            elif arg == 'shards':
+                shards = max(1, int(value))
+            elif arg == 'dedup':
+                dedup = bool(value)
+            elif arg == 'compress':
+                compress = bool(value)
+            elif arg == 'cache':
+                cache = bool(value)
+            elif arg == 'cluster':
+                cluster = value
+            elif arg == 'prefilter':
+                prefilter = bool(value)
+            elif arg == 'jobs':
+                jobs = max(1, int(value))
+            elif arg == 'tools':
+                tools = max(1, int(value))
+            elif arg == 'unattended':
+                unattended = bool(value)
+            #Si el argumento indicado no existe se avisa pero se ignora
+            else:
+                print(error+'¡ERROR: has aportado el argumento opcional '+arg\
+                + ' que no existe!' +normal+' por lo que ha sido ignorado\n')
+
+    #SCRIPT
+    #######
+    print('/**********************************************************************'\
+         + '*****************************************************')
+    print('* '+header+'Ejecutando análisis de identipy en: '+os.getcwd()+normal)
+    print('\\*********************************************************************'\
+         + '******************************************************')
+
+    #Sin makeblastdb instalado se busca directamente en el multifasta
+    if blastdb and shutil.which('makeblastdb') is None:
+        print(error+'¡AVISO: no se ha encontrado makeblastdb'+normal+' por lo'\
+        + ' que se buscará directamente en el multifasta (blastdb=0)\n')
+        blastdb = False
+
+    print('\nValores de parámetros usados en el análisis:')
+    print('evalue: '+str(eval))
+    print('coverage: '+str(cov)+'%')
+    print('identity: '+str(iden)+'%')
+    print('workers: '+str(workers))
+    print('threads: '+str(threads))
+    print('blastdb: '+str(blastdb))
+    print('batch: '+str(batch))
+    print('shards: '+str(shards))
+    print('dedup: '+str(dedup))
+    print('compress: '+str(compress))
+    print('cache: '+str(cache))
+    print('cluster: '+(str(cluster)+'%' if cluster else 'False'))
+    print('prefilter: '+str(prefilter))
+    print('jobs: '+str(jobs))
+    print('tools: '+str(tools))
+    #Sin preguntas, por defecto no se sobreescriben resultados anteriores
+    if unattended and overwrite == 'ask':
+        overwrite = 'no'
+    print('unattended: '+str(unattended))
+    print('overwrite: '+overwrite)
+    print('plots: '+(plot_format if unattended else 'interactive'))
+    #Perfilar una etapa también activa las métricas, con su archivo por
+    #defecto si no se ha dado
+    if profile and not metrics:
+        metrics = 'identipy_metrics.json'
+    print('metrics: '+str(metrics))
+    print('profile: '+str(profile))
+    if metrics:
+        id.imetrics.enable(profile, os.path.splitext(metrics)[0]+'.'\
+                           + profile+'.prof' if profile else None)
+
+    #Máximo de procesos externos (blastp, muscle...) ejecutándose a la vez
+    id.set_tool_limit(tools)
+
+    print('\n> Creando base de datos multifasta MultifaDB.fasta de los '\
+         + 'ensamblados genómicos...')
+    print('-------------------------------------------------------------'\
+         + '----------------------')
+
+    #Creación del MultifaDB.fasta a partir de las secuencias de la database
+    #(con dedup cada secuencia repetida se escribe una sola vez y se cargan
+    #sus miembros para repetir luego los resultados para todos)
+    id.make_multifa(database_path, workers=workers, dedup=dedup, \
+                    compress=compress)
+    members, dbsize = id.load_members()
+    #Si se pide se crea (o se reutiliza si está al día) la base de datos de
+    #BLAST formateada en la que se buscan las querys
+    db = id.make_blastdb(id.multifa_path()) if blastdb else None
+    #El índice de k-mers del prefiltro se carga (o crea) una sola vez para
+    #todas las querys, antes de analizarlas a la vez
+    index = id.make_kmer_index(id.multifa_path()) if prefilter else None
+    #Lo mismo con los shards de la búsqueda repartida y el índice de
+    #patrones de prosite, de forma que las querys analizadas a la vez solo
+    #los leen (el índice de MultifaDB ya lo crea make_multifa)
+    if shards > 1 and not prefilter:
+        id.make_blast_shards(id.multifa_path(), shards, blastdb=blastdb)
+    id.load_prosite('prosite.dat')
+    print('\t'+success+'{+}'+normal+' ¡La base de datos se ha creado exitosamente!')
+
+    print('\n> Comprobando los archivos query...')
+    print('------------------------------------------------------------')
+
+    #Primero se comprueban todas las querys y se crean sus carpetas de
+    #resultados, de forma que la búsqueda por lotes ya las tenga todas
+    queries = []
+    for file in os.listdir(querys_path):
+        #Para cada proteina query se hace un análisis de blast, muscle y prosite
+        path = querys_path+"/"+file
+        #Se obtiene el nombre separando por el punto y tomando con la parte anterior
+        filename = file.split('.')[0]
+
+        #Control de argumentos para query:
+        try: #Se intenta parsear por seqio (descomprimiendo si hace falta)
+            with id.open_input(path) as handle:
+                SeqIO.read(handle, 'fasta')
+        except:
+            print('\t'+error+'{x}'+normal+' El archivo query '+file+' no está en '\
+                 + 'formato fasta y se ha omitido para el análisis')
         else:
-            print('\t'+error+'{x}'+normal+' No se encontró ningún hit. '\
-                 + 'Análisis abortado.')
+            #Si no da error se procede a intentar crear los directorios de resultado
+            #Si el directorio ya existe se pregunta si se desea sobreescribir el
+            #(o se aplica la política de overwrite si no es 'ask')
+            if os.path.isdir('Result_'+filename):
+                print('\t'+error+'{x}'+normal+' ERROR: Ya existe una carpeta de '\
+                + 'resultados para la query '+filename)
+                if overwrite == 'ask':
+                    user_choice = input('\t'+question+'{?}'+normal\
+                                       +' Quieres sobreescribirla? [y/n]: ')
+                else:
+                    user_choice = 'y' if overwrite == 'yes' else 'n'
+                    print('\t'+question+'{?}'+normal+' overwrite='\
+                         + overwrite+': '+('se sobreescribe' if \
+                         overwrite == 'yes' else 'se omite la query'))
+                if user_choice in ['Y','y','yes']:
+                    #Si se desea sobreescribir se borra el directorio y sus
+                    #contenidos y se crea de nuevo la carpeta
+                    shutil.rmtree('Result_'+filename)
+                    os.mkdir('Result_'+filename)
+                else:
+                    #Pero si no se desea sobreescribir se pasa a la siguiente query
+                    continue
+            #Si el directorio no existía simplemente se crea
+            else:
+                os.mkdir('Result_'+filename)
+            #Las querys comprimidas se descomprimen en su carpeta de
+            #resultados, porque blastp solo lee archivos de texto
+            if id.compression(path) is not None:
+                with id.open_input(path) as handle, \
+                     open('Result_'+filename+'/Query.fasta', 'w') as output:
+                    shutil.copyfileobj(handle, output)
+                path = 'Result_'+filename+'/Query.fasta'
+            queries.append((path, filename))
+
+    #En modo por lotes se buscan todas las querys con una sola llamada a blastp
+    batch_hits = {}
+    if batch and queries:
+        batch_hits = id.blastp_batch([(path, 'Result_'+filename) \
+                                      for path, filename in queries], \
+                                     eval, cov, iden, db=db, threads=threads, \
+                                     shards=shards, return_rows=True, \
+                                     members=members, dbsize=dbsize, \
+                                     cache=cache, prefilter=prefilter, \
+                                     save_table=True, index=index)
+
+    #Con jobs > 1 las querys se analizan a la vez en un pool de hilos (el
+    #trabajo pesado lo hacen procesos externos y los workers de prosite), sin
+    #preguntas ni gráficos (salvo los de unattended, que van a archivo)
+    plotter = None
+    if unattended and plot_format != 'none' and queries:
+        plotter = id.start_plot_worker()
+    plots = []
+    identity = cluster / 100 if cluster else None
+    blast_args = {'eval': eval, 'cov_t': cov, 'iden_t': iden, 'db': db, \
+                  'threads': threads, 'shards': shards, 'members': members, \
+                  'dbsize': dbsize, 'cache': cache, 'prefilter': prefilter, \
+                  'save_table': True, 'index': index}
+    if jobs > 1 and len(queries) > 1:
+        print('\n> Ejecutando análisis de '+str(len(queries))+' querys ('\
+             + str(jobs)+' a la vez)...')
+        print('------------------------------------------------------------')
+        with ThreadPoolExecutor(jobs) as executor:
+            futures = [executor.submit(analyze_query, path, filename, \
+                                       blast_args, workers, \
+                                       batch_hits.get('Result_'+filename), \
+                                       False, identity, plotter, \
+                                       plot_format) \
+                       for path, filename in queries]
+            #Se espera a todas las querys (si alguna falla se lanza su error)
+            for future in futures:
+                plots += future.result()
+    else:
+        for path, filename in queries:
+            plots += analyze_query(path, filename, blast_args, workers, \
+                                   batch_hits.get('Result_'+filename), \
+                                   not unattended, identity, plotter, \
+                                   plot_format)
+
+    #Al final se espera a los gráficos que aún se estén dibujando
+    if plotter is not None:
+        with id.imetrics.stage('plots'):
+            for plot_path, future in plots:
+                try:
+                    future.result()
+                except Exception as exception:
+                    print('\t'+error+'{x}'+normal+' No se pudo dibujar '\
+                         + plot_path+': '+str(exception))
+                else:
+                    print('\t'+success+'{+}'+normal+' Gráfico guardado en '\
+                         + plot_path)
+            plotter.shutdown()
+
+    #Por último se guardan las métricas del análisis
+    if metrics:
+        id.imetrics.write(metrics)
+        print('\t'+success+'{+}'+normal+' Métricas guardadas en '+metrics)
+
+#end main()
+
+
+#El análisis solo se ejecuta al lanzar el script (no al importarlo, lo que
+#ocurre p.ej. en los procesos worker de multiprocessing)
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,63 @@
+'''
+Tests de identipy.iblast (se ejecutan con "python -m pytest tests")
+'''
+
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from identipy.iblast import _merge_blast_shards
+
+
+def blast_line (query, subject, evalue, bitscore):
+    '''
+    Línea de blastp (BLAST_OUTFMT) con cov, iden y secuencia fijos
+    '''
+    return '%s\t%s\t90\t80.000\tMKV\t%.2e\t%.1f\n' \
+           % (query, subject, evalue, bitscore)
+
+#end blast_line()
+
+
+def test_merge_order ():
+    '''
+    Las querys salen en el orden de query_ids, los subjects ordenados por su
+    mejor evalue (y bitscore) entre shards y las HSPs de un subject juntas
+    '''
+    outputs = [[blast_line('q2', 's1', 1e-5, 50),
+                blast_line('q1', 's1', 1e-3, 40),
+                blast_line('q1', 's2', 1e-20, 90),
+                blast_line('q1', 's1', 1e-30, 100)],
+               [blast_line('q1', 's3', 1e-20, 95),
+                blast_line('q1', 's4', 1e-10, 60)]]
+
+    merged = _merge_blast_shards(['q1', 'q2', 'q3'], outputs)
+
+    assert [line.split('\t')[:2] for line in merged] \
+           == [['q1', 's1'], ['q1', 's1'], ['q1', 's3'], ['q1', 's2'],
+               ['q1', 's4'], ['q2', 's1']]
+    #Las HSPs de cada subject mantienen el orden en el que las dio blastp
+    assert merged[0] == outputs[0][1] and merged[1] == outputs[0][3]
+
+#end test_merge_order()
+
+
+def test_merge_max_targets ():
+    '''
+    Por query se quedan los max_targets subjects con mejor evalue de todos
+    los shards juntos (500 por defecto, como -max_target_seqs de blastp)
+    '''
+    outputs = [[blast_line('q1', 's%d' % n, (n % 700 + 1) * 1e-6, 50) \
+                for n in range(shard, 1400, 2)] for shard in range(2)]
+
+    merged = _merge_blast_shards(['q1'], outputs)
+    assert len(merged) == 500
+    evalues = [float(line.split('\t')[5]) for line in merged]
+    assert evalues == sorted(evalues)
+    assert max(evalues) == 250e-6
+
+    subjects = [line.split('\t')[1] for line in \
+                _merge_blast_shards(['q1'], outputs, max_targets=3)]
+    assert subjects == ['s0', 's700', 's1']
+
+#end test_merge_max_targets()
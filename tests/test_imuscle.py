@@ -0,0 +1,68 @@
+'''
+Tests de identipy.imuscle (se ejecutan con "python -m pytest tests")
+'''
+
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from identipy.imuscle import cluster_sequences, _sequence_identity, \
+                             word_length
+
+#Sustitución de cada aminoácido por el siguiente, para crear secuencias que
+#no comparten ningún k-mer con la original
+_NEXT = dict(zip('ACDEFGHIKLMNPQRSTVWY', 'CDEFGHIKLMNPQRSTVWYA'))
+
+
+def test_cluster_without_shared_kmers ():
+    '''
+    Con identity=0.5 el mínimo de k-mers es <= 0: dos secuencias con un 50%
+    de identidad que no comparten ningún k-mer van al mismo grupo
+    '''
+    a = 'ACDEFGHIKLMNPQRSTVWY'
+    b = ''.join(c if i % 2 == 0 else _NEXT[c] for i, c in enumerate(a))
+    k = word_length(0.5)
+    assert not {a[i:i+k] for i in range(len(a)-k+1)} \
+               & {b[i:i+k] for i in range(len(b)-k+1)}
+    assert _sequence_identity(a, b) == 0.5
+
+    assert cluster_sequences([('a', a), ('b', b)], 0.5) == [('a', ['a', 'b'])]
+
+#end test_cluster_without_shared_kmers()
+
+
+def test_cluster_shorter_than_k ():
+    '''
+    Secuencias idénticas más cortas que k (sin ningún k-mer) se agrupan
+    '''
+    assert cluster_sequences([('a', 'MKV'), ('b', 'MKV')], 0.9) \
+           == [('a', ['a', 'b'])]
+
+#end test_cluster_shorter_than_k()
+
+
+def test_cluster_repetitive ():
+    '''
+    Los k-mers repetidos cuentan con su multiplicidad: dos secuencias de
+    baja complejidad con un 97.5% de identidad se agrupan
+    '''
+    a = 'Q' * 40
+    b = 'Q' * 39 + 'A'
+
+    assert cluster_sequences([('a', a), ('b', b)], 0.9) == [('a', ['a', 'b'])]
+
+#end test_cluster_repetitive()
+
+
+def test_cluster_unrelated ():
+    '''
+    Secuencias sin relación quedan en grupos distintos y la primera (la
+    query) siempre es representante
+    '''
+    a = 'ACDEFGHIKLMNPQRSTVWY' * 3
+    b = 'W' * 80
+
+    assert cluster_sequences([('a', a), ('b', b)], 0.9) \
+           == [('a', ['a']), ('b', ['b'])]
+
+#end test_cluster_unrelated()